@@ -1411,35 +1411,68 @@
 
 import os
 import io
+# Boot timings for /api/health (see startup_profile.py)
+from startup_profile import StartupProfile
+startup = StartupProfile()
+import asyncio
+import contextlib
 import requests
-import google.generativeai as genai
-from flask import Flask, request, jsonify, session, send_from_directory
+import httpx
+from flask import Flask, request, jsonify, session, send_from_directory, Response, stream_with_context, g, has_app_context
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.utils import secure_filename 
+from werkzeug.utils import secure_filename, safe_join
 from dotenv import load_dotenv, find_dotenv
 import time
+import threading
+import click
 from datetime import datetime
 import json
+import mimetypes
 import traceback
-from PIL import Image 
+from urllib.parse import quote
+from PIL import Image, UnidentifiedImageError
 import base64
+from sqlalchemy import and_, or_
 from sqlalchemy.engine.url import make_url
 import uuid 
+import hashlib
+import math
+import queue
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import importlib.util
+startup.mark('import web stack')
 # --- GOOGLE CLOUD IMPORTS ---
-from google.cloud import speech
-from google.cloud import texttospeech
+# google.cloud.speech and texttospeech are imported on first use (startup.load)
 from google.oauth2 import service_account
+startup.mark('import google auth')
+from media_storage import ensure_media_path, resolve_media_path, iter_media_files, migrate_flat_folder, create_media_storage
+from image_utils import (
+    read_image_info, spool_response, file_sha256, extract_image_attributes, describe_image_attributes,
+    compact_format, COMPACT_FORMATS, MultipartFileStream, ImageTooLargeError
+)
+from image_workers import ImageWorkerPool, use_light_spawn_main
+from async_io import AsyncIORunner
+from grpc_clients import GrpcClientRegistry
+from llm_clients import LLMClientRegistry
+from rate_limiter import RateLimiter
+from resilience import (
+    BreakerRegistry, Bulkhead, Deadline, RetryPolicy, RetryBudget, ResilienceError, DeadlineExceededError
+)
+from phash_index import HammingIndex
+startup.mark('import local modules')
 
 # Optional: Imagen API (requires google-cloud-aiplatform)
-# NOTE: This block is kept but Image Generation is disabled due to 403 errors.
-try:
-    from google.cloud import aiplatform
-    from vertexai.preview.vision_models import ImageGenerationModel
-    IMAGEN_AVAILABLE = True
-except ImportError:
-    IMAGEN_AVAILABLE = False
+# NOTE: Image Generation is disabled due to 403 errors. Only checks that the SDK is
+# installed; aiplatform/vertexai take seconds to import and are not loaded here.
+IMAGEN_AVAILABLE = (
+    importlib.util.find_spec('google.cloud.aiplatform') is not None
+    and importlib.util.find_spec('vertexai') is not None
+)
 
 
 # Load environment variables
@@ -1475,31 +1508,134 @@ def get_google_credentials():
 # Get credentials
 credentials = get_google_credentials()
 
-# Initialize Google Cloud clients only if credentials are available
-speech_client = None
-tts_client = None
-
-if credentials:
-    try:
-        speech_client = speech.SpeechClient(credentials=credentials)
-        tts_client = texttospeech.TextToSpeechClient(credentials=credentials)
-        print("✓ Google Cloud Speech/TTS clients initialized")
-    except Exception as e:
-        print(f"⚠ Speech/TTS client initialization failed: {e}")
+# Speech/TTS clients are async (grpc.aio) and are created per worker process on
+# first use, see google_clients below. GRPC_WARMUP connects them on the first request.
+GOOGLE_SPEECH_AVAILABLE = credentials is not None
+GRPC_KEEPALIVE_SECONDS = float(os.getenv("GRPC_KEEPALIVE_SECONDS", 60))
+GRPC_KEEPALIVE_TIMEOUT_SECONDS = float(os.getenv("GRPC_KEEPALIVE_TIMEOUT_SECONDS", 20))
+GRPC_WARMUP = os.getenv("GRPC_WARMUP", "false").lower() == "true"
+GRPC_WARMUP_TIMEOUT = float(os.getenv("GRPC_WARMUP_TIMEOUT", 10))
+if GOOGLE_SPEECH_AVAILABLE:
+    print("✓ Google Cloud Speech/TTS credentials loaded")
 else:
     print("⚠ Running without Google Cloud Speech/TTS services")
+startup.mark('credentials')
 
 # Translation API Key
 TRANSLATION_API_KEY = os.getenv("TRANSLATION_API_KEY")
 
+# Content generation model (Groq). LLM_WARMUP connects to it on a worker's first request.
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() == "true"
+LLM_WARMUP_TIMEOUT = float(os.getenv("LLM_WARMUP_TIMEOUT", 10))
+# 'combined' asks for every platform's post in one JSON call (details sent once);
+# 'per_platform' sends one prompt per platform. Requests may override it with "mode".
+GENERATION_MODES = ('combined', 'per_platform')
+GENERATION_MODE = os.getenv("GENERATION_MODE", "combined").lower()
+if GENERATION_MODE not in GENERATION_MODES:
+    raise ValueError(f"GENERATION_MODE must be one of {', '.join(GENERATION_MODES)}, got {GENERATION_MODE!r}")
+GENERATION_COMBINED_MAX_TOKENS = int(os.getenv("GENERATION_COMBINED_MAX_TOKENS", 6000))
+# Idle Server-Sent Events streams get a comment line this often, so proxies keep them open
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+
 # Configure Clipdrop API
 CLIPDROP_API_KEY = os.getenv("CLIPDROP_API_KEY")
 CLIPDROP_AVAILABLE = bool(CLIPDROP_API_KEY)
+# Uploads are downscaled to this longest side before being sent to Clipdrop
+CLIPDROP_MAX_SIDE = int(os.getenv("CLIPDROP_MAX_SIDE", 2048))
+# Clipdrop returns large PNGs; enhanced images are stored in this format instead
+# (webp, avif, jpeg or png). ENHANCED_KEEP_MASTER also keeps the original PNG.
+ENHANCED_IMAGE_FORMAT = compact_format(os.getenv("ENHANCED_IMAGE_FORMAT", "webp"))
+ENHANCED_IMAGE_QUALITY = int(os.getenv("ENHANCED_IMAGE_QUALITY", 82))
+ENHANCED_KEEP_MASTER = os.getenv("ENHANCED_KEEP_MASTER", "false").lower() == "true"
+# Background removal starts speculatively right after upload. Each prefetch costs a
+# Clipdrop credit, so it is bounded per user and globally (per hour, per process).
+CUTOUT_PREFETCH_ENABLED = os.getenv("CUTOUT_PREFETCH", "true").lower() == "true"
+CUTOUT_PREFETCH_WORKERS = int(os.getenv("CUTOUT_PREFETCH_WORKERS", 2))
+CUTOUT_PREFETCH_MAX_PENDING = int(os.getenv("CUTOUT_PREFETCH_MAX_PENDING", 8))
+CUTOUT_PREFETCH_USER_HOURLY = int(os.getenv("CUTOUT_PREFETCH_USER_HOURLY", 10))
+CUTOUT_PREFETCH_GLOBAL_HOURLY = int(os.getenv("CUTOUT_PREFETCH_GLOBAL_HOURLY", 200))
+# Clipdrop allows 60 requests/minute per key; this is the share of one worker process
+CLIPDROP_RATE_LIMIT_PER_MINUTE = float(os.getenv("CLIPDROP_RATE_LIMIT_PER_MINUTE", 60))
+CLIPDROP_RATE_LIMIT_BURST = int(os.getenv("CLIPDROP_RATE_LIMIT_BURST", 5))
+clipdrop_rate_limiter = RateLimiter(CLIPDROP_RATE_LIMIT_PER_MINUTE, CLIPDROP_RATE_LIMIT_BURST)
+# Batch enhancement: photos per request and how many are processed at once
+ENHANCE_BATCH_MAX_IMAGES = int(os.getenv("ENHANCE_BATCH_MAX_IMAGES", 10))
+ENHANCE_BATCH_CONCURRENCY = int(os.getenv("ENHANCE_BATCH_CONCURRENCY", 3))
+# Circuit breakers for external providers: once CIRCUIT_FAILURE_RATE of the calls in
+# the last CIRCUIT_WINDOW_SECONDS failed or were slow, the provider is skipped for
+# CIRCUIT_OPEN_SECONDS instead of every request waiting for its timeout
+circuit_breakers = BreakerRegistry(
+    failure_rate=float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5)),
+    min_calls=int(os.getenv("CIRCUIT_MIN_CALLS", 5)),
+    window_seconds=int(os.getenv("CIRCUIT_WINDOW_SECONDS", 60)),
+    open_seconds=int(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+)
+# Calls slower than this count as failures
+PROVIDER_SLOW_CALL_SECONDS = {
+    'clipdrop': 20,
+    'translate': 5,
+    'tts': 5,
+    'speech': 10,
+    'groq': 20
+}
+# Concurrent calls per provider (per process). A request that cannot get a slot within
+# BULKHEAD_QUEUE_TIMEOUT seconds gets a 503, so a slow provider cannot take every thread.
+BULKHEAD_QUEUE_TIMEOUT = float(os.getenv("BULKHEAD_QUEUE_TIMEOUT", 1.0))
+BULKHEAD_RETRY_AFTER = int(os.getenv("BULKHEAD_RETRY_AFTER", 5))
+PROVIDER_CONCURRENCY = {
+    'clipdrop': int(os.getenv("CLIPDROP_MAX_CONCURRENCY", 8)),
+    'groq': int(os.getenv("GROQ_MAX_CONCURRENCY", 8)),
+    'translate': int(os.getenv("TRANSLATE_MAX_CONCURRENCY", 8)),
+    'tts': int(os.getenv("TTS_MAX_CONCURRENCY", 4)),
+    'speech': int(os.getenv("SPEECH_MAX_CONCURRENCY", 4)),
+    'image_fetch': int(os.getenv("IMAGE_FETCH_MAX_CONCURRENCY", 4))
+}
+provider_bulkheads = {
+    provider: Bulkhead(provider, limit, queue_timeout=BULKHEAD_QUEUE_TIMEOUT, retry_after=BULKHEAD_RETRY_AFTER)
+    for provider, limit in PROVIDER_CONCURRENCY.items()
+}
+# Time budget per request in seconds, by endpoint. Every outbound call gets the remaining
+# budget as its timeout. Clients can ask for a shorter budget (not below REQUEST_DEADLINE_MIN)
+# with an X-Request-Deadline header, never for a longer one.
+REQUEST_DEADLINE_DEFAULT = float(os.getenv("REQUEST_DEADLINE_DEFAULT", 30))
+REQUEST_DEADLINE_MIN = float(os.getenv("REQUEST_DEADLINE_MIN", 1))
+ENDPOINT_DEADLINES = {
+    'respond_to_conversation': float(os.getenv("CONVERSATION_DEADLINE", 30)),
+    'enhance_product_image': float(os.getenv("ENHANCE_DEADLINE", 90)),
+    'enhance_product_images_batch': float(os.getenv("ENHANCE_BATCH_DEADLINE", 300)),
+    'generate_from_conversation': float(os.getenv("GENERATE_DEADLINE", 60)),
+    'generate_from_conversation_stream': float(os.getenv("GENERATE_STREAM_DEADLINE", 120))
+}
+# Transient provider errors (429, 5xx, dropped connections) are retried with jittered
+# backoff; one request spends at most RETRY_BUDGET_PER_REQUEST retries in total.
+# TTS has no policy: its fallback voice is the retry.
+RETRY_BUDGET_PER_REQUEST = int(os.getenv("RETRY_BUDGET_PER_REQUEST", 4))
+PROVIDER_RETRY = {
+    'clipdrop': RetryPolicy(
+        max_attempts=int(os.getenv("CLIPDROP_MAX_ATTEMPTS", 3)),
+        credit_header='x-remaining-credits'
+    ),
+    'groq': RetryPolicy(
+        max_attempts=int(os.getenv("GROQ_MAX_ATTEMPTS", 3)),
+        credit_header='x-ratelimit-remaining-requests',
+        reset_headers=('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+    ),
+    'translate': RetryPolicy(max_attempts=2),
+    'speech': RetryPolicy(max_attempts=2)
+}
+# Upper bound for a single Postgres statement (also capped by the request deadline)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
 
 if CLIPDROP_AVAILABLE:
     print("✓ Clipdrop API configured")
+    if ENHANCED_IMAGE_FORMAT != os.getenv("ENHANCED_IMAGE_FORMAT", "webp").lower():
+        print(f"⚠ ENHANCED_IMAGE_FORMAT not supported by this Pillow build, using {ENHANCED_IMAGE_FORMAT}")
 else:
     print("⚠ Clipdrop API key not found. Set CLIPDROP_API_KEY in environment variables")
+startup.mark('configuration')
 
 
 app = Flask(__name__)
@@ -1548,8 +1684,33 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 86400
 UPLOAD_FOLDER = 'uploads'
 AUDIO_FOLDER = 'audio_responses'
 ENHANCED_IMAGES_FOLDER = 'enhanced_images'
+# Derived files that can always be recomputed (normalized provider uploads, ...)
+IMAGE_CACHE_FOLDER = os.getenv('IMAGE_CACHE_FOLDER', '.cache')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 MAX_FILE_SIZE = 50 * 1024 * 1024  
+# CPU-heavy image work runs in this many spawned processes (0 = in the request thread);
+# by default one core is left for the web worker
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', min(4, (os.cpu_count() or 1) - 1)))
+IMAGE_TASK_TIMEOUT = float(os.getenv('IMAGE_TASK_TIMEOUT', 60))
+# Uploads whose perceptual hashes differ in at most this many bits count as near-duplicates
+PHASH_DUPLICATE_DISTANCE = int(os.getenv('PHASH_DUPLICATE_DISTANCE', 10))
+# In-process cache of image attributes per content hash (the database is the shared cache)
+IMAGE_ATTRIBUTES_CACHE_SIZE = 512
+
+# Media serving mode:
+#   'direct'     - Flask streams the file itself (default, for local development)
+#   'x-accel'    - nginx streams it via X-Accel-Redirect (production behind nginx)
+#   'x-sendfile' - Apache/lighttpd stream it via X-Sendfile
+# For 'x-accel', nginx needs an internal location mapping the prefix to the backend folder:
+#   location /protected_media/ { internal; alias /path/to/backend/; }
+MEDIA_SERVING_MODE = os.getenv('MEDIA_SERVING_MODE', 'direct').lower()
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected_media').rstrip('/')
+
+# Media retention: unreferenced files older than the TTL are swept.
+# The background sweeper is disabled unless MEDIA_SWEEP_INTERVAL_HOURS > 0.
+MEDIA_RETENTION_HOURS = float(os.getenv('MEDIA_RETENTION_HOURS', 72))
+MEDIA_SWEEP_BATCH_SIZE = int(os.getenv('MEDIA_SWEEP_BATCH_SIZE', 500))
+MEDIA_SWEEP_INTERVAL_HOURS = float(os.getenv('MEDIA_SWEEP_INTERVAL_HOURS', 0))
 
 # Configure CORS (Updated from user's last provided file)
 CORS(app, 
@@ -1565,7 +1726,7 @@ CORS(app,
          "http://localhost:5001", 
          "http://127.0.0.1:5001"
      ],
-     allow_headers=["Content-Type", "Authorization", "Cookie", "X-Requested-With"],
+     allow_headers=["Content-Type", "Authorization", "Cookie", "X-Requested-With", "X-Request-Deadline"],
      expose_headers=["Set-Cookie", "Content-Type"],
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
      max_age=3600,
@@ -1576,14 +1737,60 @@ CORS(app,
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['AUDIO_FOLDER'] = AUDIO_FOLDER
 app.config['ENHANCED_IMAGES_FOLDER'] = ENHANCED_IMAGES_FOLDER
+app.config['IMAGE_CACHE_FOLDER'] = IMAGE_CACHE_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['MEDIA_SERVING_MODE'] = MEDIA_SERVING_MODE
+app.config['MEDIA_ACCEL_PREFIX'] = MEDIA_ACCEL_PREFIX
+# Flask's send_from_directory emits X-Sendfile itself when this is enabled
+app.config['USE_X_SENDFILE'] = MEDIA_SERVING_MODE == 'x-sendfile'
+
+if MEDIA_SERVING_MODE != 'direct':
+    print(f"✓ Media offloaded to reverse proxy ({MEDIA_SERVING_MODE})")
+
+# Media storage backend (local folders, or S3-compatible bucket with local read-through cache)
+media_storage = create_media_storage()
+print(f"✓ Media storage: {media_storage.name}")
+
+# Image processing runs out of the request threads; workers are started by the first
+# request of each worker process (see warm_provider_clients), not at import
+image_pool = ImageWorkerPool(workers=IMAGE_WORKERS, task_timeout=IMAGE_TASK_TIMEOUT)
+print(f"✓ Image workers: {IMAGE_WORKERS or 'inline'}")
+
+# Provider calls run as coroutines on one shared event loop (see async_io.py)
+io_loop = AsyncIORunner()
+
+# Google gRPC clients: created lazily after fork, never at import (see grpc_clients.py)
+google_clients = GrpcClientRegistry(
+    io_loop, credentials,
+    keepalive_seconds=GRPC_KEEPALIVE_SECONDS,
+    keepalive_timeout_seconds=GRPC_KEEPALIVE_TIMEOUT_SECONDS
+)
+google_clients.register('speech', lambda: startup.load('google.cloud.speech').SpeechAsyncClient)
+google_clients.register('tts', lambda: startup.load('google.cloud.texttospeech').TextToSpeechAsyncClient)
 
-# Configure Google Gemini API (still needed for context in content generation)
-genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
+# LLM clients: one per provider and model for the whole worker process (see llm_clients.py)
+llm_clients = LLMClientRegistry(io_loop)
+llm_clients.register('groq', lambda model: create_groq_client(model), warm=lambda client: client.models.list())
 
 # Initialize Database
 db = SQLAlchemy(app)
 
+if database_url:
+    from sqlalchemy import event
+    
+    with app.app_context():
+        @event.listens_for(db.engine, 'checkout')
+        def set_statement_timeout(dbapi_connection, connection_record, connection_proxy):
+            # Queries of a request never outlive its deadline
+            deadline = current_deadline()
+            seconds = DB_STATEMENT_TIMEOUT_MS / 1000
+            if deadline:
+                seconds = min(seconds, deadline.remaining())
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"SET statement_timeout = {max(1, int(seconds * 1000))}")
+
+startup.mark('app setup')
+
 # ==================== DATABASE MODELS (Unchanged) ====================
 
 class User(db.Model):
@@ -1624,6 +1831,8 @@ class Content(db.Model):
     punjabi_text = db.Column(db.Text)
     english_text = db.Column(db.Text)
     image_url = db.Column(db.String(255))
+    # Filename of the source upload (basename of image_url), for exact lookups
+    image_filename = db.Column(db.String(255), index=True)
     generated_description = db.Column(db.Text)
     generated_captions = db.Column(db.Text)
     enhanced_images = db.Column(db.Text)
@@ -1665,10 +1874,60 @@ class Conversation(db.Model):
         }
 
 
-# ==================== DATABASE INITIALIZATION (Unchanged) ====================
+class ImageUpload(db.Model):
+    """Per-upload image metadata, computed once when the image is uploaded"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    filename = db.Column(db.String(255), unique=True, nullable=False)
+    content_hash = db.Column(db.String(64), index=True)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    quality = db.Column(db.Text)
+    phash = db.Column(db.String(16))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'content_hash': self.content_hash,
+            'width': self.width,
+            'height': self.height,
+            'quality': json.loads(self.quality) if self.quality else None,
+            'phash': self.phash,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class ImageAttributes(db.Model):
+    """Visual attributes (palette, dimensions, brightness) cached per image content hash"""
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    attributes = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class GenerationCache(db.Model):
+    """Generated post per product fingerprint, platform, model, prompt version and photo"""
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    platform = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(100), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# ==================== DATABASE INITIALIZATION ====================
+# Schema creation (create_all, schema inspection, column migrations) is an explicit
+# deploy step: `flask --app app init-db`. Only the local SQLite database is
+# initialized on import, unless DB_AUTO_INIT says otherwise.
+DB_AUTO_INIT = os.getenv('DB_AUTO_INIT', 'false' if database_url else 'true').lower() == 'true'
+
+startup.mark('models')
+
 
 def init_database():
-    """Initialize database tables - creates all tables on startup"""
+    """Initialize database tables - creates missing tables (flask init-db)"""
     with app.app_context():
         try:
             # Import all models to ensure they're registered
@@ -1681,6 +1940,27 @@ def init_database():
             # Create all tables
             db.create_all()
             
+            # create_all() never alters existing tables, so add nullable columns
+            # that were introduced after a table was first created
+            from sqlalchemy import text
+            for table_name, table in db.metadata.tables.items():
+                if table_name not in existing_tables:
+                    continue
+                existing_columns = {column['name'] for column in inspector.get_columns(table_name)}
+                for column in table.columns:
+                    if column.name in existing_columns or not column.nullable:
+                        continue
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    with db.engine.begin() as conn:
+                        conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN "{column.name}" {column_type}'))
+                    print(f"✓ Added column {table_name}.{column.name}")
+                # ...and the indexes of those columns
+                existing_indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+                for index in table.indexes:
+                    if index.name not in existing_indexes:
+                        index.create(db.engine)
+                        print(f"✓ Added index {index.name}")
+            
             print("=" * 60)
             print("✓ Database initialized successfully!")
             print(f"  Engine: {db.engine.url.drivername}")
@@ -1694,8 +1974,15 @@ def init_database():
             import traceback
             traceback.print_exc()
 
-# IMPORTANT: Call this right after defining it
-init_database()
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and add new nullable columns"""
+    init_database()
+
+
+if DB_AUTO_INIT:
+    init_database()
+    startup.mark('database')
 
 
 # ==================== PLATFORM CONFIGURATION (Updated) ====================
@@ -1706,7 +1993,8 @@ PLATFORMS = [
         "icon": "📷",
         "description": "Visual storytelling with images",
         "char_limit": 2200,
-        "best_for": "Visual content, lifestyle, behind-the-scenes"
+        "best_for": "Visual content, lifestyle, behind-the-scenes",
+        "rendition": {"width": 1080, "height": 1080}
     },
     {
         "id": "facebook",
@@ -1714,7 +2002,8 @@ PLATFORMS = [
         "icon": "👥",
         "description": "Community engagement and detailed posts",
         "char_limit": 63206,
-        "best_for": "Detailed stories, community building"
+        "best_for": "Detailed stories, community building",
+        "rendition": {"width": 1200, "height": 630}
     },
     {
         "id": "twitter",
@@ -1722,7 +2011,8 @@ PLATFORMS = [
         "icon": "🐦",
         "description": "Short, punchy updates",
         "char_limit": 280,
-        "best_for": "Short, punchy updates. Must strictly adhere to the 280 character limit and use concise language."
+        "best_for": "Short, punchy updates. Must strictly adhere to the 280 character limit and use concise language.",
+        "rendition": {"width": 1600, "height": 900}
     },
     {
         "id": "linkedin",
@@ -1730,7 +2020,8 @@ PLATFORMS = [
         "icon": "💼",
         "description": "Professional networking",
         "char_limit": 3000,
-        "best_for": "Professional networking, formal tone, NO emojis, highlight craftsmanship, time, and quality."
+        "best_for": "Professional networking, formal tone, NO emojis, highlight craftsmanship, time, and quality.",
+        "rendition": {"width": 1200, "height": 627}
     },
     {
         "id": "marketplace",
@@ -1738,7 +2029,8 @@ PLATFORMS = [
         "icon": "🛒",
         "description": "E-commerce product listing description",
         "char_limit": 5000,
-        "best_for": "E-commerce listing description, SEO optimized, bullet points, feature focused on materials, price, and craftsmanship details."
+        "best_for": "E-commerce listing description, SEO optimized, bullet points, feature focused on materials, price, and craftsmanship details.",
+        "rendition": {"width": 1500, "height": 1500, "background": "white", "fill": 0.85}
     }
 ]
 
@@ -1810,6 +2102,35 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def send_media_file(folder_key, filename, mimetype=None):
+    """
+    Serve a file from one of the media folders (UPLOAD_FOLDER, AUDIO_FOLDER, ...).
+    In 'x-accel' mode we only resolve the path here and hand the actual
+    byte streaming to nginx through the X-Accel-Redirect header.
+    """
+    directory = app.config[folder_key]
+    
+    # Reject traversal before touching the disk, then find the (sharded or legacy) file
+    if safe_join(directory, filename) is None:
+        return jsonify({'error': 'File not found'}), 404
+    
+    filepath = media_storage.fetch(directory, filename)
+    if filepath is None:
+        return jsonify({'error': 'File not found'}), 404
+    
+    if app.config['MEDIA_SERVING_MODE'] != 'x-accel':
+        return send_from_directory(directory, os.path.relpath(filepath, directory), mimetype=mimetype)
+    
+    response = Response(mimetype=mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = f"{app.config['MEDIA_ACCEL_PREFIX']}/{quote(filepath)}"
+    return response
+
+
+def escape_like(value):
+    """value as a literal inside a LIKE pattern (with escape='\\')"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 def get_current_user():
     user_id = session.get('user_id')
     if user_id:
@@ -1817,7 +2138,430 @@ def get_current_user():
     return None
 
 
-def translate_to_english(punjabi_text):
+_image_attributes_cache = OrderedDict()
+_image_attributes_lock = threading.Lock()
+
+
+def get_image_attributes(content_hash, filepath):
+    """
+    Visual attributes for an image, computed once per content hash.
+    Looks in the in-process LRU first, then the ImageAttributes table.
+    """
+    with _image_attributes_lock:
+        if content_hash in _image_attributes_cache:
+            _image_attributes_cache.move_to_end(content_hash)
+            return _image_attributes_cache[content_hash]
+    
+    row = ImageAttributes.query.filter_by(content_hash=content_hash).first()
+    if row:
+        attributes = json.loads(row.attributes)
+    else:
+        attributes = image_pool.run(extract_image_attributes, filepath)
+        try:
+            db.session.add(ImageAttributes(content_hash=content_hash, attributes=json.dumps(attributes)))
+            db.session.commit()
+        except Exception as db_error:
+            # Another worker may have stored the same hash concurrently
+            print(f"[ATTRIBUTES] DB error: {db_error}")
+            db.session.rollback()
+    
+    with _image_attributes_lock:
+        _image_attributes_cache[content_hash] = attributes
+        while len(_image_attributes_cache) > IMAGE_ATTRIBUTES_CACHE_SIZE:
+            _image_attributes_cache.popitem(last=False)
+    
+    return attributes
+
+
+_phash_indexes = {}
+_phash_lock = threading.Lock()
+
+
+def find_near_duplicate_uploads(user_id, phash, exclude_upload_id=None, limit=5):
+    """
+    Earlier uploads of the same user whose perceptual hash is within
+    PHASH_DUPLICATE_DISTANCE bits. Each worker keeps a per-user HammingIndex and
+    tops it up with rows added since its last lookup (also by other workers).
+    
+    Returns: list of (ImageUpload, distance)
+    """
+    with _phash_lock:
+        index, last_id = _phash_indexes.get(user_id) or (HammingIndex(), 0)
+        
+        new_rows = db.session.query(ImageUpload.id, ImageUpload.phash).filter(
+            ImageUpload.user_id == user_id,
+            ImageUpload.id > last_id,
+            ImageUpload.phash.isnot(None)
+        ).order_by(ImageUpload.id)
+        for upload_id, upload_phash in new_rows:
+            index.add(upload_id, int(upload_phash, 16))
+            last_id = upload_id
+        _phash_indexes[user_id] = (index, last_id)
+        
+        matches = [
+            (upload_id, distance)
+            for upload_id, distance in index.search(int(phash, 16), PHASH_DUPLICATE_DISTANCE)
+            if upload_id != exclude_upload_id
+        ]
+    
+    if not matches:
+        return []
+    
+    # The index may still hold uploads the media sweeper has deleted since
+    uploads = {u.id: u for u in ImageUpload.query.filter(ImageUpload.id.in_([m[0] for m in matches]))}
+    return [(uploads[upload_id], distance) for upload_id, distance in matches if upload_id in uploads][:limit]
+
+
+def get_or_create_image_upload(filename, filepath, user_id=None):
+    """
+    Return the ImageUpload row for an uploaded file, analysing the image
+    (content hash, quality scores) the first time it is seen.
+    Uploads from before this table existed are analysed on first use.
+    """
+    upload = ImageUpload.query.filter_by(filename=filename).first()
+    if upload and (upload.phash or not upload.quality):
+        return upload
+    
+    try:
+        analysis = image_pool.analyze_upload(filepath)
+        quality = analysis['quality']
+        phash = f"{analysis['phash']:016x}"
+        print(f"[QUALITY] {filename}: sharpness={quality['sharpness']}, brightness={quality['brightness']}, issues={quality['issues']}")
+    except (UnidentifiedImageError, ImageTooLargeError, OSError, BrokenProcessPool, RuntimeError) as e:
+        # RuntimeError: the image worker pool is shut down
+        print(f"[QUALITY] Could not analyse {filename}: {e}")
+        quality = None
+        phash = None
+    
+    if upload is None:
+        upload = ImageUpload(user_id=user_id, filename=filename, content_hash=file_sha256(filepath))
+    upload.width = quality['width'] if quality else None
+    upload.height = quality['height'] if quality else None
+    upload.quality = json.dumps(quality) if quality else None
+    upload.phash = phash
+    try:
+        db.session.add(upload)
+        db.session.commit()
+    except Exception as db_error:
+        print(f"[QUALITY] DB error: {db_error}")
+        db.session.rollback()
+    
+    return upload
+
+
+@app.before_request
+def start_request_deadline():
+    seconds = ENDPOINT_DEADLINES.get(request.endpoint, REQUEST_DEADLINE_DEFAULT)
+    requested = request.headers.get('X-Request-Deadline')
+    if requested:
+        try:
+            requested = float(requested)
+        except ValueError:
+            requested = None
+        if requested is not None and math.isfinite(requested):
+            seconds = min(max(requested, REQUEST_DEADLINE_MIN), seconds)
+    g.deadline = Deadline(seconds)
+    g.retry_budget = RetryBudget(RETRY_BUDGET_PER_REQUEST)
+
+
+def current_deadline():
+    """Deadline of the request being served, or None outside requests (background threads)"""
+    return g.get('deadline') if has_app_context() else None
+
+
+def call_timeout(cap, stage=None):
+    """
+    Timeout for an outbound call: the request's remaining budget, at most cap seconds.
+    
+    Raises: DeadlineExceededError once the budget is spent, so later stages never start
+    """
+    deadline = current_deadline()
+    return deadline.timeout(cap, stage) if deadline else cap
+
+
+def provider_breaker(provider, key=None):
+    """Circuit breaker for a provider, or for one voice/model of it ('tts', 'pa-IN-Wavenet-B')"""
+    return circuit_breakers.get(
+        f"{provider}:{key}" if key else provider,
+        slow_call_seconds=PROVIDER_SLOW_CALL_SECONDS.get(provider)
+    )
+
+
+def provider_http_error(response):
+    """
+    Responses that count against a provider's circuit: its own failures, not bad input
+    or rate limiting (429s are retried after the provider's Retry-After instead)
+    """
+    return response.status_code >= 500
+
+
+def _retry_delay(provider, retry, attempt, result, error, idempotent):
+    """Seconds to wait before retrying a failed provider call, or None to give up"""
+    if not retry.is_transient(result, error, idempotent):
+        return None
+    
+    delay = retry.delay(attempt - 1, result, error)
+    deadline = current_deadline()
+    budget = g.get('retry_budget') if has_app_context() else None
+    if attempt >= retry.max_attempts:
+        reason = f"{attempt} attempts"
+    elif retry.out_of_credits(result, error):
+        reason = "no credits left"
+    elif delay > retry.max_hinted_delay:
+        reason = f"asked to wait {delay:.0f}s"
+    elif deadline and delay >= deadline.remaining():
+        reason = "request deadline"
+    elif budget and not budget.take():
+        reason = "request retry budget spent"
+    else:
+        retry.record(True)
+        return delay
+    
+    retry.record(False)
+    print(f"[RETRY] {provider}: giving up ({reason})")
+    return None
+
+
+def _record_provider_attempt(provider, breaker, started, result=None, error=None, is_failure=None):
+    """
+    Report one attempt (reserved with breaker.before_call()) to the provider's breaker.
+    An attempt that failed because the request's own deadline ran out says nothing
+    about the provider: it is released without an outcome and DeadlineExceededError
+    is raised instead, so short client deadlines can't open a provider's circuit.
+    """
+    latency = time.monotonic() - started
+    if error is None:
+        breaker.record(not (is_failure and is_failure(result)), latency)
+        return
+    deadline = current_deadline()
+    if deadline and deadline.expired():
+        breaker.release()
+        raise DeadlineExceededError(provider) from error
+    breaker.record(False, latency)
+
+
+def _next_provider_attempt(provider, retry, attempt, result, error, idempotent):
+    """Seconds to wait before retrying a provider call, or None when the call is finished"""
+    if retry is None:
+        return None
+    retry.observe(result, error)
+    delay = _retry_delay(provider, retry, attempt, result, error, idempotent)
+    if delay is not None:
+        status = result.status_code if result is not None else type(error).__name__
+        print(f"[RETRY] {provider} attempt {attempt} failed ({status}), retrying in {delay:.1f}s")
+    return delay
+
+
+def call_provider(provider, fn, *args, key=None, is_failure=None, rate_limiter=None, idempotent=False, **kwargs):
+    """
+    Call an external provider inside its bulkhead and through its circuit breaker,
+    retrying transient failures with PROVIDER_RETRY[provider]. Every call is retried
+    on 429/503; idempotent calls also on other 5xx and dropped connections.
+    timeout: cap in seconds; each attempt gets the request's remaining budget up to it
+    rate_limiter: optional RateLimiter to wait for before each attempt
+    
+    Returns: fn's result (the last one if every attempt failed with a response)
+    Raises: CircuitOpenError or BulkheadFullError (both ResilienceError) without calling fn,
+            DeadlineExceededError if the call failed because the request ran out of time
+    """
+    breaker = provider_breaker(provider, key)
+    retry = PROVIDER_RETRY.get(provider)
+    timeout_cap = kwargs.pop('timeout', None)
+    attempt = 0
+    
+    while True:
+        breaker.check()
+        if timeout_cap is not None:
+            kwargs['timeout'] = call_timeout(timeout_cap, provider)
+        result, error = None, None
+        # Wait for a rate-limit token before taking a bulkhead slot, so callers
+        # queued on the limiter don't hold slots they aren't using
+        if rate_limiter:
+            rate_limiter.acquire(timeout=call_timeout(60, provider))
+        with provider_bulkheads[provider].slot():
+            breaker.before_call()
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                error = e
+            except BaseException:
+                breaker.release()
+                raise
+            _record_provider_attempt(provider, breaker, started, result, error, is_failure)
+        attempt += 1
+        
+        delay = _next_provider_attempt(provider, retry, attempt, result, error, idempotent)
+        if delay is None:
+            break
+        if hasattr(result, 'close'):
+            result.close()
+        time.sleep(delay)
+    
+    if error is not None:
+        raise error
+    return result
+
+
+async def acall_provider(provider, fn, *args, key=None, is_failure=None, rate_limiter=None, idempotent=False, **kwargs):
+    """call_provider() for coroutines on the provider I/O loop: fn is awaited, all waits are async"""
+    breaker = provider_breaker(provider, key)
+    retry = PROVIDER_RETRY.get(provider)
+    timeout_cap = kwargs.pop('timeout', None)
+    attempt = 0
+    
+    while True:
+        breaker.check()
+        if timeout_cap is not None:
+            kwargs['timeout'] = call_timeout(timeout_cap, provider)
+        result, error = None, None
+        if rate_limiter:
+            await rate_limiter.acquire_async(timeout=call_timeout(60, provider))
+        async with provider_bulkheads[provider].aslot():
+            breaker.before_call()
+            started = time.monotonic()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                error = e
+            except BaseException:
+                # Cancelled: still release a half-open probe
+                breaker.release()
+                raise
+            _record_provider_attempt(provider, breaker, started, result, error, is_failure)
+        attempt += 1
+        
+        delay = _next_provider_attempt(provider, retry, attempt, result, error, idempotent)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    
+    if error is not None:
+        raise error
+    return result
+
+
+def _deadline_scope():
+    """asyncio.timeout() bounded by the request's remaining budget (unbounded outside requests)"""
+    deadline = current_deadline()
+    return asyncio.timeout(deadline.remaining() if deadline else None)
+
+
+@contextlib.asynccontextmanager
+async def acall_provider_stream(provider, fn, *args, key=None, rate_limiter=None, idempotent=False, **kwargs):
+    """
+    acall_provider() for streamed responses: async with acall_provider_stream(...) as stream.
+    
+    Opening the stream is retried like any call. Once it is open, the bulkhead slot and
+    the breaker attempt are held until the block exits, so a stream counts against the
+    provider's concurrency for as long as it is read and a stream that breaks part-way
+    is recorded as a failure. Opening and reading are bounded by the request deadline.
+    """
+    breaker = provider_breaker(provider, key)
+    retry = PROVIDER_RETRY.get(provider)
+    timeout_cap = kwargs.pop('timeout', None)
+    attempt = 0
+    
+    while True:
+        breaker.check()
+        if timeout_cap is not None:
+            kwargs['timeout'] = call_timeout(timeout_cap, provider)
+        stream, error = None, None
+        if rate_limiter:
+            await rate_limiter.acquire_async(timeout=call_timeout(60, provider))
+        async with provider_bulkheads[provider].aslot():
+            breaker.before_call()
+            started = time.monotonic()
+            try:
+                async with _deadline_scope():
+                    stream = await fn(*args, **kwargs)
+            except Exception as e:
+                error = e
+            except BaseException:
+                breaker.release()
+                raise
+            
+            if error is None:
+                try:
+                    async with _deadline_scope():
+                        yield stream
+                except Exception as e:
+                    error = e
+                except BaseException:
+                    breaker.release()
+                    raise
+                _record_provider_attempt(provider, breaker, started, error=error)
+                if error is not None:
+                    raise error
+                return
+            _record_provider_attempt(provider, breaker, started, error=error)
+        attempt += 1
+        
+        # Only opening is retried: once read, tokens may already have been passed on
+        delay = _next_provider_attempt(provider, retry, attempt, None, error, idempotent)
+        if delay is None:
+            raise error
+        await asyncio.sleep(delay)
+
+
+def provider_http_client(provider):
+    """Shared httpx.AsyncClient of a provider: pooled keep-alive connections (call on io_loop)"""
+    limit = PROVIDER_CONCURRENCY.get(provider, 10)
+    return io_loop.client(f"http:{provider}", lambda: httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+        timeout=30
+    ))
+
+
+def create_groq_client(model):
+    """AsyncGroq client of one model (built once per process by llm_clients); all models share the Groq connection pool"""
+    from groq import AsyncGroq
+    # Retries are done by acall_provider (shared budget, deadline-aware)
+    return AsyncGroq(
+        api_key=os.environ.get('GROQ_API_KEY'),
+        max_retries=0,
+        http_client=provider_http_client('groq')
+    )
+
+
+async def llm_chat(provider, model, messages, **kwargs):
+    """Chat completion on the shared client of provider/model; latency is recorded per model"""
+    started = time.monotonic()
+    try:
+        response = await acall_provider(
+            provider, llm_clients.client(provider, model).chat.completions.create,
+            model=model, messages=messages, idempotent=True, **kwargs
+        )
+    except BaseException:
+        llm_clients.record(provider, model, time.monotonic() - started, False)
+        raise
+    usage = getattr(response, 'usage', None)
+    llm_clients.record(provider, model, time.monotonic() - started, True, getattr(usage, 'completion_tokens', None))
+    return response
+
+
+def google_async_client(kind):
+    """Google 'speech' or 'tts' async client on the provider I/O loop (grpc.aio channels are bound to it)"""
+    return google_clients.get(kind)
+
+
+async def recognize_punjabi_async(audio_content):
+    """Punjabi transcript of a WEBM/Opus recording ('' if nothing was understood)"""
+    speech = await startup.aload('google.cloud.speech')
+    audio = speech.RecognitionAudio(content=audio_content)
+    config = speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
+        language_code='pa-IN',
+        enable_automatic_punctuation=True,
+    )
+    response = await acall_provider(
+        'speech', google_async_client('speech').recognize, config=config, audio=audio,
+        timeout=30, idempotent=True
+    )
+    return " ".join([r.alternatives[0].transcript for r in response.results]).strip()
+
+
+async def translate_to_english_async(punjabi_text):
     try:
         url = "https://translation.googleapis.com/language/translate/v2"
         params = {
@@ -1827,7 +2571,10 @@ def translate_to_english(punjabi_text):
             'target': 'en',
             'format': 'text'
         }
-        response = requests.post(url, params=params, timeout=10)
+        response = await acall_provider(
+            'translate', provider_http_client('translate').post, url, params=params,
+            timeout=10, is_failure=provider_http_error, idempotent=True
+        )
         
         if response.status_code == 200:
             result = response.json()
@@ -1844,12 +2591,20 @@ def translate_to_english(punjabi_text):
         return None
 
 
-def text_to_speech_punjabi(text, output_filename):
-    if not tts_client:
+def _store_audio(output_filename, audio_content):
+    output_path = ensure_media_path(app.config['AUDIO_FOLDER'], output_filename)
+    with open(output_path, 'wb') as out:
+        out.write(audio_content)
+    media_storage.put(app.config['AUDIO_FOLDER'], output_filename, output_path)
+
+
+async def text_to_speech_punjabi_async(text, output_filename):
+    if not GOOGLE_SPEECH_AVAILABLE:
         print("[TTS] Client not initialized")
         return None
         
     try:
+        texttospeech = await startup.aload('google.cloud.texttospeech')
         synthesis_input = texttospeech.SynthesisInput(text=text)
         
         voice_configs = [
@@ -1859,6 +2614,10 @@ def text_to_speech_punjabi(text, output_filename):
         
         response = None
         for voice_config in voice_configs:
+            # Each voice has its own breaker, so a failing pa-IN voice is skipped
+            # straight to the fallback instead of being retried on every call
+            if not provider_breaker('tts', voice_config["name"]).available():
+                continue
             try:
                 voice = texttospeech.VoiceSelectionParams(
                     language_code=voice_config["language_code"],
@@ -1866,26 +2625,208 @@ def text_to_speech_punjabi(text, output_filename):
                     ssml_gender=voice_config["ssml_gender"]
                 )
                 audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-                response = tts_client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config)
+                response = await acall_provider(
+                    'tts', google_async_client('tts').synthesize_speech, key=voice_config["name"],
+                    input=synthesis_input, voice=voice, audio_config=audio_config, timeout=10
+                )
                 break
-            except:
+            except Exception as e:
+                print(f"[TTS] Voice {voice_config['name']} failed: {e}")
                 continue
         
         if not response:
             return None
         
-        output_path = os.path.join(app.config['AUDIO_FOLDER'], output_filename)
-        with open(output_path, 'wb') as out:
-            out.write(response.audio_content)
+        # Disk (and S3) writes stay off the event loop
+        await asyncio.to_thread(_store_audio, output_filename, response.audio_content)
         return output_filename
     except Exception as e:
         print(f"[TTS] Error: {str(e)}")
         return None
 
 
+def text_to_speech_punjabi(text, output_filename):
+    return io_loop.run(text_to_speech_punjabi_async(text, output_filename))
+
+
+async def process_spoken_answer(audio_content, session_id, next_step=None):
+    """
+    Transcribe an answer, then translate it while the next question is synthesized.
+    
+    Returns: (punjabi_text, english_text, audio_filename or None)
+    """
+    punjabi_text = await recognize_punjabi_async(audio_content)
+    if not punjabi_text:
+        return punjabi_text, None, None
+    
+    if not next_step:
+        return punjabi_text, await translate_to_english_async(punjabi_text), None
+    
+    english_text, audio_file = await asyncio.gather(
+        translate_to_english_async(punjabi_text),
+        text_to_speech_punjabi_async(next_step['question_pa'], f"{session_id}_{next_step['step']}.mp3")
+    )
+    return punjabi_text, english_text, audio_file
+
+
 # ==================== CLIPDROP IMAGE ENHANCEMENT HELPERS ====================
 
-def enhance_image_with_clipdrop(image_path, product_info=None):
+def prepare_clipdrop_upload(image_path):
+    """
+    Normalize an upload before sending it to Clipdrop: EXIF orientation applied,
+    metadata stripped, downscaled to CLIPDROP_MAX_SIDE and re-encoded with the
+    matching MIME type. Cached per source hash.
+    
+    Returns: (path, filename, mime_type)
+    """
+    try:
+        normalized = image_pool.normalize_for_provider(image_path, app.config['IMAGE_CACHE_FOLDER'], max_side=CLIPDROP_MAX_SIDE)
+        print(f"[CLIPDROP] Normalized upload: {os.path.getsize(image_path)} -> {os.path.getsize(normalized[0])} bytes")
+        return normalized
+    except (UnidentifiedImageError, OSError) as e:
+        # Let Clipdrop decide what to do with formats Pillow cannot read
+        print(f"[CLIPDROP] Could not normalize image, sending original: {e}")
+        mime_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+        return image_path, os.path.basename(image_path), mime_type
+
+
+def clipdrop_post(url, upload=None, **kwargs):
+    """
+    POST to Clipdrop once the shared rate limiter allows it; 429/5xx are retried
+    (Clipdrop calls have no side effects besides credits, which only 200s use).
+    upload: optional (field, path, filename, mime_type) streamed from disk as the
+            multipart body; the stream is reopened for every attempt
+    
+    Raises: ResilienceError (see call_provider)
+    """
+    def post(**attempt_kwargs):
+        if upload is None:
+            return requests.post(url, **attempt_kwargs)
+        with MultipartFileStream(*upload) as body:
+            headers = dict(attempt_kwargs.pop('headers', {}), **{'Content-Type': body.content_type})
+            return requests.post(url, data=body, headers=headers, **attempt_kwargs)
+    
+    return call_provider(
+        'clipdrop', post,
+        is_failure=provider_http_error, rate_limiter=clipdrop_rate_limiter, idempotent=True, **kwargs
+    )
+
+
+async def replace_background_async(no_bg_image, prompt):
+    """Clipdrop replace-background on the shared connection pool"""
+    return await acall_provider(
+        'clipdrop', provider_http_client('clipdrop').post,
+        'https://clipdrop-api.co/replace-background/v1',
+        files={'image_file': ('image.png', no_bg_image, 'image/png')},
+        data={'prompt': prompt},
+        headers={'x-api-key': CLIPDROP_API_KEY},
+        timeout=30,
+        is_failure=provider_http_error, rate_limiter=clipdrop_rate_limiter, idempotent=True
+    )
+
+
+def replace_backgrounds(no_bg_image, prompts):
+    """
+    Run replace-background for every prompt concurrently.
+    
+    Returns: list with a response or the raised exception per prompt, in order
+    """
+    async def replace_all():
+        return await asyncio.gather(
+            *(replace_background_async(no_bg_image, prompt) for prompt in prompts),
+            return_exceptions=True
+        )
+    return io_loop.run(replace_all())
+
+
+def _clipdrop_remove_background(image_path):
+    """
+    Call Clipdrop remove-background (the original is streamed from disk, not read into memory).
+    
+    Returns: PNG bytes with alpha, or None if removal failed
+    """
+    upload_path, upload_name, upload_mime = prepare_clipdrop_upload(image_path)
+    remove_bg_response = clipdrop_post(
+        'https://clipdrop-api.co/remove-background/v1',
+        upload=('image_file', upload_path, upload_name, upload_mime),
+        headers={'x-api-key': CLIPDROP_API_KEY},
+        timeout=30
+    )
+    
+    if remove_bg_response.status_code != 200:
+        print(f"[CLIPDROP] Background removal failed: {remove_bg_response.status_code}")
+        print(f"[CLIPDROP] Response: {remove_bg_response.text}")
+        return None
+    
+    no_bg_image = remove_bg_response.content
+    remove_bg_response.close()
+    return no_bg_image
+
+
+def _cutout_cache_folder():
+    return os.path.join(app.config['IMAGE_CACHE_FOLDER'], 'cutouts')
+
+
+def _cutout_cache_name(content_hash):
+    # The cut-out depends on the normalized upload, so the size limit is part of the key
+    return f"{content_hash}_{CLIPDROP_MAX_SIDE}.png"
+
+
+def read_cached_cutout(content_hash):
+    """Background-removed PNG for an upload's content hash, or None"""
+    path = resolve_media_path(_cutout_cache_folder(), _cutout_cache_name(content_hash))
+    if not path:
+        return None
+    with open(path, 'rb') as cached_file:
+        return cached_file.read()
+
+
+def _fetch_cutout(image_path, content_hash=None):
+    """Remove the background and keep the cut-out in the cache"""
+    no_bg_image = _clipdrop_remove_background(image_path)
+    if no_bg_image and content_hash:
+        path = ensure_media_path(_cutout_cache_folder(), _cutout_cache_name(content_hash))
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp_path, 'wb') as out_file:
+            out_file.write(no_bg_image)
+        os.replace(tmp_path, path)
+    return no_bg_image
+
+
+def remove_background(image_path, content_hash=None):
+    """
+    Background-removed version of an upload.
+    Uses the cut-out cache (usually filled by the speculative prefetch after upload),
+    waits for a prefetch of the same image that is still running, and only then
+    calls Clipdrop itself.
+    
+    Returns: PNG bytes with alpha, or None if removal failed
+    """
+    if content_hash:
+        cached = read_cached_cutout(content_hash)
+        if cached:
+            _count_cutout('cache_hits')
+            print("[CLIPDROP] ✓ Using cached cut-out")
+            return cached
+        
+        with _cutout_lock:
+            pending = _cutout_pending.get(content_hash)
+        if pending is not None:
+            try:
+                no_bg_image = pending.result(timeout=call_timeout(45, 'background removal'))
+            except Exception as e:
+                print(f"[CLIPDROP] Speculative cut-out failed: {e}")
+                no_bg_image = None
+            if no_bg_image:
+                _count_cutout('cache_hits')
+                print("[CLIPDROP] ✓ Using speculative cut-out")
+                return no_bg_image
+    
+    _count_cutout('misses')
+    return _fetch_cutout(image_path, content_hash)
+
+
+def enhance_image_with_clipdrop(image_path, product_info=None, content_hash=None):
     """
     Enhance product image using Clipdrop APIs:
     1. Remove background
@@ -1900,25 +2841,11 @@ def enhance_image_with_clipdrop(image_path, product_info=None):
     try:
         print(f"[CLIPDROP] Starting image enhancement for: {image_path}")
         
-        # Read original image
-        with open(image_path, 'rb') as img_file:
-            image_data = img_file.read()
-        
-        # Step 1: Remove Background
+        # Step 1: Remove Background (usually already done speculatively after upload)
         print("[CLIPDROP] Step 1: Removing background...")
-        remove_bg_response = requests.post(
-            'https://clipdrop-api.co/remove-background/v1',
-            files={'image_file': ('image.jpg', image_data, 'image/jpeg')},
-            headers={'x-api-key': CLIPDROP_API_KEY},
-            timeout=30
-        )
-        
-        if remove_bg_response.status_code != 200:
-            print(f"[CLIPDROP] Background removal failed: {remove_bg_response.status_code}")
-            print(f"[CLIPDROP] Response: {remove_bg_response.text}")
+        no_bg_image = remove_background(image_path, content_hash)
+        if not no_bg_image:
             return None
-        
-        no_bg_image = remove_bg_response.content
         print("[CLIPDROP] ✓ Background removed successfully")
         
         # Step 2: Replace Background with professional setting
@@ -1935,17 +2862,9 @@ def enhance_image_with_clipdrop(image_path, product_info=None):
         
         background_prompt = f"Professional studio setup for {craft_type}, clean white background, soft studio lighting, minimalist product photography, premium e-commerce aesthetic"
         
-        replace_bg_response = requests.post(
-            'https://clipdrop-api.co/replace-background/v1',
-            files={
-                'image_file': ('image.png', no_bg_image, 'image/png')
-            },
-            data={
-                'prompt': background_prompt
-            },
-            headers={'x-api-key': CLIPDROP_API_KEY},
-            timeout=30
-        )
+        replace_bg_response = replace_backgrounds(no_bg_image, [background_prompt])[0]
+        if isinstance(replace_bg_response, Exception):
+            raise replace_bg_response
         
         if replace_bg_response.status_code != 200:
             print(f"[CLIPDROP] Background replacement failed: {replace_bg_response.status_code}")
@@ -1958,36 +2877,134 @@ def enhance_image_with_clipdrop(image_path, product_info=None):
         
         # Save enhanced image
         timestamp = int(time.time())
-        filename = f"enhanced_{timestamp}_{os.path.basename(image_path)}"
-        output_path = os.path.join(app.config['ENHANCED_IMAGES_FOLDER'], filename)
-        
-        # CRITICAL FIX: Ensure directory exists before saving the file
-        os.makedirs(app.config['ENHANCED_IMAGES_FOLDER'], exist_ok=True)
-        
-        with open(output_path, 'wb') as out_file:
-            out_file.write(enhanced_image)
-        
-        file_size = os.path.getsize(output_path)
-        print(f"[CLIPDROP] ✓ Saved enhanced image: {filename} ({file_size} bytes)")
+        stem = f"enhanced_{timestamp}_{os.path.splitext(os.path.basename(image_path))[0]}"
+        stored = store_enhanced_image(enhanced_image, stem)
+        filename = stored['filename']
         
         base_url = os.getenv('BASE_URL', 'http://127.0.0.1:5001')
         image_url = f'{base_url}/enhanced_images/{filename}'
         
-        return {
+        result = {
             'url': image_url,
             'filename': filename,
-            'size': file_size,
+            'size': stored['size'],
+            'original_size': stored['original_size'],
+            'format': stored['format'],
             'method': 'clipdrop_enhancement',
-            'original_image': os.path.basename(image_path)
+            'original_image': os.path.basename(image_path),
+            'renditions': create_platform_renditions(enhanced_image, filename, no_bg_image)
         }
+        if stored['master_filename']:
+            result['master_url'] = f"{base_url}/enhanced_images/{stored['master_filename']}"
+        return result
         
+    except ResilienceError:
+        # Clipdrop down or saturated: the route answers 503 with Retry-After
+        raise
     except Exception as e:
         print(f"[CLIPDROP] Error: {str(e)}")
         traceback.print_exc()
         return None
 
 
-def create_multiple_background_variants(image_path, product_info=None, num_variants=3):
+def store_enhanced_image(image_bytes, stem):
+    """
+    Write a Clipdrop output to the enhanced images folder in ENHANCED_IMAGE_FORMAT.
+    The original PNG is kept as "<stem>_master.png" when ENHANCED_KEEP_MASTER is set,
+    and is stored as-is if re-encoding fails or would not make it smaller.
+    
+    Returns: dict with filename, path, size, original_size, format and master_filename
+    """
+    folder = app.config['ENHANCED_IMAGES_FOLDER']
+    original_size = len(image_bytes)
+    
+    filename = f"{stem}{COMPACT_FORMATS[ENHANCED_IMAGE_FORMAT][1]}"
+    output_path = ensure_media_path(folder, filename)
+    fmt = ENHANCED_IMAGE_FORMAT
+    try:
+        file_size = image_pool.transcode(image_bytes, output_path, fmt, ENHANCED_IMAGE_QUALITY)
+    except (UnidentifiedImageError, ImageTooLargeError, OSError) as e:
+        print(f"[CLIPDROP] Could not transcode {stem}, keeping original: {e}")
+        file_size = None
+    
+    if file_size is None or file_size >= original_size:
+        if file_size is not None:
+            os.remove(output_path)
+        fmt = 'png'
+        filename = f"{stem}.png"
+        output_path = ensure_media_path(folder, filename)
+        with open(output_path, 'wb') as out_file:
+            out_file.write(image_bytes)
+        file_size = original_size
+    media_storage.put(folder, filename, output_path)
+    
+    master_filename = None
+    if ENHANCED_KEEP_MASTER and fmt != 'png':
+        master_filename = f"{stem}_master.png"
+        master_path = ensure_media_path(folder, master_filename)
+        with open(master_path, 'wb') as out_file:
+            out_file.write(image_bytes)
+        media_storage.put(folder, master_filename, master_path)
+    
+    print(f"[CLIPDROP] ✓ Saved {filename} as {fmt}: {original_size} -> {file_size} bytes")
+    return {
+        'filename': filename,
+        'path': output_path,
+        'size': file_size,
+        'original_size': original_size,
+        'format': fmt,
+        'master_filename': master_filename
+    }
+
+
+def create_platform_renditions(enhanced_image, enhanced_filename, cutout=None, platform_ids=None):
+    """
+    Cut the per-platform crops (PLATFORMS[...]['rendition']) from one enhanced image.
+    enhanced_image: bytes of the enhanced image as received (full quality)
+    cutout: background-removed PNG bytes; its alpha mask centres the crops on the
+    product and the solid-background renditions are composited from it.
+    A failure here never fails the enhancement itself.
+    
+    Returns: dict platform id -> rendition info (empty dict on failure)
+    """
+    folder = app.config['ENHANCED_IMAGES_FOLDER']
+    stem = os.path.splitext(enhanced_filename)[0]
+    
+    specs = []
+    for platform in PLATFORMS:
+        rendition = platform.get('rendition')
+        if not rendition or (platform_ids is not None and platform['id'] not in platform_ids):
+            continue
+        filename = f"{stem}_{platform['id']}.jpg"
+        specs.append({**rendition, 'key': platform['id'], 'path': ensure_media_path(folder, filename)})
+    
+    if not specs:
+        return {}
+    
+    try:
+        start = time.time()
+        results = image_pool.render_renditions(enhanced_image, specs, cutout=cutout)
+        print(f"[RENDITIONS] {len(results)} renditions of {enhanced_filename} in {time.time() - start:.2f}s")
+    except Exception as e:
+        print(f"[RENDITIONS] Could not create renditions for {enhanced_filename}: {e}")
+        return {}
+    
+    base_url = os.getenv('BASE_URL', 'http://127.0.0.1:5001')
+    renditions = {}
+    for platform_id, info in results.items():
+        filename = os.path.basename(info['path'])
+        media_storage.put(folder, filename, info['path'])
+        renditions[platform_id] = {
+            'url': f'{base_url}/enhanced_images/{filename}',
+            'filename': filename,
+            'width': info['width'],
+            'height': info['height'],
+            'size': info['size']
+        }
+    return renditions
+
+
+def create_multiple_background_variants(image_path, product_info=None, num_variants=3, content_hash=None):
     """
     Create multiple professional background variants of the product image
     
@@ -2000,24 +3017,11 @@ def create_multiple_background_variants(image_path, product_info=None, num_varia
     try:
         print(f"[CLIPDROP] Creating {num_variants} background variants...")
         
-        # Read original image
-        with open(image_path, 'rb') as img_file:
-            image_data = img_file.read()
-        
-        # Step 1: Remove Background (do this once)
+        # Step 1: Remove Background (do this once; usually already done speculatively after upload)
         print("[CLIPDROP] Removing background...")
-        remove_bg_response = requests.post(
-            'https://clipdrop-api.co/remove-background/v1',
-            files={'image_file': ('image.jpg', image_data, 'image/jpeg')},
-            headers={'x-api-key': CLIPDROP_API_KEY},
-            timeout=30
-        )
-        
-        if remove_bg_response.status_code != 200:
-            print(f"[CLIPDROP] Background removal failed")
+        no_bg_image = remove_background(image_path, content_hash)
+        if not no_bg_image:
             return None
-        
-        no_bg_image = remove_bg_response.content
         print("[CLIPDROP] ✓ Background removed")
         
         # Get product context
@@ -2037,60 +3041,70 @@ def create_multiple_background_variants(image_path, product_info=None, num_varia
         ]
         
         enhanced_images = []
+        resilience_error = None
+        
+        # Step 2: All variant backgrounds are generated concurrently
+        prompts = background_prompts[:num_variants]
+        responses = replace_backgrounds(no_bg_image, prompts)
         
-        # Step 2: Create variants with different backgrounds
-        for idx, prompt in enumerate(background_prompts[:num_variants]):
+        # Solid-background renditions come from the cut-out alone, so they are
+        # identical for every variant and only rendered once
+        cutout_platforms = {p['id'] for p in PLATFORMS if p.get('rendition', {}).get('background')}
+        shared_renditions = None
+        
+        for idx, (prompt, replace_bg_response) in enumerate(zip(prompts, responses)):
             try:
                 print(f"[CLIPDROP] Creating variant {idx + 1}/{num_variants}...")
-                
-                replace_bg_response = requests.post(
-                    'https://clipdrop-api.co/replace-background/v1',
-                    files={
-                        'image_file': ('image.png', io.BytesIO(no_bg_image), 'image/png')
-                    },
-                    data={
-                        'prompt': prompt
-                    },
-                    headers={'x-api-key': CLIPDROP_API_KEY},
-                    timeout=30
-                )
+                if isinstance(replace_bg_response, Exception):
+                    raise replace_bg_response
                 
                 if replace_bg_response.status_code == 200:
                     timestamp = int(time.time())
                     # Use random to ensure unique filenames in high concurrency
                     import random
-                    filename = f"enhanced_{timestamp}_{random.randint(1000,9999)}_v{idx + 1}.png"
-                    
-                    # CRITICAL FIX: Ensure directory exists before saving the file
-                    os.makedirs(app.config['ENHANCED_IMAGES_FOLDER'], exist_ok=True)
+                    stem = f"enhanced_{timestamp}_{random.randint(1000,9999)}_v{idx + 1}"
                     
-                    output_path = os.path.join(app.config['ENHANCED_IMAGES_FOLDER'], filename)
+                    variant_image = replace_bg_response.content
+                    stored = store_enhanced_image(variant_image, stem)
+                    filename = stored['filename']
                     
-                    # Write file
-                    with open(output_path, 'wb') as out_file:
-                        out_file.write(replace_bg_response.content)
-                    
-                    file_size = os.path.getsize(output_path)
                     base_url = os.getenv('BASE_URL', 'http://127.0.0.1:5001')
                     image_url = f'{base_url}/enhanced_images/{filename}'
                     
-                    enhanced_images.append({
+                    if shared_renditions is None:
+                        renditions = create_platform_renditions(variant_image, filename, no_bg_image)
+                        shared_renditions = {k: v for k, v in renditions.items() if k in cutout_platforms}
+                    else:
+                        renditions = create_platform_renditions(
+                            variant_image, filename, no_bg_image,
+                            platform_ids={p['id'] for p in PLATFORMS} - set(shared_renditions)
+                        )
+                        renditions.update(shared_renditions)
+                    
+                    variant = {
                         'url': image_url,
                         'filename': filename,
                         'variant': idx + 1,
                         'background_style': prompt.split(',')[0],
-                        'size': file_size,
-                        'method': 'clipdrop_variant'
-                    })
+                        'size': stored['size'],
+                        'original_size': stored['original_size'],
+                        'format': stored['format'],
+                        'method': 'clipdrop_variant',
+                        'renditions': renditions
+                    }
+                    if stored['master_filename']:
+                        variant['master_url'] = f"{base_url}/enhanced_images/{stored['master_filename']}"
+                    enhanced_images.append(variant)
                     
                     print(f"[CLIPDROP] ✓ Variant {idx + 1} created")
                 else:
                     print(f"[CLIPDROP] Variant {idx + 1} failed: {replace_bg_response.status_code}")
-                
-                # Rate limiting delay
-                if idx < num_variants - 1:
-                    time.sleep(1.5)
                     
+            except ResilienceError as e:
+                # Keep the other variants rather than failing the request
+                print(f"[CLIPDROP] Variant {idx + 1} skipped: {e}")
+                resilience_error = resilience_error or e
+                continue
             except Exception as e:
                 print(f"[CLIPDROP] Error creating variant {idx + 1}: {str(e)}")
                 traceback.print_exc()
@@ -2100,20 +3114,400 @@ def create_multiple_background_variants(image_path, product_info=None, num_varia
             print(f"[CLIPDROP] Successfully created {len(enhanced_images)} variants")
             return enhanced_images
         else:
+            if resilience_error:
+                raise resilience_error
             print("[CLIPDROP] No variants were created")
             return None
             
+    except ResilienceError:
+        raise
     except Exception as e:
         print(f"[CLIPDROP] Fatal error: {str(e)}")
         traceback.print_exc()
         return None
 
 
-# ==================== ROUTES (Modified) ====================
+def get_conversation_product_info(user_id, session_id):
+    """collected_info of the user's completed conversation, or None"""
+    if not session_id:
+        return None
+    
+    conversation = Conversation.query.filter_by(
+        session_id=session_id,
+        user_id=user_id
+    ).first()
+    
+    if conversation and conversation.is_complete:
+        try:
+            product_info = json.loads(conversation.collected_info)
+            print(f"✅ Product info loaded from conversation")
+            return product_info
+        except:
+            print(f"⚠️ Could not parse product info")
+    return None
 
-@app.route('/')
-def home():
-    return jsonify({
+
+def save_enhanced_images(user_id, image_url, enhanced_images):
+    """
+    Store enhanced images on the user's latest Content record (or a new one).
+    
+    Returns: Content or None on DB error
+    """
+    try:
+        content = Content.query.filter_by(user_id=user_id).order_by(Content.created_at.desc()).first()
+        
+        if content:
+            content.enhanced_images = json.dumps(enhanced_images)
+            # The source upload is what keeps it from being swept
+            if image_url:
+                content.image_url = image_url
+                content.image_filename = os.path.basename(image_url)
+            db.session.commit()
+            print("✅ Updated existing content record")
+        else:
+            content = Content(
+                user_id=user_id,
+                image_url=image_url,
+                image_filename=os.path.basename(image_url) if image_url else None,
+                enhanced_images=json.dumps(enhanced_images)
+            )
+            db.session.add(content)
+            db.session.commit()
+            print("✅ Created new content record")
+        return content
+        
+    except Exception as db_error:
+        print(f"[ENHANCE] DB error: {db_error}")
+        db.session.rollback()
+        return None
+
+
+# ==================== SPECULATIVE BACKGROUND REMOVAL ====================
+# upload_image() starts the Clipdrop cut-out in the background so that a later
+# /api/enhance-image only has to replace the background.
+
+_cutout_executor = None
+_cutout_executor_pid = None
+_cutout_pending = {}
+_cutout_lock = threading.Lock()
+_cutout_budget = {'global': deque(), 'users': {}}
+_cutout_stats = {
+    'scheduled': 0, 'completed': 0, 'failed': 0, 'skipped_budget': 0,
+    'skipped_busy': 0, 'cache_hits': 0, 'misses': 0
+}
+
+
+def _count_cutout(key):
+    with _cutout_lock:
+        _cutout_stats[key] += 1
+
+
+def _get_cutout_executor():
+    # Created per process: threads do not survive a fork (gunicorn --preload)
+    global _cutout_executor, _cutout_executor_pid
+    if _cutout_executor is None or _cutout_executor_pid != os.getpid():
+        _cutout_executor = ThreadPoolExecutor(max_workers=CUTOUT_PREFETCH_WORKERS, thread_name_prefix='cutout-prefetch')
+        _cutout_executor_pid = os.getpid()
+    return _cutout_executor
+
+
+def _finish_cutout_prefetch(content_hash, future):
+    if future.exception() is not None:
+        print(f"[CUTOUT] Prefetch failed: {future.exception()}")
+    with _cutout_lock:
+        _cutout_pending.pop(content_hash, None)
+        if future.exception() is None and future.result():
+            _cutout_stats['completed'] += 1
+        else:
+            _cutout_stats['failed'] += 1
+
+
+def schedule_cutout_prefetch(user_id, image_path, content_hash):
+    """
+    Start background removal for a fresh upload if the budgets allow it.
+    
+    Returns: 'scheduled', 'cached', 'pending', 'busy', 'over_budget', 'unavailable' or 'disabled'
+    """
+    if not (CLIPDROP_AVAILABLE and CUTOUT_PREFETCH_ENABLED and content_hash and user_id):
+        return 'disabled'
+    if resolve_media_path(_cutout_cache_folder(), _cutout_cache_name(content_hash)):
+        return 'cached'
+    if not provider_breaker('clipdrop').available():
+        return 'unavailable'
+    
+    now = time.time()
+    with _cutout_lock:
+        if content_hash in _cutout_pending:
+            return 'pending'
+        if len(_cutout_pending) >= CUTOUT_PREFETCH_MAX_PENDING:
+            _cutout_stats['skipped_busy'] += 1
+            return 'busy'
+        
+        # Sliding one-hour windows of prefetches, globally and for this user
+        global_window = _cutout_budget['global']
+        user_window = _cutout_budget['users'].setdefault(user_id, deque())
+        for window in (global_window, user_window):
+            while window and window[0] < now - 3600:
+                window.popleft()
+        if not user_window:
+            _cutout_budget['users'].pop(user_id, None)
+        if len(global_window) >= CUTOUT_PREFETCH_GLOBAL_HOURLY or len(user_window) >= CUTOUT_PREFETCH_USER_HOURLY:
+            _cutout_stats['skipped_budget'] += 1
+            return 'over_budget'
+        
+        global_window.append(now)
+        user_window.append(now)
+        _cutout_budget['users'][user_id] = user_window
+        
+        future = _get_cutout_executor().submit(_fetch_cutout, image_path, content_hash)
+        _cutout_pending[content_hash] = future
+        _cutout_stats['scheduled'] += 1
+    
+    future.add_done_callback(lambda done: _finish_cutout_prefetch(content_hash, done))
+    return 'scheduled'
+
+
+def cutout_prefetch_stats():
+    with _cutout_lock:
+        return dict(_cutout_stats, pending=len(_cutout_pending), enabled=CLIPDROP_AVAILABLE and CUTOUT_PREFETCH_ENABLED)
+
+
+# ==================== MEDIA RETENTION SWEEPER ====================
+
+MEDIA_SWEEP_FOLDERS = ('UPLOAD_FOLDER', 'ENHANCED_IMAGES_FOLDER', 'AUDIO_FOLDER')
+# Cache folders are local-only and never referenced from the database, only the TTL applies
+MEDIA_CACHE_FOLDERS = ('IMAGE_CACHE_FOLDER',)
+
+_media_sweeper_pid = None
+
+
+def collect_referenced_media():
+    """
+    Build the set of media filenames that are still referenced from the database.
+    - uploads: Content.image_url (ImageUpload rows are metadata, not references:
+      they are deleted together with their file)
+    - enhanced images: every entry in Content.enhanced_images, its master and renditions
+    - audio: question audio of conversations that are still in progress
+      (audio files are named "<session_id>_<step>.mp3")
+    
+    Returns: (referenced filenames, tuple of live audio prefixes)
+    """
+    referenced = set()
+    
+    rows = db.session.query(Content.image_url, Content.enhanced_images).yield_per(1000)
+    for image_url, enhanced_images in rows:
+        if image_url:
+            referenced.add(os.path.basename(image_url))
+        if not enhanced_images:
+            continue
+        try:
+            for entry in json.loads(enhanced_images):
+                if entry.get('filename'):
+                    referenced.add(entry['filename'])
+                elif entry.get('url'):
+                    referenced.add(os.path.basename(entry['url']))
+                if entry.get('master_url'):
+                    referenced.add(os.path.basename(entry['master_url']))
+                for rendition in (entry.get('renditions') or {}).values():
+                    referenced.add(rendition['filename'])
+        except (ValueError, TypeError, AttributeError):
+            continue
+    
+    live_sessions = db.session.query(Conversation.session_id).filter(Conversation.is_complete.is_(False)).yield_per(1000)
+    audio_prefixes = tuple(f"{session_id}_" for (session_id,) in live_sessions)
+    
+    return referenced, audio_prefixes
+
+
+def _delete_media_batch(batch, stats):
+    deleted_uploads = []
+    for folder, filename, path in batch:
+        try:
+            if path:
+                os.remove(path)
+            else:
+                media_storage.delete(folder, filename)
+            stats['deleted'] += 1
+            if folder == app.config['UPLOAD_FOLDER']:
+                deleted_uploads.append(filename)
+        except Exception as e:
+            print(f"[SWEEPER] Could not delete {filename}: {e}")
+            stats['errors'] += 1
+    batch.clear()
+    
+    if deleted_uploads:
+        # Their hashes would otherwise still offer the deleted files as near-duplicates
+        try:
+            ImageUpload.query.filter(ImageUpload.filename.in_(deleted_uploads)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as db_error:
+            print(f"[SWEEPER] Could not delete upload records: {db_error}")
+            db.session.rollback()
+
+
+def sweep_orphaned_media(ttl_hours=None, batch_size=None, dry_run=False):
+    """
+    Delete media files that are not referenced by any Content/Conversation row
+    and are older than the retention TTL. Files are deleted in batches.
+    Must be called inside an app context.
+    
+    Only files present in the local folders are swept; deleting one also deletes
+    its object in the storage backend. With MEDIA_STORAGE_BACKEND=s3, objects that
+    have no local copy on the sweeping instance are not listed; expire those with
+    a bucket lifecycle rule.
+    
+    Returns: dict report per folder
+    """
+    ttl_hours = MEDIA_RETENTION_HOURS if ttl_hours is None else ttl_hours
+    batch_size = batch_size or MEDIA_SWEEP_BATCH_SIZE
+    cutoff = time.time() - ttl_hours * 3600
+    
+    referenced, audio_prefixes = collect_referenced_media()
+    
+    report = {
+        'dry_run': dry_run,
+        'ttl_hours': ttl_hours,
+        'folders': {}
+    }
+    
+    for folder_key in MEDIA_SWEEP_FOLDERS + MEDIA_CACHE_FOLDERS:
+        folder = app.config[folder_key]
+        is_cache = folder_key in MEDIA_CACHE_FOLDERS
+        stats = {'scanned': 0, 'orphaned': 0, 'deleted': 0, 'bytes': 0, 'errors': 0, 'sample': []}
+        report['folders'][folder] = stats
+        
+        batch = []
+        
+        for entry in iter_media_files(folder):
+            stats['scanned'] += 1
+            
+            name = entry.name
+            if not is_cache and (name in referenced or name.startswith(audio_prefixes)):
+                continue
+            
+            stat = entry.stat()
+            if stat.st_mtime > cutoff:
+                continue
+            
+            stats['orphaned'] += 1
+            stats['bytes'] += stat.st_size
+            if len(stats['sample']) < 20:
+                stats['sample'].append(name)
+            
+            if dry_run:
+                continue
+            
+            batch.append((folder, name, entry.path if is_cache else None))
+            if len(batch) >= batch_size:
+                _delete_media_batch(batch, stats)
+        
+        if not dry_run:
+            _delete_media_batch(batch, stats)
+    
+    return report
+
+
+def _run_scheduled_sweep():
+    """One sweep round; a lock file makes sure only one worker sweeps at a time"""
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    
+    with open(os.path.join(app.instance_path, 'media_sweeper.lock'), 'w') as lock_file:
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                print("[SWEEPER] Another worker is sweeping, skipping this round")
+                return
+        
+        with app.app_context():
+            report = sweep_orphaned_media()
+            db.session.remove()
+        
+        for folder, stats in report['folders'].items():
+            print(f"[SWEEPER] {folder}: deleted {stats['deleted']}/{stats['orphaned']} orphaned files ({stats['bytes']} bytes)")
+
+
+def start_media_sweeper():
+    """
+    Start the background sweeper thread for this process.
+    Called lazily from a request hook so the thread is created after gunicorn forks.
+    """
+    global _media_sweeper_pid
+    
+    if MEDIA_SWEEP_INTERVAL_HOURS <= 0 or _media_sweeper_pid == os.getpid():
+        return
+    _media_sweeper_pid = os.getpid()
+    os.makedirs(app.instance_path, exist_ok=True)
+    
+    def sweeper_loop():
+        while True:
+            time.sleep(MEDIA_SWEEP_INTERVAL_HOURS * 3600)
+            try:
+                _run_scheduled_sweep()
+            except Exception as e:
+                print(f"[SWEEPER] Error: {str(e)}")
+                traceback.print_exc()
+    
+    threading.Thread(target=sweeper_loop, name='media-sweeper', daemon=True).start()
+    print(f"[SWEEPER] Background sweeper started (every {MEDIA_SWEEP_INTERVAL_HOURS}h, TTL {MEDIA_RETENTION_HOURS}h)")
+
+
+@app.before_request
+def ensure_media_sweeper():
+    start_media_sweeper()
+
+
+@app.before_request
+def warm_provider_clients():
+    # From a request hook, not at import, so connections and image workers are started
+    # after gunicorn forks (and never by CLI commands)
+    image_pool.warm_in_background()
+    if GRPC_WARMUP and GOOGLE_SPEECH_AVAILABLE:
+        google_clients.warm_in_background(GRPC_WARMUP_TIMEOUT)
+    if LLM_WARMUP and os.environ.get('GROQ_API_KEY'):
+        llm_clients.warm_in_background([('groq', GROQ_MODEL)], LLM_WARMUP_TIMEOUT)
+
+
+@app.cli.command('sweep-media')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted')
+@click.option('--ttl-hours', type=float, default=None, help='Override MEDIA_RETENTION_HOURS')
+@click.option('--batch-size', type=int, default=None, help='Override MEDIA_SWEEP_BATCH_SIZE')
+def sweep_media_command(dry_run, ttl_hours, batch_size):
+    """Delete unreferenced generated media older than the retention TTL"""
+    report = sweep_orphaned_media(ttl_hours=ttl_hours, batch_size=batch_size, dry_run=dry_run)
+    
+    print("=" * 60)
+    print(f"MEDIA SWEEP {'(DRY RUN) ' if dry_run else ''}- TTL {report['ttl_hours']}h")
+    for folder, stats in report['folders'].items():
+        action = 'would delete' if dry_run else 'deleted'
+        count = stats['orphaned'] if dry_run else stats['deleted']
+        print(f"  {folder}: scanned {stats['scanned']}, {action} {count} ({stats['bytes']} bytes)")
+        for name in stats['sample']:
+            print(f"    - {name}")
+    print("=" * 60)
+
+
+@app.cli.command('shard-media')
+@click.option('--dry-run', is_flag=True, help='Only report what would be moved')
+def shard_media_command(dry_run):
+    """Move media files from the old flat folders into the sharded layout"""
+    print("=" * 60)
+    print(f"MEDIA SHARD MIGRATION {'(DRY RUN)' if dry_run else ''}")
+    for folder_key in MEDIA_SWEEP_FOLDERS:
+        folder = app.config[folder_key]
+        stats = migrate_flat_folder(folder, dry_run=dry_run)
+        print(f"  {folder}: moved {stats['moved']}, skipped {stats['skipped']}, errors {stats['errors']}")
+    print("=" * 60)
+
+
+# ==================== ROUTES (Modified) ====================
+
+@app.route('/')
+def home():
+    return jsonify({
         'status': 'online',
         'service': 'Kalakar AI Backend',
         'version': '2.0.0',
@@ -2127,13 +3521,40 @@ def health_check():
         'status': 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
         'services': {
-            'speech_to_text': 'active' if speech_client else 'inactive',
-            'text_to_speech': 'active' if tts_client else 'inactive',
+            'speech_to_text': 'active' if GOOGLE_SPEECH_AVAILABLE else 'inactive',
+            'text_to_speech': 'active' if GOOGLE_SPEECH_AVAILABLE else 'inactive',
             'translation': 'active' if TRANSLATION_API_KEY else 'inactive',
             'groq_content': 'active', # Updated
             'clipdrop_enhancement': 'active' if CLIPDROP_AVAILABLE else 'not_configured',
-            'database': 'postgresql' if database_url else 'sqlite'
-        }
+            'database': 'postgresql' if database_url else 'sqlite',
+            'media_storage': media_storage.health(),
+            'image_workers': image_pool.stats(),
+            'cutout_prefetch': cutout_prefetch_stats(),
+            'clipdrop_rate_limit': clipdrop_rate_limiter.stats(),
+            'circuit_breakers': circuit_breakers.stats(),
+            'provider_io': io_loop.stats(),
+            'google_grpc': google_clients.stats(),
+            'llm': llm_clients.stats()
+        },
+        'startup': startup.stats()
+    }), 200
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Runtime counters of this worker process: provider bulkheads, breakers, pools"""
+    return jsonify({
+        'pid': os.getpid(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'bulkheads': {provider: bulkhead.stats() for provider, bulkhead in provider_bulkheads.items()},
+        'circuit_breakers': circuit_breakers.stats(),
+        'clipdrop_rate_limit': clipdrop_rate_limiter.stats(),
+        'retries': {provider: policy.stats() for provider, policy in PROVIDER_RETRY.items()},
+        'image_workers': image_pool.stats(),
+        'cutout_prefetch': cutout_prefetch_stats(),
+        'provider_io': io_loop.stats(),
+        'google_grpc': google_clients.stats(),
+        'llm': llm_clients.stats()
     }), 200
 
 
@@ -2272,30 +3693,25 @@ def respond_to_conversation():
         if not conversation:
             return jsonify({'error': 'Conversation not found'}), 404
         
-        if not speech_client:
+        if not GOOGLE_SPEECH_AVAILABLE:
             return jsonify({'error': 'Speech service not available'}), 503
         
         audio_file = request.files['audio']
         audio_content = audio_file.read()
-        audio = speech.RecognitionAudio(content=audio_content)
         
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
-            language_code='pa-IN',
-            enable_automatic_punctuation=True,
-        )
+        current_step_index = next((i for i, s in enumerate(CONVERSATION_FLOW) if s['step'] == conversation.current_step), 0)
+        current_step = CONVERSATION_FLOW[current_step_index]
+        next_step_index = current_step_index + 1
+        next_step = CONVERSATION_FLOW[next_step_index] if next_step_index < len(CONVERSATION_FLOW) else None
         
-        response = speech_client.recognize(config=config, audio=audio)
-        punjabi_text = " ".join([r.alternatives[0].transcript for r in response.results]).strip()
+        # Speech-to-text, then translation and the next question's audio concurrently
+        punjabi_text, english_text, audio_file = io_loop.run(
+            process_spoken_answer(audio_content, session_id, next_step)
+        )
         
         if not punjabi_text:
             return jsonify({'error': 'Could not understand audio'}), 400
         
-        english_text = translate_to_english(punjabi_text)
-        
-        current_step_index = next((i for i, s in enumerate(CONVERSATION_FLOW) if s['step'] == conversation.current_step), 0)
-        current_step = CONVERSATION_FLOW[current_step_index]
-        
         collected_info = json.loads(conversation.collected_info)
         collected_info[current_step['field']] = {'punjabi': punjabi_text, 'english': english_text}
         
@@ -2309,9 +3725,7 @@ def respond_to_conversation():
         conversation.collected_info = json.dumps(collected_info)
         conversation.conversation_data = json.dumps(conv_data)
         
-        next_step_index = current_step_index + 1
-        
-        if next_step_index >= len(CONVERSATION_FLOW):
+        if not next_step:
             conversation.is_complete = True
             conversation.current_step = "completed"
             db.session.commit()
@@ -2322,12 +3736,10 @@ def respond_to_conversation():
                 'progress': 100
             }), 200
         
-        next_step = CONVERSATION_FLOW[next_step_index]
         conversation.current_step = next_step['step']
         db.session.commit()
         
         audio_filename = f"{session_id}_{next_step['step']}.mp3"
-        audio_file = text_to_speech_punjabi(next_step['question_pa'], audio_filename)
         
         progress = int((next_step_index / len(CONVERSATION_FLOW)) * 100)
         
@@ -2341,6 +3753,9 @@ def respond_to_conversation():
             'audio_url': f'{request.host_url.rstrip("/")}/audio/{audio_filename}' if audio_file else None,
             'progress': progress
         }), 200
+    except ResilienceError:
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
         traceback.print_exc()
@@ -2374,6 +3789,7 @@ def enhance_product_image():
                 'details': 'CLIPDROP_API_KEY not configured',
                 'success': False
             }), 503
+        provider_breaker('clipdrop').check()
         
         user = get_current_user()
         if not user:
@@ -2394,18 +3810,18 @@ def enhance_product_image():
         
         # 1. Extract filename and construct local path
         image_filename = os.path.basename(image_url)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
+        filepath = media_storage.fetch(app.config['UPLOAD_FOLDER'], image_filename)
         
-        print(f"📁 Looking for local file: {filepath}")
+        print(f"📁 Looking for local file: {image_filename}")
         
-        if not os.path.exists(filepath):
-            print(f"❌ File not found: {filepath}")
+        if not filepath:
+            print(f"❌ File not found: {image_filename}")
             # The previous attempt to download the file timed out. Since the file was originally uploaded
             # via `/api/upload_image`, it should be in the `uploads` directory. If it's missing,
             # we must fail, as the external download is unreliable (as demonstrated by your logs).
             return jsonify({
                 'error': 'Image file not found on server',
-                'details': f'File {image_filename} does not exist in uploads. Network access to self failed previously.',
+                'details': f'File {image_filename} does not exist in uploads or media storage.',
                 'success': False
             }), 404
         
@@ -2413,20 +3829,21 @@ def enhance_product_image():
         file_size = os.path.getsize(filepath)
         print(f"✅ File found: {filepath} ({file_size} bytes)")
         
+        # Quality gate: don't spend Clipdrop credits on photos that can't make a usable listing
+        upload = get_or_create_image_upload(image_filename, filepath, user.id)
+        quality = upload.to_dict()['quality']
+        if quality and not quality['passed'] and not data.get('force'):
+            print(f"❌ Quality gate rejected image: {quality['issues']}")
+            return jsonify({
+                'error': 'Image quality too low for enhancement',
+                'details': '; '.join(quality['issues']),
+                'quality': quality,
+                'hint': 'Retake the photo, or send force=true to enhance anyway',
+                'success': False
+            }), 422
+        
         # Get product info
-        product_info = None
-        if session_id:
-            conversation = Conversation.query.filter_by(
-                session_id=session_id,
-                user_id=user.id
-            ).first()
-            
-            if conversation and conversation.is_complete:
-                try:
-                    product_info = json.loads(conversation.collected_info)
-                    print(f"✅ Product info loaded from conversation")
-                except:
-                    print(f"⚠️ Could not parse product info")
+        product_info = get_conversation_product_info(user.id, session_id)
         
         # Step 2: Enhance the image
         print(f"🎨 Starting enhancement (variants={create_variants}, num={num_variants})")
@@ -2435,10 +3852,11 @@ def enhance_product_image():
             enhanced_images = create_multiple_background_variants(
                 filepath,
                 product_info,
-                num_variants
+                num_variants,
+                content_hash=upload.content_hash
             )
         else:
-            single_result = enhance_image_with_clipdrop(filepath, product_info)
+            single_result = enhance_image_with_clipdrop(filepath, product_info, content_hash=upload.content_hash)
             enhanced_images = [single_result] if single_result else None
         
         if not enhanced_images:
@@ -2449,26 +3867,7 @@ def enhance_product_image():
             }), 500
         
         # Save to database
-        try:
-            content = Content.query.filter_by(user_id=user.id).order_by(Content.created_at.desc()).first()
-            
-            if content:
-                content.enhanced_images = json.dumps(enhanced_images)
-                db.session.commit()
-                print("✅ Updated existing content record")
-            else:
-                content = Content(
-                    user_id=user.id,
-                    image_url=image_url,
-                    enhanced_images=json.dumps(enhanced_images)
-                )
-                db.session.add(content)
-                db.session.commit()
-                print("✅ Created new content record")
-            
-        except Exception as db_error:
-            print(f"[ENHANCE] DB error: {db_error}")
-            db.session.rollback()
+        save_enhanced_images(user.id, image_url, enhanced_images)
         
         print("=" * 60)
         print(f"✅ ENHANCEMENT COMPLETE - {len(enhanced_images)} variants created")
@@ -2480,9 +3879,12 @@ def enhance_product_image():
             'enhanced_images': enhanced_images,
             'count': len(enhanced_images),
             'method': 'clipdrop',
+            'quality_warnings': quality['warnings'] + quality['issues'] if quality else [],
             'message': f'Successfully enhanced image with {len(enhanced_images)} variant(s)'
         }), 200
         
+    except ResilienceError:
+        raise
     except Exception as e:
         print(f"[ENHANCE] Unexpected error: {e}")
         traceback.print_exc()
@@ -2493,42 +3895,680 @@ def enhance_product_image():
         }), 500
 
 
+@app.route('/api/enhance-images/batch', methods=['POST', 'OPTIONS'])
+def enhance_product_images_batch():
+    """
+    ROUTE ENDPOINT - Enhance several photos of one product in a single request.
+    Body: image_urls (list), session_id, num_variants, force
+    
+    Photos are enhanced concurrently (ENHANCE_BATCH_CONCURRENCY, all Clipdrop calls
+    share the rate limiter). The response is newline-delimited JSON: an "image"
+    event per photo as soon as it finishes, then a "done" event once the whole
+    set is stored on one Content record.
+    """
+    if request.method == 'OPTIONS':
+        response = jsonify({'status': 'ok'})
+        response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
+        response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, Cookie, X-Requested-With')
+        response.headers.add('Access-Control-Allow-Credentials', 'true')
+        return response, 200
+    
+    if not CLIPDROP_AVAILABLE:
+        return jsonify({
+            'error': 'Image enhancement not available',
+            'details': 'CLIPDROP_API_KEY not configured',
+            'success': False
+        }), 503
+    provider_breaker('clipdrop').check()
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': 'Not authenticated', 'success': False}), 401
+    
+    data = request.get_json(silent=True) or {}
+    image_urls = data.get('image_urls')
+    if not isinstance(image_urls, list) or not image_urls:
+        return jsonify({'error': 'image_urls (non-empty list) required', 'success': False}), 400
+    if len(image_urls) > ENHANCE_BATCH_MAX_IMAGES:
+        return jsonify({'error': f'At most {ENHANCE_BATCH_MAX_IMAGES} images per batch', 'success': False}), 400
+    
+    try:
+        num_variants = max(1, min(int(data.get('num_variants', 1)), 3))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'num_variants must be a number between 1 and 3', 'success': False}), 400
+    force = bool(data.get('force'))
+    product_info = get_conversation_product_info(user.id, data.get('session_id'))
+    user_id = user.id
+    
+    print(f"🖼️ BATCH ENHANCE: {len(image_urls)} images, {num_variants} variant(s) each")
+    
+    # Resolve and quality-gate every photo first; DB work stays in the request thread
+    jobs = []
+    rejected = []
+    for index, image_url in enumerate(image_urls):
+        image_filename = os.path.basename(str(image_url or ''))
+        filepath = media_storage.fetch(app.config['UPLOAD_FOLDER'], image_filename) if image_filename else None
+        if not filepath:
+            rejected.append({'index': index, 'image_url': image_url, 'error': 'Image file not found on server'})
+            continue
+        
+        upload = get_or_create_image_upload(image_filename, filepath, user_id)
+        quality = upload.to_dict()['quality']
+        if quality and not quality['passed'] and not force:
+            rejected.append({
+                'index': index,
+                'image_url': image_url,
+                'error': 'Image quality too low for enhancement',
+                'details': '; '.join(quality['issues']),
+                'quality': quality
+            })
+            continue
+        jobs.append((index, image_url, filepath, upload.content_hash, quality))
+    
+    def enhance_one(filepath, content_hash):
+        if num_variants > 1:
+            return create_multiple_background_variants(filepath, product_info, num_variants, content_hash=content_hash)
+        result = enhance_image_with_clipdrop(filepath, product_info, content_hash=content_hash)
+        return [result] if result else None
+    
+    def event(payload):
+        return json.dumps(payload) + '\n'
+    
+    def generate():
+        yield event({'event': 'started', 'total': len(image_urls), 'accepted': len(jobs)})
+        for rejection in rejected:
+            yield event(dict(rejection, event='image', success=False))
+        
+        finished = []
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(ENHANCE_BATCH_CONCURRENCY, len(jobs))),
+            thread_name_prefix='enhance-batch'
+        )
+        try:
+            # Workers run in a copy of the request context, so they share its deadline
+            futures = {
+                executor.submit(contextvars.copy_context().run, enhance_one, filepath, content_hash): (index, image_url, quality)
+                for index, image_url, filepath, content_hash, quality in jobs
+            }
+            for future in as_completed(futures):
+                index, image_url, quality = futures[future]
+                try:
+                    enhanced_images = future.result()
+                except Exception as e:
+                    print(f"[ENHANCE] Batch image {index} failed: {e}")
+                    enhanced_images = None
+                
+                if not enhanced_images:
+                    yield event({
+                        'event': 'image', 'index': index, 'image_url': image_url, 'success': False,
+                        'error': 'Image enhancement failed'
+                    })
+                    continue
+                
+                for entry in enhanced_images:
+                    entry['source_image_url'] = image_url
+                finished.append((index, enhanced_images))
+                yield event({
+                    'event': 'image', 'index': index, 'image_url': image_url, 'success': True,
+                    'enhanced_images': enhanced_images,
+                    'quality_warnings': quality['warnings'] + quality['issues'] if quality else []
+                })
+        finally:
+            # Client went away or we are done: don't start photos nobody will see
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        # The whole set, in request order, goes on one Content record
+        finished.sort(key=lambda item: item[0])
+        all_images = [entry for _, entries in finished for entry in entries]
+        content = save_enhanced_images(user_id, finished[0][1][0]['source_image_url'], all_images) if finished else None
+        
+        print(f"✅ BATCH ENHANCE COMPLETE - {len(finished)}/{len(image_urls)} images")
+        yield event({
+            'event': 'done',
+            'success': bool(finished),
+            'content_id': content.id if content else None,
+            'succeeded': len(finished),
+            'failed': len(image_urls) - len(finished),
+            'count': len(all_images)
+        })
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 # ==================== IMAGE & CONTENT GENERATION ====================
 
+# Bump when the generation prompts change: cached posts of older templates are ignored
+PROMPT_TEMPLATE_VERSION = 1
+
+# Product details used in the prompts (and in the cache fingerprint)
+PRODUCT_DETAIL_FIELDS = [
+    ("craft_type", "Craft Type"),
+    ("product_name", "Product Name"),
+    ("materials", "Materials"),
+    ("process", "Process"),
+    ("time_taken", "Time Spent (Hours)"),
+    ("price", "Selling Price (INR)"),
+    ("special_features", "Special Features")
+]
+
+GENERATION_SYSTEM_PROMPT = "You are an expert social media content creator specializing in handcrafted artisan products. Create engaging, authentic posts that highlight craftsmanship, materials, time, and price. Ensure the tone and emoji usage strictly match the platform's requirements. For e-commerce (Amazon/Flipkart), focus on structured features."
+
+
+def product_fingerprint(collected_info):
+    """Hash of the product details, ignoring case and whitespace differences"""
+    details = {}
+    for field_key, _ in PRODUCT_DETAIL_FIELDS:
+        value = collected_info.get(field_key, {}).get('english') or ''
+        details[field_key] = ' '.join(str(value).split()).casefold()
+    return hashlib.sha256(json.dumps(details, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def generation_cache_key(fingerprint, platform_id, image_attributes):
+    """GenerationCache key: product, platform, model, prompt template version and photo attributes"""
+    image_hash = hashlib.sha256(json.dumps(image_attributes, sort_keys=True).encode('utf-8')).hexdigest() if image_attributes else 'none'
+    parts = [fingerprint, platform_id, GROQ_MODEL, str(PROMPT_TEMPLATE_VERSION), image_hash]
+    return hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+
+
+def load_cached_generations(cache_keys):
+    """Cached posts for {platform_id: cache_key}; returns {platform_id: content} of the hits"""
+    platforms_by_key = {key: platform_id for platform_id, key in cache_keys.items()}
+    try:
+        rows = GenerationCache.query.filter(GenerationCache.cache_key.in_(list(platforms_by_key))).all()
+    except Exception as db_error:
+        print(f"[GEN CACHE] DB error: {db_error}")
+        db.session.rollback()
+        return {}
+    return {platforms_by_key[row.cache_key]: row.content for row in rows}
+
+
+def store_generations(posts, cache_keys):
+    """Store freshly generated posts {platform_id: content}; replaces entries that were regenerated"""
+    if not posts:
+        return
+    try:
+        existing = {
+            row.cache_key: row
+            for row in GenerationCache.query.filter(GenerationCache.cache_key.in_([cache_keys[p] for p in posts])).all()
+        }
+        for platform_id, content in posts.items():
+            row = existing.get(cache_keys[platform_id])
+            if row:
+                row.content = content
+                row.created_at = datetime.utcnow()
+            else:
+                db.session.add(GenerationCache(
+                    cache_key=cache_keys[platform_id], platform=platform_id, model=GROQ_MODEL, content=content
+                ))
+        db.session.commit()
+    except Exception as db_error:
+        # Another worker may have stored the same key concurrently
+        print(f"[GEN CACHE] DB error: {db_error}")
+        db.session.rollback()
+
+
+def build_platform_prompt(platform, product_text, image_text):
+    """Prompt for one platform's post (per-platform mode, and fallback of the combined mode)"""
+    platform_id = platform['id']
+    prompt = f"""You are an expert content creator helping an artisan (Kalakaar) generate engaging social media posts.
+
+Create a compelling and authentic {platform['name']} post for the following handcrafted product.
+Use the product photo details (if provided) and weave them with the textual details below.
+
+--- PRODUCT DETAILS ---
+{product_text}
+--- END DETAILS ---
+{image_text}
+Requirements:
+- Platform: {platform['name']} ({platform['description']})
+- Character limit: {platform['char_limit']}. {platform['best_for']}
+- Style: Generate an authentic, heartfelt, and personal tone.
+- Include relevant emojis and hashtags based on the product, materials, and craft. **Crucial: DO NOT use emojis for LinkedIn.**
+- The post must be engaging and encourage comments/shares.
+
+Generate ONLY the post content, nothing else."""
+
+    # Adjust prompt for strict formats
+    if platform_id == 'twitter':
+        prompt = prompt.replace(f"Style: Generate an authentic, heartfelt, and personal tone.", f"Style: {platform['best_for']}")
+    elif platform_id == 'linkedin':
+        prompt = prompt.replace(f"Style: Generate an authentic, heartfelt, and personal tone.", f"Style: {platform['best_for']}")
+        prompt = prompt.replace("**Crucial: DO NOT use emojis for LinkedIn.**", "") # Remove redundant instruction
+    return prompt
+
+
+def platform_posts_schema(platforms):
+    """JSON schema of a combined generation: {platform_id: post text within its char_limit}"""
+    return {
+        'type': 'object',
+        'properties': {
+            platform['id']: {'type': 'string', 'minLength': 1, 'maxLength': platform['char_limit']}
+            for platform in platforms
+        },
+        'required': [platform['id'] for platform in platforms]
+    }
+
+
+def validate_platform_posts(data, schema):
+    """
+    Check a combined generation against platform_posts_schema().
+    
+    Returns: (valid posts {platform_id: text}, problems {platform_id: reason})
+    """
+    if not isinstance(data, dict):
+        return {}, {platform_id: 'response is not a JSON object' for platform_id in schema['required']}
+    
+    valid, problems = {}, {}
+    for platform_id in schema['required']:
+        rules = schema['properties'][platform_id]
+        value = data.get(platform_id)
+        text = value.strip() if isinstance(value, str) else ''
+        if len(text) < rules['minLength']:
+            problems[platform_id] = 'missing or empty'
+        elif len(text) > rules['maxLength']:
+            problems[platform_id] = f"{len(text)} characters, limit {rules['maxLength']}"
+        else:
+            valid[platform_id] = text
+    return valid, problems
+
+
+def build_combined_prompt(platforms, product_text, image_text, schema):
+    """One prompt for every platform: the product details are sent once"""
+    platform_lines = "\n".join(
+        f"- {p['id']}: {p['name']} ({p['description']}). Character limit: {p['char_limit']}. {p['best_for']}"
+        for p in platforms
+    )
+    return f"""You are an expert content creator helping an artisan (Kalakaar) generate engaging social media posts.
+
+Create a compelling and authentic post for EACH platform listed below for the following handcrafted product.
+Use the product photo details (if provided) and weave them with the textual details below.
+
+--- PRODUCT DETAILS ---
+{product_text}
+--- END DETAILS ---
+{image_text}
+Platforms:
+{platform_lines}
+
+Requirements:
+- Every post must stay within its platform's character limit and follow its platform notes.
+- Style: Generate an authentic, heartfelt, and personal tone, unless the platform notes ask for another style.
+- Include relevant emojis and hashtags based on the product, materials, and craft. **Crucial: DO NOT use emojis for LinkedIn.**
+- Each post must be engaging and encourage comments/shares.
+
+Respond with ONLY a JSON object matching this JSON schema (one key per platform id, the post text as value):
+{json.dumps(schema)}"""
+
+
+async def generate_platform_posts_combined(platforms, product_text, image_text):
+    """
+    Every platform's post from a single JSON-mode Groq call. Platforms whose post is
+    missing or over its char_limit fall back to their own per-platform call.
+    
+    Returns: ({platform_id: text or raised exception}, generation info)
+    """
+    schema = platform_posts_schema(platforms)
+    try:
+        response = await llm_chat(
+            'groq', GROQ_MODEL,
+            messages=[
+                {"role": "system", "content": GENERATION_SYSTEM_PROMPT},
+                {"role": "user", "content": build_combined_prompt(platforms, product_text, image_text, schema)}
+            ],
+            max_tokens=min(GENERATION_COMBINED_MAX_TOKENS, 1024 * len(platforms)),
+            temperature=0.7,
+            top_p=1,
+            response_format={"type": "json_object"},
+            timeout=60
+        )
+        valid, problems = validate_platform_posts(json.loads(response.choices[0].message.content), schema)
+    except ResilienceError:
+        raise
+    except Exception as e:
+        print(f"[GENERATE] Combined generation failed, falling back to per-platform calls: {e}")
+        valid, problems = {}, {platform['id']: 'combined call failed' for platform in platforms}
+    
+    for platform_id, reason in problems.items():
+        print(f"[GENERATE] {platform_id}: invalid combined output ({reason}), regenerating separately")
+    
+    fallback = {
+        platform['id']: build_platform_prompt(platform, product_text, image_text)
+        for platform in platforms if platform['id'] in problems
+    }
+    results = dict(valid)
+    if fallback:
+        results.update(zip(fallback, await generate_platform_posts(fallback)))
+    return results, {'mode': 'combined', 'llm_calls': 1 + len(fallback), 'fallback_platforms': list(fallback)}
+
+
+def platform_post_messages(prompt):
+    return [
+        {
+            "role": "system",
+            "content": GENERATION_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+async def generate_platform_post(prompt):
+    """One platform's post from Groq (runs on the provider I/O loop)"""
+    response = await llm_chat(
+        'groq', GROQ_MODEL,
+        messages=platform_post_messages(prompt),
+        max_tokens=1024,
+        temperature=0.7,
+        top_p=1,
+        timeout=60
+    )
+    return response.choices[0].message.content
+
+
+async def generate_platform_posts(prompts):
+    """
+    Generate every platform's post concurrently.
+    
+    Returns: list with the text or the raised exception per platform, in prompts order
+    """
+    return await asyncio.gather(
+        *(generate_platform_post(prompt) for prompt in prompts.values()),
+        return_exceptions=True
+    )
+
+
+async def stream_platform_post(platform_id, prompt, emit):
+    """One platform's post streamed from Groq: emits a token event per chunk, returns the full text"""
+    started = time.monotonic()
+    parts = []
+    try:
+        # The Groq slot and breaker attempt are held until the last token is read
+        async with acall_provider_stream(
+            'groq', llm_clients.client('groq', GROQ_MODEL).chat.completions.create,
+            model=GROQ_MODEL,
+            messages=platform_post_messages(prompt),
+            max_tokens=1024,
+            temperature=0.7,
+            top_p=1,
+            stream=True,
+            timeout=60,
+            idempotent=True
+        ) as stream:
+            async for chunk in stream:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    parts.append(text)
+                    emit('token', {'platform': platform_id, 'text': text})
+    except BaseException:
+        llm_clients.record('groq', GROQ_MODEL, time.monotonic() - started, False)
+        raise
+    # Groq streams one token per chunk
+    llm_clients.record('groq', GROQ_MODEL, time.monotonic() - started, True, len(parts))
+    return ''.join(parts)
+
+
+async def stream_platform_posts(platforms, product_text, image_text, emit):
+    """
+    Stream every platform's post concurrently (one Groq call each).
+    Progress is reported through emit(event, payload); emit(None, None) marks the end.
+    """
+    async def stream_one(platform):
+        try:
+            text = await stream_platform_post(platform['id'], build_platform_prompt(platform, product_text, image_text), emit)
+            emit('platform_complete', {'platform': platform['id'], 'content': text.strip(), 'cached': False})
+        except Exception as e:
+            print(f"[GENERATE] Streaming {platform['id']} failed: {e}")
+            emit('platform_error', {
+                'platform': platform['id'],
+                'error': str(e),
+                'retry_after': getattr(e, 'retry_after', None)
+            })
+    
+    try:
+        await asyncio.gather(*(stream_one(platform) for platform in platforms))
+    finally:
+        emit(None, None)
+
+
+def sse_event(event, payload):
+    """One Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
 @app.route('/api/upload_image', methods=['POST'])
 def upload_image():
     try:
         file = request.files['image']
         timestamp = int(time.time())
         filename = f"{timestamp}_{secure_filename(file.filename)}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        filepath = ensure_media_path(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
+        # Reject non-images and decompression bombs before anything tries to decode them
+        try:
+            read_image_info(filepath)
+        except ImageTooLargeError as e:
+            os.remove(filepath)
+            return jsonify({'error': 'Image too large', 'details': str(e)}), 413
+        except UnidentifiedImageError:
+            os.remove(filepath)
+            return jsonify({'error': 'Invalid image', 'details': 'The uploaded file is not a supported image'}), 400
+        
+        # Other instances fetch uploads from the storage backend: don't hand out a URL only this one can serve
+        if not media_storage.put(app.config['UPLOAD_FOLDER'], filename, filepath):
+            os.remove(filepath)
+            return jsonify({'error': 'Could not store image', 'details': 'Media storage is unavailable, please try again'}), 503
+        
+        # Score the photo now so enhancement can be gated before any paid call
+        user = get_current_user()
+        upload = get_or_create_image_upload(filename, filepath, user.id if user else None)
+        
+        # Most uploads get enhanced: start the cut-out now, skipping photos the gate would reject
+        quality = upload.to_dict()['quality']
+        if user and (quality is None or quality['passed']):
+            prefetch = schedule_cutout_prefetch(user.id, filepath, upload.content_hash)
+            print(f"[CUTOUT] Prefetch for {filename}: {prefetch}")
+        
         base_url = os.getenv('BASE_URL', 'http://127.0.0.1:5001')
         image_url = f'{base_url}/uploads/{filename}'
         
-        return jsonify({'message': 'Image uploaded!', 'image_url': image_url}), 200
+        # Flag re-uploads of the same product and offer the earlier results
+        near_duplicates = []
+        if user and upload.phash:
+            for duplicate, distance in find_near_duplicate_uploads(user.id, upload.phash, exclude_upload_id=upload.id):
+                earlier_content = Content.query.filter(
+                    Content.user_id == user.id,
+                    or_(
+                        Content.image_filename == duplicate.filename,
+                        # Rows from before image_filename existed
+                        and_(
+                            Content.image_filename.is_(None),
+                            Content.image_url.like(f'%/{escape_like(duplicate.filename)}', escape='\\')
+                        )
+                    )
+                ).order_by(Content.created_at.desc()).limit(3).all()
+                near_duplicates.append({
+                    'image_url': f'{base_url}/uploads/{duplicate.filename}',
+                    'distance': distance,
+                    'uploaded_at': duplicate.created_at.isoformat() if duplicate.created_at else None,
+                    'content': [c.to_dict() for c in earlier_content]
+                })
+            if near_duplicates:
+                print(f"[PHASH] {filename} looks like {len(near_duplicates)} earlier upload(s)")
+        
+        return jsonify({
+            'message': 'Image uploaded!',
+            'image_url': image_url,
+            'quality': quality,
+            'near_duplicates': near_duplicates
+        }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/uploads/<filename>')
 def serve_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_media_file('UPLOAD_FOLDER', filename)
 
 
 @app.route('/enhanced_images/<filename>')
 def serve_enhanced_image(filename):
     """Serve Clipdrop enhanced images"""
     try:
-        return send_from_directory(app.config['ENHANCED_IMAGES_FOLDER'], filename)
+        return send_media_file('ENHANCED_IMAGES_FOLDER', filename)
     except FileNotFoundError:
         return jsonify({'error': 'Image not found'}), 404
 
 
 @app.route('/audio/<filename>')
 def serve_audio(filename):
-    return send_from_directory(app.config['AUDIO_FOLDER'], filename, mimetype='audio/mpeg')
+    return send_media_file('AUDIO_FOLDER', filename, mimetype='audio/mpeg')
+
+
+def prepare_generation(data):
+    """
+    Everything a generation needs from a request body: the completed conversation's
+    product details, the photo description, the platforms and their cached posts.
+    
+    Returns: (context dict, None) or (None, error response)
+    """
+    session_id = data.get('session_id')
+    image_url = data.get('image_url')
+    selected_platforms = data.get('platforms', ['instagram', 'facebook'])
+    generation_mode = data.get('mode') or GENERATION_MODE
+    regenerate = data.get('regenerate', False)
+    # JSON true, or 'true' as in the GET form of the streaming endpoint ("false" is a truthy string)
+    regenerate = regenerate is True or (isinstance(regenerate, str) and regenerate.lower() == 'true')
+    
+    print(f"🔑 Session ID: {session_id}")
+    print(f"🖼️ Image URL: {image_url}")
+    print(f"📱 Platforms: {selected_platforms}")
+    
+    if not session_id:
+        print("❌ Missing session_id")
+        return None, (jsonify({'error': 'session_id required'}), 400)
+    
+    if not isinstance(generation_mode, str) or generation_mode.lower() not in GENERATION_MODES:
+        print(f"❌ Unknown generation mode: {generation_mode}")
+        return None, (jsonify({
+            'error': 'Invalid mode',
+            'details': f"mode must be one of: {', '.join(GENERATION_MODES)}"
+        }), 400)
+    generation_mode = generation_mode.lower()
+    
+    user = get_current_user()
+    if not user:
+        print("❌ User not authenticated")
+        return None, (jsonify({'error': 'Not authenticated'}), 401)
+    
+    print(f"👤 User ID: {user.id}")
+    
+    conversation = Conversation.query.filter_by(session_id=session_id, user_id=user.id).first()
+    
+    if not conversation:
+        print("❌ Conversation not found")
+        return None, (jsonify({'error': 'Conversation not found'}), 404)
+    
+    if not conversation.is_complete:
+        print(f"❌ Conversation not complete. Current step: {conversation.current_step}")
+        return None, (jsonify({
+            'error': 'Conversation must be completed first',
+            'current_step': conversation.current_step
+        }), 400)
+    
+    print("✅ Conversation found and complete")
+    
+    # Parse collected info
+    try:
+        collected_info = json.loads(conversation.collected_info)
+        print(f"✅ Collected Info: {collected_info}")
+    except json.JSONDecodeError as e:
+        print(f"❌ JSON Decode Error: {str(e)}")
+        return None, (jsonify({
+            'error': 'Invalid conversation data',
+            'details': str(e)
+        }), 500)
+    
+    # Build product details
+    
+    product_details_list = []
+    
+    for field_key, field_title in PRODUCT_DETAIL_FIELDS:
+        info_entry = collected_info.get(field_key, {})
+        english_value = info_entry.get('english', 'Not provided')
+        product_details_list.append(f"**{field_title}**: {english_value}")
+    
+    product_text = "\n".join(product_details_list)
+    print(f"📄 Product Text:\n{product_text}")
+    
+    # Visual grounding: the Groq prompt is text-only, so we describe the photo
+    # with cached attributes (palette, size, brightness) instead of decoding it here
+    image_attributes = None
+    if image_url:
+        try:
+            print(f"🖼️ Loading image attributes for: {image_url}")
+            
+            # FIX: Try loading from local path first (to avoid internal Render network latency)
+            image_filename = os.path.basename(image_url)
+            local_path = media_storage.fetch(app.config['UPLOAD_FOLDER'], image_filename)
+            
+            if local_path:
+                upload = get_or_create_image_upload(image_filename, local_path, user.id)
+                image_attributes = get_image_attributes(upload.content_hash, local_path)
+                print("✅ Image attributes loaded")
+            else:
+                # Fallback to external download (slower/flakier)
+                print(f"⚠️ Image not found locally, falling back to external fetch...")
+                with call_provider('image_fetch', requests.get, image_url, stream=True, timeout=10) as image_response:
+                    if image_response.status_code == 200:
+                        with spool_response(image_response, MAX_FILE_SIZE) as image_file:
+                            image_attributes = extract_image_attributes(image_file)
+                        print("✅ Image attributes computed from URL")
+                    else:
+                        print(f"❌ Failed to fetch image: {image_response.status_code}")
+        except Exception as e:
+            print(f"⚠️ Error loading image: {str(e)}")
+    
+    image_text = ""
+    if image_attributes:
+        image_text = f"\n--- PRODUCT PHOTO ---\n{describe_image_attributes(image_attributes)}\n--- END PHOTO ---\n"
+    
+    platforms = []
+    
+    for platform_id in selected_platforms:
+        platform = next((p for p in PLATFORMS if p['id'] == platform_id), None)
+        if not platform:
+            print(f"⚠️ Platform not found: {platform_id}")
+            continue
+        # A platform listed twice would be generated (and cached) twice
+        if platform in platforms:
+            continue
+        platforms.append(platform)
+    
+    # Posts already generated for this exact product, photo, model and prompt version
+    fingerprint = product_fingerprint(collected_info)
+    cache_keys = {p['id']: generation_cache_key(fingerprint, p['id'], image_attributes) for p in platforms}
+    cached = {} if regenerate else load_cached_generations(cache_keys)
+    if cached:
+        print(f"⚡ Served from cache: {', '.join(cached)}")
+    
+    return {
+        'user': user,
+        'selected_platforms': selected_platforms,
+        'generation_mode': generation_mode,
+        'platforms': platforms,
+        'product_text': product_text,
+        'image_text': image_text,
+        'cache_keys': cache_keys,
+        'cached': cached
+    }, None
 
 
 @app.route('/api/conversation/generate', methods=['POST'])
@@ -2545,177 +4585,47 @@ def generate_from_conversation():
             print("❌ No data received in request")
             return jsonify({'error': 'No data received'}), 400
         
-        session_id = data.get('session_id')
-        image_url = data.get('image_url')
-        selected_platforms = data.get('platforms', ['instagram', 'facebook'])
-        
-        print(f"🔑 Session ID: {session_id}")
-        print(f"🖼️ Image URL: {image_url}")
-        print(f"📱 Platforms: {selected_platforms}")
-        
-        if not session_id:
-            print("❌ Missing session_id")
-            return jsonify({'error': 'session_id required'}), 400
-        
-        user = get_current_user()
-        if not user:
-            print("❌ User not authenticated")
-            return jsonify({'error': 'Not authenticated'}), 401
-        
-        print(f"👤 User ID: {user.id}")
-        
-        conversation = Conversation.query.filter_by(session_id=session_id, user_id=user.id).first()
-        
-        if not conversation:
-            print("❌ Conversation not found")
-            return jsonify({'error': 'Conversation not found'}), 404
-        
-        if not conversation.is_complete:
-            print(f"❌ Conversation not complete. Current step: {conversation.current_step}")
-            return jsonify({
-                'error': 'Conversation must be completed first',
-                'current_step': conversation.current_step
-            }), 400
-        
-        print("✅ Conversation found and complete")
-        
-        # Parse collected info
-        try:
-            collected_info = json.loads(conversation.collected_info)
-            print(f"✅ Collected Info: {collected_info}")
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON Decode Error: {str(e)}")
-            return jsonify({
-                'error': 'Invalid conversation data',
-                'details': str(e)
-            }), 500
-        
-        # Build product details
-        
-        # NEW: Ensure new fields are extracted for the prompt
-        fields_to_extract = [
-            ("craft_type", "Craft Type"),
-            ("product_name", "Product Name"),
-            ("materials", "Materials"),
-            ("process", "Process"),
-            ("time_taken", "Time Spent (Hours)"), # NEW
-            ("price", "Selling Price (INR)"),      # NEW
-            ("special_features", "Special Features")
-        ]
-        
-        product_details_list = []
-        
-        for field_key, field_title in fields_to_extract:
-            info_entry = collected_info.get(field_key, {})
-            english_value = info_entry.get('english', 'Not provided')
-            product_details_list.append(f"**{field_title}**: {english_value}")
-        
-        product_text = "\n".join(product_details_list)
-        print(f"📄 Product Text:\n{product_text}")
-        
-        # Load image if provided
-        image_part = None
-        if image_url:
-            try:
-                print(f"🖼️ Loading image from: {image_url}")
-                
-                # FIX: Try loading from local path first (to avoid internal Render network latency)
-                image_filename = os.path.basename(image_url)
-                local_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                
-                if os.path.exists(local_path):
-                    image_part = Image.open(local_path)
-                    print("✅ Image loaded locally")
-                else:
-                    # Fallback to external download (slower/flakier)
-                    print(f"⚠️ Image not found locally, falling back to external fetch...")
-                    image_response = requests.get(image_url, stream=True, timeout=10)
-                    if image_response.status_code == 200:
-                        image_part = Image.open(io.BytesIO(image_response.content))
-                        print("✅ Image loaded from URL")
-                    else:
-                        print(f"❌ Failed to fetch image: {image_response.status_code}")
-            except Exception as e:
-                print(f"⚠️ Error loading image: {str(e)}")
-        
+        context, error = prepare_generation(data)
+        if error:
+            return error
+        platforms = context['platforms']
+        product_text, image_text = context['product_text'], context['image_text']
+        cached = context['cached']
+        pending = [p for p in platforms if p['id'] not in cached]
         platform_content = {}
         
-        print(f"🎨 Generating content for {len(selected_platforms)} platforms...")
+        results = dict(cached)
+        generation = {'mode': 'cache', 'llm_calls': 0, 'fallback_platforms': []}
+        
+        # --- Groq API Calls on the provider I/O loop ---
+        if context['generation_mode'] == 'combined' and len(pending) > 1:
+            # One JSON call for every platform; invalid platforms are regenerated alone
+            print(f"🚀 Generating content for {len(pending)} platforms in one Groq call...")
+            generated, generation = io_loop.run(generate_platform_posts_combined(pending, product_text, image_text))
+            results.update(generated)
+        elif pending:
+            print(f"🚀 Generating content for {len(pending)} platforms using Groq...")
+            prompts = {p['id']: build_platform_prompt(p, product_text, image_text) for p in pending}
+            results.update(zip(prompts, io_loop.run(generate_platform_posts(prompts))))
+            generation = {'mode': 'per_platform', 'llm_calls': len(prompts), 'fallback_platforms': []}
+        generation['cached_platforms'] = [p['id'] for p in platforms if p['id'] in cached]
+        
+        store_generations(
+            {p['id']: results[p['id']].strip() for p in pending if isinstance(results[p['id']], str)},
+            context['cache_keys']
+        )
         
-        for platform_id in selected_platforms:
-            platform = next((p for p in PLATFORMS if p['id'] == platform_id), None)
-            if not platform:
-                print(f"⚠️ Platform not found: {platform_id}")
-                continue
-            
-            print(f"📝 Generating for {platform['name']}...")
-            
-            prompt = f"""You are an expert content creator helping an artisan (Kalakaar) generate engaging social media posts.
-
-Create a compelling and authentic {platform['name']} post for the following handcrafted product.
-Analyze the visual details from the image (if provided) and weave them with the textual details below.
-
---- PRODUCT DETAILS ---
-{product_text}
---- END DETAILS ---
-
-Requirements:
-- Platform: {platform['name']} ({platform['description']})
-- Character limit: {platform['char_limit']}. {platform['best_for']}
-- Style: Generate an authentic, heartfelt, and personal tone.
-- Include relevant emojis and hashtags based on the product, materials, and craft. **Crucial: DO NOT use emojis for LinkedIn.**
-- The post must be engaging and encourage comments/shares.
-
-Generate ONLY the post content, nothing else."""
-
-            # Adjust prompt for strict formats
-            if platform_id == 'twitter':
-                prompt = prompt.replace(f"Style: Generate an authentic, heartfelt, and personal tone.", f"Style: {platform['best_for']}")
-            elif platform_id == 'linkedin':
-                prompt = prompt.replace(f"Style: Generate an authentic, heartfelt, and personal tone.", f"Style: {platform['best_for']}")
-                prompt = prompt.replace("**Crucial: DO NOT use emojis for LinkedIn.**", "") # Remove redundant instruction
-
-            try:
-                from groq import Groq
-                
-                groq_client = Groq(api_key=os.environ.get('GROQ_API_KEY'))
-                
-                print(f"🚀 Generating content for {platform['name']} using Groq...")
-                
-                # --- Groq API Call ---
-                messages = [
-                    {
-                        "role": "system",
-                        "content": "You are an expert social media content creator specializing in handcrafted artisan products. Create engaging, authentic posts that highlight craftsmanship, materials, time, and price. Ensure the tone and emoji usage strictly match the platform's requirements. For e-commerce (Amazon/Flipkart), focus on structured features."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-
-                response = groq_client.chat.completions.create(
-                    model="llama-3.3-70b-versatile",
-                    messages=messages,
-                    max_tokens=1024,
-                    temperature=0.7,
-                    top_p=1
-                )
-                
-                generated_text = response.choices[0].message.content
-                
-                platform_content[platform_id] = {
-                    'platform': platform['name'],
-                    'content': generated_text.strip(),
-                    'char_limit': platform['char_limit'],
-                    'format_type': platform['best_for']
-                }
-                print(f"✅ Content generated successfully for {platform['name']}")
-                
-            except Exception as e:
-                error_msg = str(e)
+        for platform in platforms:
+            platform_id = platform['id']
+            result = results[platform_id]
+            if isinstance(result, ResilienceError):
+                # Groq is saturated or down: tell the client to come back instead of
+                # returning an error text for every platform
+                raise result
+            if isinstance(result, Exception):
+                error_msg = str(result)
                 print(f"❌ Error generating for {platform['name']}: {error_msg}")
-                traceback.print_exc()
+                traceback.print_exception(result)
                 platform_content[platform_id] = {
                     'platform': platform['name'],
                     'content': f'Error generating content: {error_msg}',
@@ -2723,6 +4633,16 @@ Generate ONLY the post content, nothing else."""
                     'format_type': platform['best_for'],
                     'error': True
                 }
+                continue
+            
+            platform_content[platform_id] = {
+                'platform': platform['name'],
+                'content': result.strip(),
+                'char_limit': platform['char_limit'],
+                'format_type': platform['best_for'],
+                'cached': platform_id in cached
+            }
+            print(f"✅ Content generated successfully for {platform['name']}")
 
         print("=" * 60)
         print("✅ CONTENT GENERATION COMPLETE")
@@ -2731,11 +4651,14 @@ Generate ONLY the post content, nothing else."""
 
         return jsonify({
             'success': True,
-            'platforms': selected_platforms,
+            'platforms': context['selected_platforms'],
             'content': platform_content,
-            'model_used': 'llama-3.3-70b-versatile (Groq)'
+            'model_used': f'{GROQ_MODEL} (Groq)',
+            'generation': generation
         }), 200
 
+    except ResilienceError:
+        raise
     except Exception as e:
         print("=" * 60)
         print("❌ FATAL ERROR IN GENERATE:")
@@ -2748,6 +4671,106 @@ Generate ONLY the post content, nothing else."""
         }), 500
 
 
+@app.route('/api/conversation/generate/stream', methods=['GET', 'POST'])
+def generate_from_conversation_stream():
+    """
+    ROUTE ENDPOINT - generate_from_conversation as a Server-Sent Events stream.
+    Body (POST) or query string (GET, for EventSource): session_id, platforms,
+    image_url, regenerate
+    
+    Each platform's post is streamed from its own Groq call. Events:
+      started            {platforms, cached_platforms, model}
+      token              {platform, text} as completion tokens arrive
+      platform_complete  {platform, content, cached} (cached posts come right away)
+      platform_error     {platform, error, retry_after}
+      done               {succeeded, failed, cached_platforms, elapsed_ms}
+    """
+    print("=" * 60)
+    print("🔥 STREAMING GENERATE REQUEST RECEIVED")
+    print("=" * 60)
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = {
+            'session_id': request.args.get('session_id'),
+            'image_url': request.args.get('image_url'),
+            'regenerate': request.args.get('regenerate', 'false').lower() == 'true'
+        }
+        # platforms=instagram,twitter or repeated platforms=... parameters
+        platform_ids = [p for value in request.args.getlist('platforms') for p in value.split(',') if p]
+        if platform_ids:
+            data['platforms'] = platform_ids
+    
+    context, error = prepare_generation(data)
+    if error:
+        return error
+    platforms, cached = context['platforms'], context['cached']
+    pending = [p for p in platforms if p['id'] not in cached]
+    started = time.time()
+    
+    def generate():
+        yield sse_event('started', {
+            'platforms': [p['id'] for p in platforms],
+            'cached_platforms': [p['id'] for p in platforms if p['id'] in cached],
+            'model': GROQ_MODEL
+        })
+        for platform in platforms:
+            if platform['id'] in cached:
+                yield sse_event('platform_complete', {'platform': platform['id'], 'content': cached[platform['id']], 'cached': True})
+        
+        posts, failed = {}, []
+        future, events = None, None
+        try:
+            if pending:
+                events = queue.Queue()
+                # Runs on the provider I/O loop; events come back through the queue
+                future = io_loop.submit(stream_platform_posts(
+                    pending, context['product_text'], context['image_text'],
+                    lambda event, payload: events.put((event, payload))
+                ))
+                while True:
+                    try:
+                        event, payload = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"
+                        continue
+                    if event is None:
+                        break
+                    if event == 'platform_complete':
+                        posts[payload['platform']] = payload['content']
+                    elif event == 'platform_error':
+                        failed.append(payload['platform'])
+                    yield sse_event(event, payload)
+        finally:
+            # Client went away: stop the Groq streams nobody will read
+            if future is not None and not future.done():
+                future.cancel()
+            # ...but keep every post that finished, including ones it never received
+            while events is not None:
+                try:
+                    event, payload = events.get_nowait()
+                except queue.Empty:
+                    break
+                if event == 'platform_complete':
+                    posts[payload['platform']] = payload['content']
+            store_generations(posts, context['cache_keys'])
+        
+        print(f"✅ STREAMING GENERATE COMPLETE - {len(posts) + len(cached)}/{len(platforms)} platforms")
+        yield sse_event('done', {
+            'succeeded': len(posts) + len(cached),
+            'failed': len(failed),
+            'cached_platforms': [p['id'] for p in platforms if p['id'] in cached],
+            'elapsed_ms': round((time.time() - started) * 1000)
+        })
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 # ==================== ERROR HANDLERS (Unchanged) ====================
 
 @app.errorhandler(404)
@@ -2765,9 +4788,27 @@ def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 
-# ==================== STARTUP (Unchanged) ====================
+@app.errorhandler(ResilienceError)
+def provider_unavailable(error):
+    response = jsonify({'error': 'Service temporarily unavailable', 'details': str(error), 'success': False})
+    if error.retry_after:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+@app.errorhandler(DeadlineExceededError)
+def deadline_exceeded(error):
+    return jsonify({'error': 'Request deadline exceeded', 'details': str(error), 'success': False}), 504
+
+
+# ==================== STARTUP ====================
+
+startup.mark('routes')
+startup.ready()
 
 if __name__ == '__main__':
+    # Spawned image workers would otherwise re-run this whole script
+    use_light_spawn_main()
     with app.app_context():
         db.create_all()
         print("=" * 50)
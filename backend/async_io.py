@@ -0,0 +1,139 @@
+# async_io.py
+# Shared asyncio event loop for outbound provider I/O
+#
+# The app runs on a WSGI server (gunicorn), so request handlers stay synchronous.
+# Their provider calls (Groq, Clipdrop, Google Speech/TTS/Translate) are
+# coroutines instead, run on one event loop in a background thread of the
+# worker process:
+# - all calls of a request run concurrently (every platform's post, every
+#   background variant, translation alongside the next question's TTS), while
+#   the request thread simply waits for the result
+# - the loop owns the long-lived clients (httpx.AsyncClient connection pools,
+#   grpc.aio channels), so connections are reused across requests instead of
+#   being opened per call
+# - coroutines run in a copy of the caller's context, so flask.g (request
+#   deadline, retry budget) is visible to them
+#
+# Clients are created lazily on the loop (they are bound to it) and the loop is
+# recreated after a fork, like the image worker pool.
+
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+
+class AsyncIORunner:
+    """Background event loop that request threads hand coroutines to"""
+
+    def __init__(self, name='provider-io'):
+        self.name = name
+        self._loop = None
+        self._loop_pid = None
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+
+    def _get_loop(self):
+        with self._lock:
+            # A loop inherited through fork has no thread running it
+            if self._loop is None or self._loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run_loop():
+                    asyncio.set_event_loop(loop)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                threading.Thread(target=run_loop, name=self.name, daemon=True).start()
+                ready.wait()
+                self._loop = loop
+                self._loop_pid = os.getpid()
+                self._clients = {}
+            return self._loop
+
+    def submit(self, coro):
+        """
+        Start a coroutine on the shared loop without waiting for it.
+        The coroutine sees the caller's contextvars (Flask request context included).
+
+        Returns: concurrent.futures.Future; cancelling it cancels the coroutine
+        """
+        loop = self._get_loop()
+        result = concurrent.futures.Future()
+        tasks = []
+
+        def start():
+            if result.cancelled():
+                coro.close()
+                self._finish(None, result)
+                return
+            task = loop.create_task(coro)
+            tasks.append(task)
+            task.add_done_callback(lambda done: self._finish(done, result))
+
+        def cancel(future):
+            if future.cancelled():
+                loop.call_soon_threadsafe(lambda: tasks and tasks[0].cancel())
+
+        with self._lock:
+            self._in_flight += 1
+        result.add_done_callback(cancel)
+        loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return result
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the shared loop and wait for its result.
+
+        Raises: whatever the coroutine raised; concurrent.futures.TimeoutError after
+                timeout seconds (the coroutine is cancelled)
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def _finish(self, task, result):
+        """Count a finished coroutine and hand its outcome to the caller's future"""
+        with self._lock:
+            self._in_flight -= 1
+            if task is None or task.cancelled() or task.exception() is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+        if result.done():
+            # Cancelled by the caller
+            return
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+    def client(self, name, factory):
+        """
+        Long-lived client bound to the loop, created by factory() on first use.
+        Must be called from a coroutine running on this loop.
+        """
+        client = self._clients.get(name)
+        if client is None:
+            client = self._clients[name] = factory()
+        return client
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._loop is not None and self._loop_pid == os.getpid() and self._loop.is_running(),
+                'clients': sorted(self._clients),
+                'in_flight': self._in_flight,
+                'completed': self._completed,
+                'failed': self._failed
+            }
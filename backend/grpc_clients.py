@@ -0,0 +1,167 @@
+# grpc_clients.py
+# Lazily created Google Cloud gRPC clients (Speech, Text-to-Speech)
+#
+# gRPC channels must not cross a fork: a channel created in the gunicorn master
+# (--preload) and inherited by the workers hangs or reconnects endlessly. The
+# registry therefore never creates a channel at import time:
+# - clients are created on the provider I/O loop on first use or by warm(),
+#   and the loop is recreated in every forked worker, so each worker process
+#   gets its own channels
+# - client libraries are imported off the loop (by warm() in its own thread,
+#   or by the caller before it asks for a client), so an import never blocks
+#   the loop shared by every request
+# - channels use keepalive pings, so idle connections dropped by NATs and load
+#   balancers are detected before a user request runs into them
+# - warm() connects the channels ahead of the first request (optional)
+# - stats() reports each channel's connectivity state for /api/health
+
+import asyncio
+import os
+import threading
+import time
+
+
+class GrpcClientRegistry:
+    """Per-process, lazily created grpc.aio clients bound to an AsyncIORunner loop"""
+
+    def __init__(self, runner, credentials=None, keepalive_seconds=60, keepalive_timeout_seconds=20):
+        self.runner = runner
+        self.credentials = credentials
+        self.keepalive_seconds = keepalive_seconds
+        self.keepalive_timeout_seconds = keepalive_timeout_seconds
+        self.channel_options = [
+            ('grpc.keepalive_time_ms', int(keepalive_seconds * 1000)),
+            ('grpc.keepalive_timeout_ms', int(keepalive_timeout_seconds * 1000)),
+            # Keep pinging while no call is active, at most once per keepalive period
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0)
+        ]
+        self._factories = {}
+        self._clients = {}
+        self._info = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self._warm_pid = None
+
+    def register(self, kind, load_class):
+        """
+        Register an async client under a name.
+        load_class() returns the client class (e.g. speech.SpeechAsyncClient); it is
+        called when the first client is created, so the library is imported lazily.
+        Callers of get() should import the library first (it then only looks it up).
+        """
+        self._factories[kind] = load_class
+
+    @property
+    def kinds(self):
+        return sorted(self._factories)
+
+    def _create(self, kind):
+        client_class = self._factories[kind]()
+        transport_class = client_class.get_transport_class('grpc_asyncio')
+        options = self.channel_options
+
+        def create_channel(*args, **kwargs):
+            kwargs['options'] = list(kwargs.get('options') or []) + options
+            return transport_class.create_channel(*args, **kwargs)
+
+        started = time.monotonic()
+        client = client_class(transport=transport_class(credentials=self.credentials, channel=create_channel))
+        self._info[kind] = {
+            'created_at': time.time(),
+            'create_ms': round((time.monotonic() - started) * 1000, 1),
+            'ready_ms': None
+        }
+        print(f"[GRPC] {kind} client created in process {os.getpid()}")
+        return client
+
+    def get(self, kind):
+        """
+        The client for kind, created on first use in this process.
+        Must be called from a coroutine running on the runner's loop.
+        """
+        with self._lock:
+            # Clients (and channels) inherited through fork are never reused
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._info = {}
+                self._pid = os.getpid()
+            client = self._clients.get(kind)
+            if client is None:
+                client = self._clients[kind] = self._create(kind)
+            return client
+
+    @staticmethod
+    def _channel(client):
+        return client.transport.grpc_channel
+
+    async def _warm(self, timeout):
+        async def connect(kind):
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self._channel(self.get(kind)).channel_ready(), timeout)
+                self._info[kind]['ready_ms'] = round((time.monotonic() - started) * 1000, 1)
+                return kind, True
+            except Exception as e:
+                print(f"[GRPC] {kind} channel not ready after warm-up: {type(e).__name__} {e}")
+                return kind, False
+        return dict(await asyncio.gather(*(connect(kind) for kind in self._factories)))
+
+    def warm(self, timeout=10):
+        """Create every registered client and connect its channel; returns {kind: ready}"""
+        if self.credentials is None or not self._factories:
+            return {}
+        started = time.time()
+        # Import the client libraries here, not on the loop
+        for load_class in self._factories.values():
+            load_class()
+        ready = self.runner.run(self._warm(timeout), timeout=timeout + 5)
+        print(f"[GRPC] Warm-up finished in {time.time() - started:.1f}s: {ready}")
+        return ready
+
+    def warm_in_background(self, timeout=10):
+        """warm() once per process, without blocking the caller"""
+        with self._lock:
+            if self._warm_pid == os.getpid():
+                return
+            self._warm_pid = os.getpid()
+
+        def run():
+            try:
+                self.warm(timeout)
+            except Exception as e:
+                print(f"[GRPC] Warm-up failed: {e}")
+
+        threading.Thread(target=run, daemon=True, name='grpc-warmup').start()
+
+    async def _channel_states(self):
+        return {
+            kind: self._channel(client).get_state(try_to_connect=False).name.lower()
+            for kind, client in self._clients.items()
+        }
+
+    def stats(self):
+        with self._lock:
+            current = self._pid == os.getpid()
+            info = {kind: dict(values) for kind, values in self._info.items()} if current else {}
+            has_clients = current and bool(self._clients)
+
+        states = {}
+        if has_clients:
+            try:
+                states = self.runner.run(self._channel_states(), timeout=1)
+            except Exception as e:
+                states = {kind: f"unknown ({type(e).__name__})" for kind in info}
+
+        channels = {}
+        for kind in self.kinds:
+            if kind in info:
+                channels[kind] = {'state': states.get(kind, 'unknown'), **info[kind]}
+            else:
+                channels[kind] = {'state': 'not_created'}
+        return {
+            'configured': self.credentials is not None,
+            'keepalive_seconds': self.keepalive_seconds,
+            'keepalive_timeout_seconds': self.keepalive_timeout_seconds,
+            'channels': channels
+        }
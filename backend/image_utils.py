@@ -0,0 +1,662 @@
+# image_utils.py
+# Memory-bounded image loading and streaming uploads
+#
+# Every place that decodes an uploaded image goes through load_image(), which
+# refuses decompression bombs and decodes JPEGs at reduced scale (draft mode)
+# when only a smaller size is needed. Outbound uploads stream the file from
+# disk with MultipartFileStream instead of reading it into memory first.
+# normalize_for_provider() prepares compact, metadata-free copies for paid APIs.
+# analyze_image_quality() and extract_image_attributes() are cheap NumPy passes
+# over a small downscaled copy.
+# create_renditions() cuts all platform crops from one decoded image.
+# transcode_image() stores generated images in a compact at-rest format.
+# These are plain functions; image_workers.py runs them in a process pool.
+
+import hashlib
+import io
+import os
+import tempfile
+import uuid
+
+import numpy as np
+from PIL import Image, ImageOps, features
+
+from media_storage import ensure_media_path, resolve_media_path
+
+# Largest image (in pixels) we are willing to decode. 50 MP covers every phone camera.
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 50_000_000))
+
+# Pillow warns above MAX_IMAGE_PIXELS and raises DecompressionBombError above 2x
+# (inside Image.open); _open_image() reports both as ImageTooLargeError.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+# Quality gate thresholds (measured on a copy downscaled to QUALITY_ANALYSIS_SIZE)
+QUALITY_ANALYSIS_SIZE = 512
+IMAGE_MIN_SIDE = int(os.getenv('IMAGE_MIN_SIDE', 400))
+IMAGE_MIN_SHARPNESS = float(os.getenv('IMAGE_MIN_SHARPNESS', 60))
+IMAGE_MIN_BRIGHTNESS = float(os.getenv('IMAGE_MIN_BRIGHTNESS', 50))
+IMAGE_MAX_BRIGHTNESS = float(os.getenv('IMAGE_MAX_BRIGHTNESS', 235))
+
+
+# Attribute extraction works on a thumbnail; a few thousand pixels are plenty for a palette
+ATTRIBUTE_THUMBNAIL_SIZE = 96
+PALETTE_SIZE = 5
+
+# Reference colours used to give palette entries a human readable name
+NAMED_COLORS = {
+    'black': (20, 20, 20), 'charcoal': (60, 60, 60), 'grey': (128, 128, 128),
+    'silver': (192, 192, 192), 'white': (245, 245, 245), 'cream': (240, 228, 200),
+    'beige': (210, 190, 150), 'tan': (180, 140, 100), 'brown': (120, 75, 40),
+    'dark brown': (70, 40, 20), 'maroon': (110, 20, 30), 'red': (200, 30, 40),
+    'orange': (235, 130, 40), 'mustard': (200, 160, 40), 'yellow': (240, 210, 50),
+    'gold': (190, 150, 60), 'olive': (110, 110, 40), 'green': (50, 140, 60),
+    'teal': (30, 120, 120), 'turquoise': (60, 190, 190), 'sky blue': (120, 180, 230),
+    'blue': (40, 80, 180), 'navy': (25, 35, 90), 'purple': (110, 50, 140),
+    'magenta': (190, 40, 130), 'pink': (240, 150, 180), 'peach': (245, 190, 150),
+}
+_NAMED_COLOR_NAMES = list(NAMED_COLORS)
+_NAMED_COLOR_VALUES = np.array(list(NAMED_COLORS.values()), dtype=np.float32)
+
+
+# Platform renditions
+RENDITION_JPEG_QUALITY = int(os.getenv('RENDITION_JPEG_QUALITY', 88))
+# Margin kept around the subject, as a fraction of its larger side
+SUBJECT_PADDING = 0.08
+
+# At-rest formats for generated images: (PIL format, extension, extra save options)
+COMPACT_FORMATS = {
+    'webp': ('WEBP', '.webp', {'method': 4}),
+    'avif': ('AVIF', '.avif', {'speed': 6}),
+    'jpeg': ('JPEG', '.jpg', {'optimize': True, 'progressive': True}),
+    'png': ('PNG', '.png', {'optimize': True}),
+}
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds MAX_IMAGE_PIXELS"""
+
+
+def _open_image(source):
+    """
+    Image.open() that refuses images over MAX_IMAGE_PIXELS (header only, nothing decoded).
+
+    Raises: ImageTooLargeError, PIL.UnidentifiedImageError
+    """
+    try:
+        img = Image.open(source)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        img.close()
+        raise ImageTooLargeError(f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS} pixels")
+    return img
+
+
+def read_image_info(source):
+    """
+    Read image dimensions and format from the header only (no pixel decode).
+
+    Returns: (width, height, format)
+    Raises: ImageTooLargeError, PIL.UnidentifiedImageError
+    """
+    with _open_image(source) as img:
+        return img.width, img.height, img.format
+
+
+def load_image(source, max_size=None, mode=None):
+    """
+    Decode an image with a bounded memory footprint.
+
+    source: path or seekable file object
+    max_size: (width, height) the caller actually needs; JPEGs are decoded at the
+              nearest reduced scale and the result is downscaled to fit
+    mode: optional PIL mode to convert to (e.g. 'RGB')
+
+    Returns: loaded PIL.Image (the underlying file is already closed)
+    Raises: ImageTooLargeError, PIL.UnidentifiedImageError
+    """
+    with _open_image(source) as img:
+        if max_size and img.format == 'JPEG':
+            # DCT scaling: decodes at 1/2, 1/4 or 1/8 size without touching full-res pixels
+            img.draft(mode or img.mode, max_size)
+
+        img.load()
+
+        if max_size and (img.width > max_size[0] or img.height > max_size[1]):
+            img.thumbnail(max_size, Image.LANCZOS)
+
+        if mode and img.mode != mode:
+            img = img.convert(mode)
+
+    return img
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Content hash of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _has_alpha(img):
+    return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def _flatten_onto_white(img):
+    """RGB copy of an image; transparency is flattened onto white instead of turning black"""
+    if not _has_alpha(img):
+        return img.convert('RGB')
+    rgba = img.convert('RGBA')
+    flat = Image.new('RGB', rgba.size, (255, 255, 255))
+    flat.paste(rgba, mask=rgba.getchannel('A'))
+    return flat
+
+
+def normalize_for_provider(source_path, cache_folder, max_side=2048, keep_alpha=False, source_hash=None):
+    """
+    Prepare an image for upload to an external image API:
+    - applies the EXIF orientation and drops all metadata (EXIF, GPS, ICC...)
+    - downscales so the longest side is at most max_side
+    - re-encodes as JPEG (or PNG when keep_alpha and the image has transparency)
+    The result is cached per source content hash, so repeated calls are free.
+
+    Returns: (path, filename, mime_type)
+    Raises: ImageTooLargeError, PIL.UnidentifiedImageError
+    """
+    source_hash = source_hash or file_sha256(source_path)
+    folder = os.path.join(cache_folder, 'normalized')
+
+    for ext, mime_type in (('jpg', 'image/jpeg'), ('png', 'image/png')):
+        cache_name = f"{source_hash}_{max_side}.{ext}"
+        cached = resolve_media_path(folder, cache_name)
+        if cached:
+            return cached, f"image.{ext}", mime_type
+
+    with _open_image(source_path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (max_side, max_side))
+
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        if keep_alpha and _has_alpha(img):
+            img = img.convert('RGBA')
+            ext, mime_type, save_args = 'png', 'image/png', {'optimize': True}
+        else:
+            img = _flatten_onto_white(img)
+            ext, mime_type, save_args = 'jpg', 'image/jpeg', {'quality': 90, 'optimize': True, 'progressive': True}
+
+        cache_path = ensure_media_path(folder, f"{source_hash}_{max_side}.{ext}")
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+        img.save(tmp_path, format='PNG' if ext == 'png' else 'JPEG', **save_args)
+        os.replace(tmp_path, cache_path)
+
+    return cache_path, f"image.{ext}", mime_type
+
+
+def analyze_image_quality(source_path):
+    """
+    Fast local quality check for product photos (no external API calls):
+    - resolution: shortest side of the original image
+    - sharpness: variance of the Laplacian on a grayscale copy (low = blurry), taken
+      per 64px tile at the 95th percentile so a small sharp product on a plain
+      background is not mistaken for a blurry photo
+    - exposure: mean brightness and the share of crushed shadows / blown highlights
+
+    'issues' make the image unusable for a listing (enhancement is rejected),
+    'warnings' are reported but do not block enhancement.
+
+    Returns: dict with the scores, issues, warnings and passed flag
+    """
+    width, height, _ = read_image_info(source_path)
+
+    gray = load_image(source_path, max_size=(QUALITY_ANALYSIS_SIZE, QUALITY_ANALYSIS_SIZE), mode='L')
+    pixels = np.asarray(gray, dtype=np.float32)
+    gray.close()
+
+    laplacian = (
+        pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+        - 4.0 * pixels[1:-1, 1:-1]
+    )
+    tile = 64
+    rows, cols = laplacian.shape[0] // tile, laplacian.shape[1] // tile
+    if rows and cols:
+        tiles = laplacian[:rows * tile, :cols * tile].reshape(rows, tile, cols, tile)
+        sharpness = float(np.percentile(tiles.var(axis=(1, 3)), 95))
+    else:
+        sharpness = float(laplacian.var()) if laplacian.size else 0.0
+
+    histogram = np.bincount(pixels.astype(np.uint8).ravel(), minlength=256)
+    total = max(int(histogram.sum()), 1)
+    brightness = float(np.dot(np.arange(256), histogram) / total)
+    dark_fraction = float(histogram[:16].sum() / total)
+    bright_fraction = float(histogram[240:].sum() / total)
+
+    issues = []
+    warnings = []
+
+    if min(width, height) < IMAGE_MIN_SIDE:
+        issues.append(f'resolution too low ({width}x{height}, need at least {IMAGE_MIN_SIDE}px on the short side)')
+
+    if sharpness < IMAGE_MIN_SHARPNESS / 2:
+        issues.append('image is very blurry')
+    elif sharpness < IMAGE_MIN_SHARPNESS:
+        warnings.append('image looks slightly blurry')
+
+    if brightness < IMAGE_MIN_BRIGHTNESS / 2 or dark_fraction > 0.7:
+        issues.append('image is far too dark')
+    elif brightness < IMAGE_MIN_BRIGHTNESS or dark_fraction > 0.4:
+        warnings.append('image is underexposed')
+
+    # Very bright is normal for products on a white sheet, so this only warns
+    if brightness > IMAGE_MAX_BRIGHTNESS or bright_fraction > 0.85:
+        warnings.append('image is overexposed')
+
+    return {
+        'width': width,
+        'height': height,
+        'sharpness': round(sharpness, 2),
+        'brightness': round(brightness, 2),
+        'dark_fraction': round(dark_fraction, 4),
+        'bright_fraction': round(bright_fraction, 4),
+        'issues': issues,
+        'warnings': warnings,
+        'passed': not issues
+    }
+
+
+def _kmeans_palette(pixels, k=PALETTE_SIZE, iterations=10):
+    """
+    Vectorized k-means over an (N, 3) float32 pixel array.
+    Deterministic farthest-point initialisation, so the same image always gives
+    the same palette and small but distinct colours still get their own cluster.
+
+    Returns: (centers (k, 3), counts (k,)) sorted by count, empty clusters dropped
+    """
+    centers = [pixels.mean(axis=0)]
+    nearest = ((pixels - centers[0]) ** 2).sum(axis=1)
+    for _ in range(k - 1):
+        centers.append(pixels[int(nearest.argmax())])
+        nearest = np.minimum(nearest, ((pixels - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers, dtype=np.float32)
+
+    for _ in range(iterations):
+        distances = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=pixels[:, ch], minlength=k) for ch in range(3)], axis=1)
+        nonempty = counts > 0
+        new_centers = centers.copy()
+        new_centers[nonempty] = sums[nonempty] / counts[nonempty, None]
+        if np.allclose(new_centers, centers, atol=0.5):
+            centers = new_centers
+            break
+        centers = new_centers
+
+    ranking = np.argsort(-counts)
+    ranking = ranking[counts[ranking] > 0]
+    return centers[ranking], counts[ranking]
+
+
+def extract_image_attributes(source):
+    """
+    Compact visual description of a product photo for text-only prompts:
+    dimensions, aspect ratio, orientation, overall brightness and a dominant
+    colour palette (k-means on a thumbnail).
+
+    source: path or seekable file object
+    Returns: dict of attributes (JSON serializable)
+    """
+    width, height, _ = read_image_info(source)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+    thumb = load_image(source, max_size=(ATTRIBUTE_THUMBNAIL_SIZE, ATTRIBUTE_THUMBNAIL_SIZE), mode='RGB')
+    pixels = np.asarray(thumb, dtype=np.float32).reshape(-1, 3)
+    thumb.close()
+
+    centers, counts = _kmeans_palette(pixels)
+    total = float(counts.sum())
+
+    name_distances = ((centers[:, None, :] - _NAMED_COLOR_VALUES[None, :, :]) ** 2).sum(axis=2)
+    palette = [
+        {
+            'hex': '#{:02x}{:02x}{:02x}'.format(*(int(round(c)) for c in center)),
+            'name': _NAMED_COLOR_NAMES[int(name_idx)],
+            'share': round(float(count) / total, 3)
+        }
+        for center, count, name_idx in zip(centers, counts, name_distances.argmin(axis=1))
+    ]
+
+    brightness = float((pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).mean())
+    aspect_ratio = width / height if height else 0
+    if aspect_ratio > 1.1:
+        orientation = 'landscape'
+    elif aspect_ratio < 0.9:
+        orientation = 'portrait'
+    else:
+        orientation = 'square'
+
+    return {
+        'width': width,
+        'height': height,
+        'aspect_ratio': round(aspect_ratio, 3),
+        'orientation': orientation,
+        'brightness': round(brightness, 1),
+        'palette': palette
+    }
+
+
+def compute_dhash(source, hash_size=8):
+    """
+    Difference hash: compares neighbouring pixels of a (hash_size+1) x hash_size
+    grayscale thumbnail. Robust to re-compression, resizing and small crops.
+
+    Returns: 64-bit hash as int
+    """
+    gray = load_image(source, max_size=(256, 256), mode='L')
+    small = gray.resize((hash_size + 1, hash_size), Image.BOX)
+    gray.close()
+
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def compact_format(name):
+    """
+    Resolve a configured at-rest format name to one this Pillow build can encode.
+    AVIF needs Pillow >= 11.3 (or pillow-avif-plugin); anything unavailable falls back to WebP.
+    """
+    name = (name or 'webp').lower()
+    name = 'jpeg' if name == 'jpg' else name
+    if name not in COMPACT_FORMATS or (name in ('webp', 'avif') and not features.check(name)):
+        return 'webp' if features.check('webp') else 'png'
+    return name
+
+
+def transcode_image(data, output_path, fmt, quality):
+    """
+    Re-encode image bytes (e.g. a PNG from an image API) in a compact format.
+    Alpha is kept for formats that support it and flattened onto white for JPEG.
+
+    Returns: size of the written file in bytes
+    Raises: ImageTooLargeError, PIL.UnidentifiedImageError
+    """
+    pil_format, _, options = COMPACT_FORMATS[fmt]
+    img = load_image(io.BytesIO(data))
+
+    if pil_format == 'JPEG':
+        img = _flatten_onto_white(img)
+    elif img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+
+    save_args = dict(options)
+    if fmt != 'png':
+        save_args['quality'] = quality
+
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+    img.save(tmp_path, pil_format, **save_args)
+    os.replace(tmp_path, output_path)
+    img.close()
+    return os.path.getsize(output_path)
+
+
+def subject_bbox(img, threshold=16):
+    """
+    Bounding box of the opaque part of an image with an alpha channel
+    (e.g. a background-removed cut-out).
+
+    Returns: (left, top, right, bottom) or None if the image has no usable alpha
+    """
+    if not _has_alpha(img):
+        return None
+    if img.mode == 'P':
+        img = img.convert('RGBA')
+    alpha = img.getchannel('A')
+    return alpha.point(lambda value: 255 if value > threshold else 0).getbbox()
+
+
+def rendition_box(size, target, subject=None, fill=None, padding=SUBJECT_PADDING):
+    """
+    Crop box with the target aspect ratio, centred on the subject.
+
+    Without `fill` the box is as large as the image allows (re-framing only);
+    with `fill` it is sized so the subject covers that fraction of the frame.
+    The box may extend past the image when the subject would not fit otherwise;
+    render_rendition() fills that area with the background.
+
+    Returns: (left, top, right, bottom) as floats
+    """
+    width, height = size
+    ratio = target[0] / target[1]
+    left, top, right, bottom = subject or (0, 0, width, height)
+    subject_w, subject_h = right - left, bottom - top
+
+    largest_w = min(width, height * ratio)
+    if fill:
+        box_w = max(subject_w / fill, subject_h / fill * ratio)
+    elif subject:
+        pad = padding * max(subject_w, subject_h)
+        box_w = max(subject_w + 2 * pad, (subject_h + 2 * pad) * ratio, largest_w)
+    else:
+        box_w = largest_w
+    box_h = box_w / ratio
+
+    def place(center, box_len, image_len):
+        start = center - box_len / 2
+        if box_len <= image_len:
+            start = min(max(start, 0), image_len - box_len)
+        return start
+
+    box_left = place((left + right) / 2, box_w, width)
+    box_top = place((top + bottom) / 2, box_h, height)
+    return box_left, box_top, box_left + box_w, box_top + box_h
+
+
+def border_color(img):
+    """Median colour of the image border, used to extend generated backgrounds"""
+    thumb = np.asarray(img.convert('RGB').resize((32, 32), Image.BOX))
+    ring = np.concatenate([thumb[0], thumb[-1], thumb[:, 0], thumb[:, -1]])
+    return tuple(int(c) for c in np.median(ring, axis=0))
+
+
+def render_rendition(img, box, target, background):
+    """
+    Resample the box of an already decoded image into a target-sized RGB canvas.
+    Parts of the box outside the image are filled with `background`; transparent
+    pixels are composited onto it.
+    """
+    scale = target[0] / (box[2] - box[0])
+    inner = (max(box[0], 0), max(box[1], 0), min(box[2], img.width), min(box[3], img.height))
+    part_size = (
+        max(1, round((inner[2] - inner[0]) * scale)),
+        max(1, round((inner[3] - inner[1]) * scale))
+    )
+    offset = (round((inner[0] - box[0]) * scale), round((inner[1] - box[1]) * scale))
+
+    part = img.resize(part_size, Image.LANCZOS, box=inner, reducing_gap=3.0)
+    canvas = Image.new('RGB', target, background)
+    canvas.paste(part, offset, part if part.mode == 'RGBA' else None)
+    return canvas
+
+
+def save_jpeg(img, path, quality):
+    """Write an RGB image as an optimized progressive JPEG; returns the file size"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    img.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def plan_rendition(spec, image_size, subject, extend_color, cutout_size=None, cutout_bbox=None):
+    """
+    Decide how one rendition is cut.
+    Solid-background renditions work from the cut-out (when it has a subject) so
+    no generated backdrop shows; the rest crop the finished image around the subject.
+
+    Returns: (use_cutout, box, background)
+    """
+    target = (spec['width'], spec['height'])
+    if spec.get('background') and cutout_bbox:
+        return True, rendition_box(cutout_size, target, cutout_bbox, fill=spec.get('fill')), spec['background']
+    box = rendition_box(image_size, target, subject, fill=spec.get('fill'))
+    return False, box, spec.get('background') or extend_color
+
+
+def scale_bbox(bbox, from_size, to_size):
+    """Map a bounding box between two sizes of the same image"""
+    sx, sy = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    return bbox[0] * sx, bbox[1] * sy, bbox[2] * sx, bbox[3] * sy
+
+
+def create_renditions(source, specs, cutout=None):
+    """
+    Produce several crops/sizes of one image from a single decode.
+
+    source: path or file object of the finished (e.g. background-replaced) image
+    specs: list of dicts with key, path, width, height and optionally
+           background ('white' composites the cut-out on white) and fill
+    cutout: optional path or file object of the background-removed image; its
+            alpha mask locates the subject
+
+    Returns: dict key -> {'path', 'width', 'height', 'size'}
+    """
+    img = load_image(source)
+    cut = load_image(cutout) if cutout is not None else None
+
+    # Subject location from the cut-out's alpha, scaled to the finished image
+    cut_bbox = subject_bbox(cut) if cut is not None else None
+    if cut_bbox:
+        subject = scale_bbox(cut_bbox, cut.size, img.size)
+    else:
+        subject = subject_bbox(img)
+
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+    extend_color = border_color(img)
+    if cut is not None and cut.mode != 'RGBA':
+        cut = cut.convert('RGBA')
+
+    results = {}
+    for spec in specs:
+        use_cutout, box, background = plan_rendition(
+            spec, img.size, subject, extend_color, cut.size if cut is not None else None, cut_bbox
+        )
+        target = (spec['width'], spec['height'])
+        canvas = render_rendition(cut if use_cutout else img, box, target, background)
+        size = save_jpeg(canvas, spec['path'], RENDITION_JPEG_QUALITY)
+        canvas.close()
+        results[spec['key']] = {'path': spec['path'], 'width': spec['width'], 'height': spec['height'], 'size': size}
+
+    img.close()
+    if cut is not None:
+        cut.close()
+    return results
+
+
+def describe_image_attributes(attributes):
+    """Render image attributes as a few short lines for an LLM prompt"""
+    brightness = attributes['brightness']
+    tone = 'bright' if brightness > 170 else 'dark' if brightness < 85 else 'balanced'
+
+    colours = ', '.join(
+        f"{entry['name']} ({entry['hex']}, {int(entry['share'] * 100)}%)"
+        for entry in attributes['palette']
+        if entry['share'] >= 0.05
+    )
+
+    return "\n".join([
+        f"**Photo**: {attributes['width']}x{attributes['height']} {attributes['orientation']} "
+        f"(aspect ratio {attributes['aspect_ratio']}), {tone} lighting",
+        f"**Dominant Colours**: {colours}"
+    ])
+
+
+def spool_response(response, max_bytes, chunk_size=64 * 1024):
+    """
+    Copy a streamed requests response into a spooled temp file (in memory up to 1 MB,
+    on disk beyond that) so it can be decoded without holding the whole body in RAM.
+
+    Returns: file object positioned at 0
+    Raises: ValueError if the body exceeds max_bytes
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    total = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        total += len(chunk)
+        if total > max_bytes:
+            spooled.close()
+            raise ValueError(f"Remote image exceeds {max_bytes} bytes")
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+class MultipartFileStream:
+    """
+    File-like multipart/form-data body for requests.post(data=...).
+    http.client reads it in blocks, so the file is streamed from disk (or from an
+    existing buffer) instead of being copied into one big request body.
+
+    with MultipartFileStream('image_file', path, 'image.jpg', 'image/jpeg') as body:
+        requests.post(url, data=body, headers={'Content-Type': body.content_type})
+    """
+
+    def __init__(self, field_name, source, filename, content_type, fields=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+
+        preamble = b''
+        for name, value in (fields or {}).items():
+            preamble += (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode('utf-8')
+        preamble += (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode('utf-8')
+        epilogue = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        if isinstance(source, (bytes, bytearray)):
+            body = io.BytesIO(source)
+            body_size = len(source)
+        else:
+            body = open(source, 'rb')
+            body_size = os.fstat(body.fileno()).st_size
+
+        self._parts = [io.BytesIO(preamble), body, io.BytesIO(epilogue)]
+        self._length = len(preamble) + body_size + len(epilogue)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        for part in self._parts:
+            part.close()
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
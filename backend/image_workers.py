@@ -0,0 +1,386 @@
+# image_workers.py
+# Process pool for CPU-heavy image work
+#
+# Decoding, resizing, compositing, encoding and quality scoring hold the GIL for
+# long stretches and stall every other request thread of the same gunicorn
+# worker. ImageWorkerPool runs them in separate processes instead:
+# - workers are spawned (the web process already has threads and gRPC channels,
+#   so forking it is unsafe) and warmed once per web process before the first
+#   image task, so no request pays for starting Python and importing Pillow/NumPy
+# - spawned workers re-run the parent's __main__ script; when that is app.py
+#   itself (python app.py), use_light_spawn_main() points them at this module
+# - image bytes and decoded pixels travel through multiprocessing.shared_memory;
+#   only block names, sizes and small results are pickled
+# - every task records its queue wait and run time for /api/health
+#
+# IMAGE_WORKERS=0 runs every task inline in the calling thread (same API).
+
+import importlib.util
+import io
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from image_utils import (
+    load_image, read_image_info, analyze_image_quality, compute_dhash, normalize_for_provider,
+    transcode_image, subject_bbox, border_color, scale_bbox, plan_rendition, render_rendition,
+    create_renditions, save_jpeg, RENDITION_JPEG_QUALITY
+)
+
+# Task latencies kept per task name for the percentile in stats()
+LATENCY_WINDOW = 200
+
+
+def use_light_spawn_main():
+    """
+    Make spawned workers import this module as their __main__ instead of re-running
+    the script that started the web process. Call it from that script's
+    if __name__ == '__main__' block, before the first task is submitted.
+    """
+    main = sys.modules['__main__']
+    if getattr(main, '__spec__', None) is None:
+        main.__spec__ = importlib.util.find_spec(__name__)
+
+
+# ==================== WORKER-SIDE TASKS ====================
+# Module-level functions so they can be pickled by reference.
+
+def _worker_init():
+    # Ctrl+C is handled by the web process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _ping(delay):
+    # Holding each worker briefly spreads the warm-up pings over all processes
+    time.sleep(delay)
+    return os.getpid()
+
+
+def _timed_call(fn, args):
+    """Run a task and report when it started and how long it ran"""
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time() - started
+
+
+def _analyze_upload(path):
+    """Quality report and perceptual hash of an uploaded image"""
+    return {'quality': analyze_image_quality(path), 'phash': compute_dhash(path)}
+
+
+def _transcode_shared(block_name, length, output_path, fmt, quality):
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        with block.buf[:length] as view:
+            return transcode_image(view, output_path, fmt, quality)
+    finally:
+        block.close()
+
+
+def _decode_shared(block_name, length, pixels_name):
+    """
+    Decode image bytes from one shared block into RGBA pixels in another.
+
+    Returns: {'bbox': subject bbox from the alpha channel or None, 'border': border colour}
+    """
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        with block.buf[:length] as view:
+            img = load_image(io.BytesIO(view))
+    finally:
+        block.close()
+
+    bbox = subject_bbox(img)
+    border = border_color(img)
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    pixels = shared_memory.SharedMemory(name=pixels_name)
+    try:
+        target = np.ndarray((img.height, img.width, 4), dtype=np.uint8, buffer=pixels.buf)
+        target[...] = np.asarray(img)
+        del target
+    finally:
+        pixels.close()
+    img.close()
+    return {'bbox': bbox, 'border': border}
+
+
+def _render_shared(pixels_name, size, box, target, background, path, quality):
+    """Cut one rendition from shared RGBA pixels and encode it as JPEG"""
+    pixels = shared_memory.SharedMemory(name=pixels_name)
+    try:
+        img = Image.frombuffer('RGBA', size, pixels.buf, 'raw', 'RGBA', 0, 1)
+        canvas = render_rendition(img, box, target, background)
+        del img
+        file_size = save_jpeg(canvas, path, quality)
+        canvas.close()
+        return file_size
+    finally:
+        pixels.close()
+
+
+# ==================== POOL ====================
+
+class _SharedBlock:
+    """Shared memory block owned (created and unlinked) by the web process"""
+
+    def __init__(self, size, data=None):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        if data is not None:
+            self.shm.buf[:len(data)] = data
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ImageWorkerPool:
+    """Runs image tasks in spawned worker processes and keeps latency statistics"""
+
+    def __init__(self, workers=0, task_timeout=60):
+        self.workers = max(0, workers)
+        self.task_timeout = task_timeout
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._restarts = 0
+        self._latencies = {}
+        self._warm_pid = None
+        self.warmed_at = None
+
+    # ---------- executor lifecycle ----------
+
+    def _get_executor(self):
+        with self._lock:
+            # A pool inherited through fork (e.g. gunicorn --preload) is unusable
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_worker_init
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def warm(self):
+        """Start every worker process now instead of on the first request"""
+        if not self.workers or multiprocessing.parent_process() is not None:
+            return
+        start = time.time()
+        try:
+            executor = self._get_executor()
+            pings = [executor.submit(_ping, 0.2) for _ in range(self.workers)]
+            pids = {ping.result(timeout=120) for ping in pings}
+            self.warmed_at = time.time()
+            print(f"[IMAGE WORKERS] {len(pids)} worker processes ready in {self.warmed_at - start:.1f}s")
+        except Exception as e:
+            print(f"[IMAGE WORKERS] Warm-up failed: {e}")
+
+    def warm_in_background(self):
+        """warm() once per process, without blocking the caller"""
+        with self._lock:
+            if self._warm_pid == os.getpid():
+                return
+            self._warm_pid = os.getpid()
+        threading.Thread(target=self.warm, daemon=True, name='image-workers-warmup').start()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # ---------- task API ----------
+
+    def _record(self, name, wait, run, ok):
+        with self._lock:
+            self._in_flight -= 1
+            if ok:
+                self._completed += 1
+                self._latencies.setdefault(name, deque(maxlen=LATENCY_WINDOW)).append((wait, run))
+            else:
+                self._failed += 1
+
+    def run_many(self, calls):
+        """
+        Run several tasks in parallel and wait for all of them.
+        calls: list of (function, args tuple); functions must be module-level
+
+        Returns: list of results in call order (the first task error is re-raised)
+        """
+        with self._lock:
+            self._in_flight += len(calls)
+
+        if not self.workers:
+            results = []
+            for index, (fn, args) in enumerate(calls):
+                try:
+                    result, started, run = _timed_call(fn, args)
+                except Exception:
+                    self._record(fn.__name__, 0, 0, False)
+                    for skipped_fn, _ in calls[index + 1:]:
+                        self._record(skipped_fn.__name__, 0, 0, False)
+                    raise
+                self._record(fn.__name__, 0, run, True)
+                results.append(result)
+            return results
+
+        executor = self._get_executor()
+        submitted = time.time()
+        try:
+            futures = [executor.submit(_timed_call, fn, args) for fn, args in calls]
+        except BrokenProcessPool:
+            futures = None
+
+        results, error = [], None
+        for index, (fn, args) in enumerate(calls):
+            try:
+                if futures is None:
+                    raise BrokenProcessPool('image worker pool is not running')
+                result, started, run = futures[index].result(timeout=self.task_timeout)
+                self._record(fn.__name__, max(0.0, started - submitted), run, True)
+                results.append(result)
+            except BrokenProcessPool as e:
+                # A worker died (e.g. OOM-killed). Not retried inline: the same input
+                # could take the web process down. The next task gets a fresh pool.
+                self._reset(executor)
+                print(f"[IMAGE WORKERS] Worker died while running {fn.__name__}, restarting pool")
+                self._record(fn.__name__, 0, 0, False)
+                error = error or e
+            except Exception as e:
+                self._record(fn.__name__, 0, 0, False)
+                error = error or e
+
+        if error is not None:
+            raise error
+        return results
+
+    def run(self, fn, *args):
+        """Run one task in a worker process and return its result"""
+        return self.run_many([(fn, args)])[0]
+
+    def analyze_upload(self, path):
+        """Quality report and perceptual hash: {'quality': ..., 'phash': int}"""
+        return self.run(_analyze_upload, path)
+
+    def normalize_for_provider(self, source_path, cache_folder, max_side=2048):
+        return self.run(normalize_for_provider, source_path, cache_folder, max_side)
+
+    def transcode(self, data, output_path, fmt, quality):
+        """transcode_image() with the input bytes passed through shared memory"""
+        if not self.workers:
+            return self.run(transcode_image, data, output_path, fmt, quality)
+        with _SharedBlock(len(data), data) as block:
+            return self.run(_transcode_shared, block.name, len(data), output_path, fmt, quality)
+
+    def render_renditions(self, source, specs, cutout=None):
+        """
+        create_renditions() split across workers: the image (and cut-out) are
+        decoded once into shared memory, then every rendition is cut and encoded
+        in parallel straight from those pixels.
+
+        source, cutout: encoded image bytes
+        Returns: dict key -> {'path', 'width', 'height', 'size'}
+        """
+        if not self.workers:
+            return self.run(create_renditions, io.BytesIO(source), specs, io.BytesIO(cutout) if cutout else None)
+
+        image_size = read_image_info(io.BytesIO(source))[:2]
+        cutout_size = read_image_info(io.BytesIO(cutout))[:2] if cutout else None
+
+        blocks = []
+        try:
+            source_block = _SharedBlock(len(source), source)
+            blocks.append(source_block)
+            pixels = _SharedBlock(image_size[0] * image_size[1] * 4)
+            blocks.append(pixels)
+            decode_calls = [(_decode_shared, (source_block.name, len(source), pixels.name))]
+            if cutout:
+                cutout_block = _SharedBlock(len(cutout), cutout)
+                blocks.append(cutout_block)
+                cutout_pixels = _SharedBlock(cutout_size[0] * cutout_size[1] * 4)
+                blocks.append(cutout_pixels)
+                decode_calls.append((_decode_shared, (cutout_block.name, len(cutout), cutout_pixels.name)))
+
+            decoded = self.run_many(decode_calls)
+            image_info = decoded[0]
+            cutout_bbox = decoded[1]['bbox'] if cutout else None
+            if cutout_bbox:
+                subject = scale_bbox(cutout_bbox, cutout_size, image_size)
+            else:
+                subject = image_info['bbox']
+
+            render_calls = []
+            for spec in specs:
+                use_cutout, box, background = plan_rendition(
+                    spec, image_size, subject, image_info['border'], cutout_size, cutout_bbox
+                )
+                render_calls.append((_render_shared, (
+                    cutout_pixels.name if use_cutout else pixels.name,
+                    cutout_size if use_cutout else image_size,
+                    box, (spec['width'], spec['height']), background, spec['path'], RENDITION_JPEG_QUALITY
+                )))
+            sizes = self.run_many(render_calls)
+        finally:
+            for block in blocks:
+                block.__exit__()
+
+        return {
+            spec['key']: {'path': spec['path'], 'width': spec['width'], 'height': spec['height'], 'size': size}
+            for spec, size in zip(specs, sizes)
+        }
+
+    # ---------- monitoring ----------
+
+    def stats(self):
+        with self._lock:
+            tasks = {}
+            for name, samples in self._latencies.items():
+                waits = sorted(sample[0] for sample in samples)
+                totals = sorted(sample[0] + sample[1] for sample in samples)
+                tasks[name] = {
+                    'samples': len(samples),
+                    'avg_wait_ms': round(sum(waits) / len(waits) * 1000, 1),
+                    'avg_ms': round(sum(totals) / len(totals) * 1000, 1),
+                    'p95_ms': round(totals[int(0.95 * (len(totals) - 1))] * 1000, 1)
+                }
+            return {
+                'mode': 'process' if self.workers else 'inline',
+                'workers': self.workers,
+                'running': self._executor is not None and self._executor_pid == os.getpid(),
+                'warmed': self.warmed_at is not None,
+                'in_flight': self._in_flight,
+                'queue_depth': max(0, self._in_flight - self.workers) if self.workers else 0,
+                'completed': self._completed,
+                'failed': self._failed,
+                'restarts': self._restarts,
+                'tasks': tasks
+            }
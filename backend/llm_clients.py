@@ -0,0 +1,121 @@
+# llm_clients.py
+# Shared LLM clients, one per provider and model, with per-model latency stats
+#
+# Creating an SDK client per call means a new connection pool and a new TLS
+# handshake for every generated post. The registry keeps one client per
+# (provider, model) for the lifetime of the worker process instead:
+# - clients live on the provider I/O loop (AsyncIORunner.client), which is
+#   recreated after a fork, so every gunicorn worker builds its own
+# - a provider factory decides how clients share connections (the Groq
+#   clients of all models share the provider's httpx connection pool)
+# - warm() creates the configured clients and opens their connections with a
+#   cheap request before the first generation needs them
+# - record()/stats() keep call counts, errors, latency percentiles and output
+#   token rates per model
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+# Latencies kept per model for the percentiles in stats()
+LATENCY_WINDOW = 200
+
+
+class LLMClientRegistry:
+    """Process-wide LLM clients keyed by provider and model"""
+
+    def __init__(self, runner):
+        self.runner = runner
+        self._providers = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._warm_pid = None
+
+    def register(self, provider, factory, warm=None):
+        """
+        factory(model) builds the client of one model (called on the I/O loop).
+        warm(client) is an optional coroutine function making a cheap request.
+        """
+        self._providers[provider] = {'factory': factory, 'warm': warm}
+
+    def client(self, provider, model):
+        """Shared client of provider/model; must be called on the I/O loop"""
+        factory = self._providers[provider]['factory']
+        return self.runner.client(f"llm:{provider}:{model}", lambda: factory(model))
+
+    # ---------- warm-up ----------
+
+    async def _warm(self, models, timeout):
+        async def connect(provider, model):
+            started = time.monotonic()
+            try:
+                client = self.client(provider, model)
+                warm = self._providers[provider]['warm']
+                if warm is not None:
+                    await asyncio.wait_for(warm(client), timeout)
+                return f"{provider}:{model}", round((time.monotonic() - started) * 1000, 1)
+            except Exception as e:
+                print(f"[LLM] Warm-up of {provider}:{model} failed: {type(e).__name__} {e}")
+                return f"{provider}:{model}", None
+        return dict(await asyncio.gather(*(connect(provider, model) for provider, model in models)))
+
+    def warm(self, models, timeout=10):
+        """
+        Create the clients of models (list of (provider, model)) and open their connections.
+        Returns: {'provider:model': warm-up ms, or None if it failed}
+        """
+        started = time.time()
+        result = self.runner.run(self._warm(models, timeout), timeout=timeout + 5)
+        print(f"[LLM] Warm-up finished in {time.time() - started:.1f}s: {result}")
+        return result
+
+    def warm_in_background(self, models, timeout=10):
+        """warm() once per process, without blocking the caller"""
+        with self._lock:
+            if self._warm_pid == os.getpid():
+                return
+            self._warm_pid = os.getpid()
+
+        def run():
+            try:
+                self.warm(models, timeout)
+            except Exception as e:
+                print(f"[LLM] Warm-up failed: {e}")
+
+        threading.Thread(target=run, daemon=True, name='llm-warmup').start()
+
+    # ---------- monitoring ----------
+
+    def record(self, provider, model, seconds, ok, output_tokens=None):
+        """Record one call (including its retries) of provider/model"""
+        with self._lock:
+            stats = self._stats.setdefault(f"{provider}:{model}", {
+                'calls': 0, 'errors': 0, 'output_tokens': 0, 'seconds': 0.0,
+                'latencies': deque(maxlen=LATENCY_WINDOW)
+            })
+            stats['calls'] += 1
+            if not ok:
+                stats['errors'] += 1
+                return
+            stats['latencies'].append(seconds)
+            stats['seconds'] += seconds
+            stats['output_tokens'] += output_tokens or 0
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for name, stats in self._stats.items():
+                latencies = sorted(stats['latencies'])
+                entry = {'calls': stats['calls'], 'errors': stats['errors']}
+                if latencies:
+                    entry.update({
+                        'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+                        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+                        'p95_ms': round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1)
+                    })
+                    if stats['output_tokens']:
+                        entry['output_tokens_per_second'] = round(stats['output_tokens'] / stats['seconds'], 1)
+                models[name] = entry
+            return {'providers': sorted(self._providers), 'models': models}
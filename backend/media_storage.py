@@ -0,0 +1,247 @@
+# media_storage.py
+# Path resolution for the media folders (uploads, audio responses, enhanced images)
+#
+# Files are stored in a two-level hash-sharded layout:
+#     uploads/ab/cd/<filename>
+# where "abcd" are the first hex digits of md5(filename). The shard only depends
+# on the filename, so public URLs (/uploads/<filename>) never change.
+# Files from the old flat layout (uploads/<filename>) are still resolved.
+#
+# Storage backends (MEDIA_STORAGE_BACKEND):
+#   'local' - files only live in the local folders (single instance, default)
+#   's3'    - files are uploaded to an S3-compatible bucket (AWS S3, MinIO, R2...)
+#             and the local folders act as a read-through cache, so any instance
+#             behind the load balancer can serve or process any file.
+# For a local MinIO stand-in:
+#   docker run -p 9000:9000 minio/minio server /data
+#   MEDIA_STORAGE_BACKEND=s3 S3_ENDPOINT_URL=http://localhost:9000 S3_BUCKET=kalakar-media
+#   S3_ACCESS_KEY_ID=minioadmin S3_SECRET_ACCESS_KEY=minioadmin
+
+import hashlib
+import importlib.util
+import mimetypes
+import os
+import shutil
+import uuid
+
+# Optional: S3-compatible storage (requires boto3). boto3 is slow to import, so it
+# is only imported when an S3 backend is created.
+BOTO3_AVAILABLE = importlib.util.find_spec('boto3') is not None
+
+
+def shard_dirs(filename):
+    """Return the two shard directory names for a filename"""
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+def media_path(folder, filename):
+    """Sharded path of a media file (whether or not it exists yet)"""
+    filename = os.path.basename(filename)
+    return os.path.join(folder, *shard_dirs(filename), filename)
+
+
+def ensure_media_path(folder, filename):
+    """Sharded path for writing a new media file; creates the shard directories"""
+    path = media_path(folder, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def resolve_media_path(folder, filename):
+    """
+    Find an existing media file.
+    Looks in the sharded location first, then in the legacy flat location.
+
+    Returns: path or None if the file does not exist
+    """
+    filename = os.path.basename(filename)
+    if not filename:
+        return None
+
+    path = media_path(folder, filename)
+    if os.path.isfile(path):
+        return path
+
+    legacy_path = os.path.join(folder, filename)
+    if os.path.isfile(legacy_path):
+        return legacy_path
+
+    return None
+
+
+def iter_media_files(folder):
+    """Yield os.DirEntry objects for every file in a media folder (sharded or flat)"""
+    if not os.path.isdir(folder):
+        return
+
+    pending = [folder]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+def migrate_flat_folder(folder, dry_run=False):
+    """
+    Move files from the legacy flat layout into the sharded layout.
+    Files that already exist in their shard are left in place.
+
+    Returns: dict with moved/skipped/errors counts
+    """
+    stats = {'moved': 0, 'skipped': 0, 'errors': 0}
+
+    if not os.path.isdir(folder):
+        return stats
+
+    with os.scandir(folder) as entries:
+        flat_files = [entry.name for entry in entries if entry.is_file(follow_symlinks=False)]
+
+    for filename in flat_files:
+        target = media_path(folder, filename)
+        if os.path.exists(target):
+            stats['skipped'] += 1
+            continue
+
+        if dry_run:
+            stats['moved'] += 1
+            continue
+
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(os.path.join(folder, filename), target)
+            stats['moved'] += 1
+        except OSError as e:
+            print(f"[MEDIA] Could not move {filename}: {e}")
+            stats['errors'] += 1
+
+    return stats
+
+
+# ==================== STORAGE BACKENDS ====================
+
+class LocalMediaStorage:
+    """Media stored only in the local sharded folders"""
+
+    name = 'local'
+
+    def put(self, folder, filename, local_path):
+        """
+        Publish a file that has just been written to its local sharded path.
+        Returns False if it could not be published (it then only exists locally).
+        """
+        return True
+
+    def fetch(self, folder, filename):
+        """Return a local path for the file, or None if it does not exist"""
+        return resolve_media_path(folder, filename)
+
+    def delete(self, folder, filename):
+        local_path = resolve_media_path(folder, filename)
+        if local_path:
+            os.remove(local_path)
+
+    def health(self):
+        return {'backend': self.name}
+
+
+class S3MediaStorage(LocalMediaStorage):
+    """
+    Media stored in an S3-compatible bucket.
+    The local sharded folders are a read-through cache: fetch() downloads
+    missing files into them, so every instance sees every upload.
+    """
+
+    name = 's3'
+
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key=None, secret_key=None, prefix=''):
+        if not BOTO3_AVAILABLE:
+            raise RuntimeError("boto3 is required for MEDIA_STORAGE_BACKEND=s3")
+        import boto3
+        from botocore.config import Config as BotoConfig
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            config=BotoConfig(
+                retries={'max_attempts': 3, 'mode': 'standard'},
+                max_pool_connections=32,
+                s3={'addressing_style': 'path'}
+            )
+        )
+
+    def object_key(self, folder, filename):
+        filename = os.path.basename(filename)
+        return f"{self.prefix}{os.path.basename(os.path.normpath(folder))}/{'/'.join(shard_dirs(filename))}/{filename}"
+
+    def put(self, folder, filename, local_path):
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        try:
+            self.client.upload_file(
+                local_path, self.bucket, self.object_key(folder, filename),
+                ExtraArgs={'ContentType': content_type}
+            )
+            return True
+        except Exception as e:
+            print(f"[MEDIA] S3 upload failed for {filename}: {e}")
+            return False
+
+    def fetch(self, folder, filename):
+        local_path = resolve_media_path(folder, filename)
+        if local_path:
+            return local_path
+
+        filename = os.path.basename(filename)
+        if not filename:
+            return None
+
+        target = ensure_media_path(folder, filename)
+        # Download to a temp name first so concurrent readers never see a partial file
+        tmp_path = f"{target}.{uuid.uuid4().hex}.part"
+        try:
+            self.client.download_file(self.bucket, self.object_key(folder, filename), tmp_path)
+            os.replace(tmp_path, target)
+            print(f"[MEDIA] Cached {filename} from S3")
+            return target
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                print(f"[MEDIA] S3 download failed for {filename}: {e}")
+            return None
+        except Exception as e:
+            print(f"[MEDIA] S3 download failed for {filename}: {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, folder, filename):
+        super().delete(folder, filename)
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(folder, filename))
+
+    def health(self):
+        return {'backend': self.name, 'bucket': self.bucket}
+
+
+def create_media_storage():
+    """Build the storage backend selected by MEDIA_STORAGE_BACKEND"""
+    backend = os.getenv('MEDIA_STORAGE_BACKEND', 'local').lower()
+
+    if backend == 's3':
+        return S3MediaStorage(
+            bucket=os.getenv('S3_BUCKET'),
+            endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+            region=os.getenv('S3_REGION'),
+            access_key=os.getenv('S3_ACCESS_KEY_ID'),
+            secret_key=os.getenv('S3_SECRET_ACCESS_KEY'),
+            prefix=os.getenv('S3_PREFIX', '')
+        )
+
+    return LocalMediaStorage()
@@ -0,0 +1,77 @@
+# phash_index.py
+# Near-duplicate search over 64-bit perceptual hashes
+#
+# Multi-index hashing: each hash is split into CHUNKS 16-bit substrings and every
+# substring gets its own exact-match table. If two hashes differ in at most d bits,
+# then (pigeonhole) at least one substring differs in at most d // CHUNKS bits, so
+# probing each table with the few substrings within that radius finds every match
+# while only touching a handful of candidates, even with hundreds of thousands of
+# hashes per user.
+
+from itertools import combinations
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def _flip_masks(radius):
+    """All CHUNK_BITS-wide masks with at most `radius` bits set"""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), r):
+            mask = 0
+            for bit in bits:
+                mask |= 1 << bit
+            masks.append(mask)
+    return masks
+
+
+_FLIP_MASKS = {}
+
+
+class HammingIndex:
+    """In-memory multi-index over 64-bit integer hashes"""
+
+    def __init__(self):
+        self.tables = [dict() for _ in range(CHUNKS)]
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, item_id, value):
+        if item_id in self.hashes:
+            return
+        self.hashes[item_id] = value
+        for position, table in enumerate(self.tables):
+            chunk = (value >> (position * CHUNK_BITS)) & CHUNK_MASK
+            table.setdefault(chunk, []).append(item_id)
+
+    def search(self, value, max_distance):
+        """
+        Find all indexed hashes within max_distance bits of value.
+
+        Returns: list of (item_id, distance) sorted by distance
+        """
+        radius = max_distance // CHUNKS
+        masks = _FLIP_MASKS.get(radius)
+        if masks is None:
+            masks = _FLIP_MASKS[radius] = _flip_masks(radius)
+
+        seen = set()
+        matches = []
+        for position, table in enumerate(self.tables):
+            chunk = (value >> (position * CHUNK_BITS)) & CHUNK_MASK
+            for mask in masks:
+                for item_id in table.get(chunk ^ mask, ()):
+                    if item_id in seen:
+                        continue
+                    seen.add(item_id)
+                    distance = (self.hashes[item_id] ^ value).bit_count()
+                    if distance <= max_distance:
+                        matches.append((item_id, distance))
+
+        matches.sort(key=lambda match: match[1])
+        return matches
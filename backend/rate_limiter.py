@@ -0,0 +1,81 @@
+# rate_limiter.py
+# Token-bucket rate limiting for calls to external providers
+#
+# One limiter is shared by every thread of the process, so batch fan-out,
+# speculative prefetches and ordinary requests together stay under the
+# provider's per-minute limit. Limits are per process; divide the provider
+# limit by the number of gunicorn workers when configuring it.
+
+import asyncio
+import threading
+import time
+
+
+class RateLimitTimeout(Exception):
+    """Raised when no token became available within the caller's timeout"""
+
+
+class RateLimiter:
+    """Token bucket: `rate_per_minute` tokens per minute, at most `burst` at once"""
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _try_take(self, deadline, timeout):
+        """Take a token now, or return how long to wait for one"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise RateLimitTimeout(f"rate limit: no capacity within {timeout}s")
+            self.waited += wait
+            return wait
+
+    def acquire(self, timeout=None):
+        """
+        Take one token, sleeping until one is available.
+
+        Raises: RateLimitTimeout if that would take longer than timeout seconds
+        """
+        if self.rate <= 0:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_take(deadline, timeout)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout=None):
+        """acquire() for coroutines: sleeps on the event loop"""
+        if self.rate <= 0:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_take(deadline, timeout)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate_per_minute': round(self.rate * 60, 1),
+                'burst': self.burst,
+                'available': round(self._tokens, 2),
+                'total_wait_seconds': round(self.waited, 1)
+            }
@@ -0,0 +1,593 @@
+# resilience.py
+# Circuit breakers for calls to external providers
+#
+# Each provider (or provider + voice/model) gets a CircuitBreaker that keeps a
+# rolling window of recent calls. When too many of them failed or were slow,
+# the breaker opens and further calls fail immediately with CircuitOpenError
+# instead of waiting for the provider's full timeout. After open_seconds the
+# breaker lets a few probe calls through (half-open): if they succeed it
+# closes again, if not it stays open for another period.
+#
+# Bulkheads cap how many calls to one provider run at once, so a slow provider
+# can only tie up its own share of the worker threads. A caller that cannot get
+# a slot within queue_timeout gets BulkheadFullError instead of queueing.
+#
+# A Deadline is the time budget of one request. Outbound calls take the
+# remaining budget as their timeout, and once it is spent further stages raise
+# DeadlineExceededError instead of working for a client that has given up.
+#
+# RetryPolicy retries transient provider errors (429, 5xx, lost connections)
+# with exponential backoff and full jitter, waits as long as the provider asks
+# for in Retry-After, gives up when its credit header says nothing is left, and
+# draws from a per-request RetryBudget so one request cannot retry forever.
+#
+# Breakers and bulkheads are per process, like the rate limiter.
+
+import asyncio
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ResilienceError(Exception):
+    """Base class for calls refused before reaching the provider"""
+
+    retry_after = None
+
+
+class CircuitOpenError(ResilienceError):
+    """Raised instead of calling a provider whose circuit is open"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is temporarily unavailable (circuit open)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BulkheadFullError(ResilienceError):
+    """Raised when all of a provider's concurrency slots stayed busy for queue_timeout"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is at its concurrency limit")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(ResilienceError):
+    """Raised when a request's time budget is spent before a stage could start"""
+
+    def __init__(self, stage=None):
+        super().__init__(f"request deadline exceeded{f' ({stage})' if stage else ''}")
+        self.stage = stage
+
+
+class Deadline:
+    """Time budget of one request, started when it is created"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage=None):
+        """Raises: DeadlineExceededError if the budget is spent"""
+        if self.expired():
+            raise DeadlineExceededError(stage)
+
+    def timeout(self, cap, stage=None):
+        """
+        Timeout for the next outbound call: the remaining budget, at most cap seconds.
+
+        Raises: DeadlineExceededError if nothing is left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceededError(stage)
+        return min(cap, remaining)
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker.
+
+    failure_rate: share of failed (or slow) calls in the window that opens the circuit
+    min_calls: calls needed in the window before the rate is trusted
+    slow_call_seconds: calls slower than this count as failures (None: latency ignored)
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=5, window_seconds=60,
+                 open_seconds=30, slow_call_seconds=None, half_open_calls=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._rejected = 0
+        self._times_opened = 0
+
+    # ---------- state ----------
+
+    def _trim(self, now):
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+
+    def _update_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self._times_opened += 1
+        print(f"[CIRCUIT] {self.name} opened for {self.open_seconds}s")
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update_state(time.monotonic())
+            return self._state
+
+    def retry_after(self):
+        """Seconds until the breaker will try the provider again (0 if it is not open)"""
+        with self._lock:
+            now = time.monotonic()
+            self._update_state(now)
+            if self._state != OPEN:
+                return 0
+            return max(1, int(self._opened_at + self.open_seconds - now + 0.999))
+
+    def available(self):
+        """True if a call would currently be let through (does not take a probe slot)"""
+        with self._lock:
+            self._update_state(time.monotonic())
+            return self._state == CLOSED or (self._state == HALF_OPEN and self._probes < self.half_open_calls)
+
+    def _reject(self, now):
+        # Called with the lock held
+        self._rejected += 1
+        if self._state == OPEN:
+            retry_after = max(1, int(self._opened_at + self.open_seconds - now + 0.999))
+        else:
+            retry_after = 1
+        return CircuitOpenError(self.name, retry_after)
+
+    def check(self):
+        """Fail fast before doing any work for a call. Raises: CircuitOpenError"""
+        with self._lock:
+            now = time.monotonic()
+            self._update_state(now)
+            if self._state == CLOSED or (self._state == HALF_OPEN and self._probes < self.half_open_calls):
+                return
+            error = self._reject(now)
+        raise error
+
+    # ---------- calls ----------
+
+    def before_call(self):
+        """Reserve a call. Raises: CircuitOpenError if the provider must not be called now"""
+        with self._lock:
+            now = time.monotonic()
+            self._update_state(now)
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return
+            error = self._reject(now)
+        raise error
+
+    def record(self, ok, latency):
+        """Report the outcome of a call reserved with before_call()"""
+        if ok and self.slow_call_seconds is not None and latency > self.slow_call_seconds:
+            ok = False
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                if ok:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    print(f"[CIRCUIT] {self.name} closed")
+                else:
+                    self._open(now)
+                self._calls.append((now, ok, latency))
+                return
+            self._calls.append((now, ok, latency))
+            self._trim(now)
+            if self._state == CLOSED and len(self._calls) >= self.min_calls:
+                failures = sum(1 for call in self._calls if not call[1])
+                if failures / len(self._calls) >= self.failure_rate:
+                    self._open(now)
+
+    def release(self):
+        """
+        Give back a call reserved with before_call() without recording an outcome,
+        for calls that ended for reasons unrelated to the provider (the caller's own
+        deadline, cancellation)
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def call(self, fn, *args, is_failure=None, **kwargs):
+        """
+        Call fn through the breaker.
+        is_failure: optional predicate on the result (e.g. an HTTP 5xx response)
+
+        Raises: CircuitOpenError, or whatever fn raised
+        """
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            self.record(False, time.monotonic() - start)
+            raise
+        self.record(not (is_failure and is_failure(result)), time.monotonic() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._update_state(now)
+            self._trim(now)
+            latencies = sorted(call[2] for call in self._calls)
+            failures = sum(1 for call in self._calls if not call[1])
+            return {
+                'state': self._state,
+                'calls': len(self._calls),
+                'failures': failures,
+                'failure_rate': round(failures / len(self._calls), 2) if self._calls else 0.0,
+                'p95_ms': round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1) if latencies else None,
+                'rejected': self._rejected,
+                'times_opened': self._times_opened
+            }
+
+
+class BreakerRegistry:
+    """Named circuit breakers created on first use with shared defaults"""
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, **overrides):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, **dict(self.defaults, **overrides))
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = sorted(self._breakers.items())
+        return {name: breaker.stats() for name, breaker in breakers}
+
+
+class Bulkhead:
+    """Semaphore with a bounded wait and saturation statistics"""
+
+    def __init__(self, name, max_concurrent, queue_timeout=1.0, retry_after=5):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiting = 0
+        self._peak = 0
+        self._calls = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        # Coroutines waiting in aslot(): (loop, future), woken one per released slot
+        self._async_waiters = deque()
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one of the provider's slots for the duration of the block.
+
+        Raises: BulkheadFullError if none became free within queue_timeout
+        """
+        with self._lock:
+            self._waiting += 1
+        start = time.monotonic()
+        acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._rejected += 1
+            else:
+                self._in_use += 1
+                self._peak = max(self._peak, self._in_use)
+                self._calls += 1
+                self._wait_total += time.monotonic() - start
+        if not acquired:
+            print(f"[BULKHEAD] {self.name} saturated, request rejected")
+            raise BulkheadFullError(self.name, self.retry_after)
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._in_use -= 1
+        self._semaphore.release()
+        self._wake_waiter()
+
+    def _wake_waiter(self):
+        """Wake the coroutine that has waited longest in aslot() (callable from any thread)"""
+        with self._lock:
+            while self._async_waiters:
+                loop, waiter = self._async_waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._signal, waiter)
+                    return
+                except RuntimeError:
+                    # Its loop is closed
+                    continue
+
+    def _signal(self, waiter):
+        if waiter.done():
+            # It gave up (timed out or cancelled) meanwhile: the slot goes to the next one
+            self._wake_waiter()
+        else:
+            waiter.set_result(None)
+
+    def _try_enter(self):
+        if not self._semaphore.acquire(blocking=False):
+            return False
+        with self._lock:
+            self._in_use += 1
+            self._peak = max(self._peak, self._in_use)
+            self._calls += 1
+        return True
+
+    async def _wait_for_release(self, timeout):
+        """Sleep until a slot is released (or timeout); False if one is free already"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        entry = (loop, waiter)
+        with self._lock:
+            self._async_waiters.append(entry)
+        try:
+            # A slot freed before we were queued would never wake us
+            if self._semaphore.acquire(blocking=False):
+                self._semaphore.release()
+                return False
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # Cancelled after being woken: pass the wake-up on
+            if waiter.done() and not waiter.cancelled():
+                self._wake_waiter()
+            raise
+        finally:
+            with self._lock:
+                if entry in self._async_waiters:
+                    self._async_waiters.remove(entry)
+        return True
+
+    @asynccontextmanager
+    async def aslot(self):
+        """slot() for coroutines: sleeps on the event loop until a slot is released"""
+        start = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while not self._try_enter():
+                remaining = self.queue_timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    with self._lock:
+                        self._rejected += 1
+                    print(f"[BULKHEAD] {self.name} saturated, request rejected")
+                    raise BulkheadFullError(self.name, self.retry_after)
+                await self._wait_for_release(remaining)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        with self._lock:
+            self._wait_total += time.monotonic() - start
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'saturation': round(self._in_use / self.max_concurrent, 2),
+                'peak': self._peak,
+                'calls': self._calls,
+                'rejected': self._rejected,
+                'avg_wait_ms': round(self._wait_total / self._calls * 1000, 1) if self._calls else 0.0
+            }
+
+
+# ==================== RETRIES ====================
+
+# Statuses that mean "not processed, try again later" (safe to retry any request)
+REJECTED_STATUSES = (429, 503)
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+
+def error_status(error):
+    """HTTP status carried by a provider exception (requests, Groq, Google), or None"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is None and isinstance(getattr(error, 'code', None), int):
+        status = error.code
+    return status
+
+
+def parse_duration(value):
+    """Seconds from '2.5', '1m30.5s' or '250ms' style headers, or None"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    factors = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * factors[unit] for number, unit in parts)
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if value is None:
+        return None
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryBudget:
+    """Retries one request may still spend across all of its provider calls"""
+
+    def __init__(self, retries):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Provider-aware retries with exponential backoff and full jitter.
+
+    retry_statuses: statuses retried for idempotent calls (429 and 503 are always retried)
+    credit_header: response header with the provider's remaining credits/requests;
+                   when it reaches 0 retrying is pointless
+    reset_headers: headers telling when a rate limit resets, used if Retry-After is missing
+    max_hinted_delay: longest provider-requested wait that is still worth retrying after
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=10.0,
+                 retry_statuses=(429, 500, 502, 503, 504), credit_header=None, reset_headers=(),
+                 max_hinted_delay=30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_hinted_delay = max_hinted_delay
+        self.retry_statuses = tuple(retry_statuses)
+        self.credit_header = credit_header
+        self.reset_headers = tuple(reset_headers)
+        self._lock = threading.Lock()
+        self._retries = 0
+        self._gave_up = 0
+        self._credits = None
+
+    def _headers(self, result, error):
+        response = result if result is not None else getattr(error, 'response', None)
+        return getattr(response, 'headers', None) or {}
+
+    def observe(self, result, error=None):
+        """Remember the provider's remaining credits from a response"""
+        if not self.credit_header:
+            return
+        value = self._headers(result, error).get(self.credit_header)
+        if value is None:
+            return
+        try:
+            credits = float(value)
+        except ValueError:
+            return
+        with self._lock:
+            self._credits = credits
+
+    def is_transient(self, result, error, idempotent):
+        """True if the failure may succeed when repeated"""
+        if error is not None:
+            status = error_status(error)
+            if status is None:
+                # No response at all: connection refused/reset or read timeout
+                no_response = getattr(error, 'request', None) is not None and getattr(error, 'response', None) is None
+                return idempotent and (isinstance(error, (ConnectionError, TimeoutError)) or no_response)
+        else:
+            status = getattr(result, 'status_code', None)
+            if status is None:
+                return False
+        if status in REJECTED_STATUSES:
+            return True
+        return idempotent and status in self.retry_statuses
+
+    def out_of_credits(self, result, error):
+        if not self.credit_header:
+            return False
+        value = self._headers(result, error).get(self.credit_header)
+        try:
+            return value is not None and float(value) <= 0
+        except ValueError:
+            return False
+
+    def delay(self, attempt, result=None, error=None):
+        """Seconds to wait before retry number attempt+1 (provider hints win over backoff)"""
+        headers = self._headers(result, error)
+        hinted = parse_retry_after(headers.get('Retry-After'))
+        if hinted is None:
+            for header in self.reset_headers:
+                hinted = parse_duration(headers.get(header))
+                if hinted is not None:
+                    break
+        if hinted is not None:
+            return hinted
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def record(self, retried):
+        with self._lock:
+            if retried:
+                self._retries += 1
+            else:
+                self._gave_up += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_attempts': self.max_attempts,
+                'retries': self._retries,
+                'gave_up': self._gave_up,
+                'remaining_credits': self._credits
+            }
@@ -0,0 +1,75 @@
+# startup_profile.py
+# Boot-time measurements of a worker process, reported by /api/health
+#
+# app.py marks the end of every startup phase (imports, configuration, app
+# setup, models...), so a slow cold start shows where the time went. Heavy,
+# rarely needed libraries are loaded on first use through load() instead of
+# at import time, and their import cost is recorded when that happens.
+# Coroutines use aload(), which imports in a thread so the event loop (shared
+# by every request of the worker) is never blocked by an import.
+#
+# Times are measured from the moment app.py starts executing; the interpreter
+# and the WSGI server's own startup are not included.
+
+import asyncio
+import importlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class StartupProfile:
+    """Phase timings of module startup plus the cost of deferred imports"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self._lock = threading.Lock()
+        self.phases = OrderedDict()
+        self.deferred = OrderedDict()
+        self.ready_seconds = None
+
+    def mark(self, phase):
+        """Record the time since the previous mark as the duration of phase"""
+        now = time.perf_counter()
+        self.phases[phase] = round(now - self._last, 3)
+        self._last = now
+
+    def ready(self):
+        """Module import finished: the worker can serve requests"""
+        self.ready_seconds = round(time.perf_counter() - self.started, 3)
+        print(f"✓ Startup: ready in {self.ready_seconds:.2f}s "
+              f"({', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.phases.items())})")
+
+    def load(self, module_name):
+        """
+        Import a module on first use and record how long the import took.
+        Later calls return the already imported module.
+        """
+        # import_module() waits for an import running in another thread, so nobody gets a
+        # half-initialised module; sys.modules only decides whether this call is timed
+        if module_name in self.deferred or module_name in sys.modules:
+            return importlib.import_module(module_name)
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        with self._lock:
+            if module_name not in self.deferred:
+                self.deferred[module_name] = round(time.perf_counter() - started, 3)
+                print(f"[STARTUP] Deferred import of {module_name} took {self.deferred[module_name]:.2f}s")
+        return module
+
+    async def aload(self, module_name):
+        """load() for coroutines: a first import runs in a thread, off the event loop"""
+        if module_name in self.deferred:
+            return importlib.import_module(module_name)
+        return await asyncio.to_thread(self.load, module_name)
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'ready_seconds': self.ready_seconds,
+            'phases': dict(self.phases),
+            'deferred_imports': dict(self.deferred)
+        }
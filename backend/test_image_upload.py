@@ -0,0 +1,72 @@
+# test_image_upload.py
+# Decompression-bomb guard of image_utils and the upload route
+#
+#   python -m pytest backend/test_image_upload.py
+
+import io
+import os
+import struct
+import zlib
+
+import pytest
+
+# Importing app must not start image workers or create tables
+os.environ.setdefault('IMAGE_WORKERS', '0')
+os.environ.setdefault('DB_AUTO_INIT', 'false')
+
+from image_utils import MAX_IMAGE_PIXELS, ImageTooLargeError, load_image, normalize_for_provider, read_image_info
+
+# Past Pillow's own DecompressionBombError threshold (2x MAX_IMAGE_PIXELS)
+BOMB_SIZE = (12_000, (2 * MAX_IMAGE_PIXELS) // 12_000 + 1)
+# Over MAX_IMAGE_PIXELS, but only a DecompressionBombWarning for Pillow
+OVER_LIMIT_SIZE = (10_000, MAX_IMAGE_PIXELS // 10_000 + 1)
+
+
+def png_header(width, height):
+    """A PNG with a valid header and no pixel data: tiny on disk, huge once decoded"""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IEND', b'')
+
+
+@pytest.fixture
+def bomb_path(tmp_path):
+    path = tmp_path / 'bomb.png'
+    path.write_bytes(png_header(*BOMB_SIZE))
+    return str(path)
+
+
+def test_read_image_info_rejects_decompression_bomb():
+    with pytest.raises(ImageTooLargeError):
+        read_image_info(io.BytesIO(png_header(*BOMB_SIZE)))
+
+
+@pytest.mark.filterwarnings('ignore::PIL.Image.DecompressionBombWarning')
+def test_read_image_info_rejects_image_over_limit():
+    with pytest.raises(ImageTooLargeError):
+        read_image_info(io.BytesIO(png_header(*OVER_LIMIT_SIZE)))
+
+
+def test_load_image_rejects_decompression_bomb(bomb_path):
+    with pytest.raises(ImageTooLargeError):
+        load_image(bomb_path)
+
+
+def test_normalize_for_provider_rejects_decompression_bomb(bomb_path, tmp_path):
+    with pytest.raises(ImageTooLargeError):
+        normalize_for_provider(bomb_path, str(tmp_path / 'cache'))
+
+
+def test_upload_of_decompression_bomb_is_rejected_and_removed(tmp_path):
+    import app as backend
+
+    upload_folder = tmp_path / 'uploads'
+    backend.app.config['UPLOAD_FOLDER'] = str(upload_folder)
+    client = backend.app.test_client()
+
+    response = client.post('/api/upload_image', data={'image': (io.BytesIO(png_header(*BOMB_SIZE)), 'big.png')})
+
+    assert response.status_code == 413
+    assert response.get_json()['error'] == 'Image too large'
+    assert not [name for _, _, names in os.walk(upload_folder) for name in names]
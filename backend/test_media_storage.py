@@ -0,0 +1,96 @@
+# test_media_storage.py
+# S3MediaStorage against an in-memory S3 (moto)
+#
+#   pip install pytest moto
+#   python -m pytest backend/test_media_storage.py
+
+import os
+
+import pytest
+
+moto = pytest.importorskip('moto')
+
+from media_storage import S3MediaStorage, ensure_media_path, resolve_media_path
+
+BUCKET = 'kalakar-media-test'
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        store = S3MediaStorage(bucket=BUCKET, region='us-east-1', prefix='media')
+        store.client.create_bucket(Bucket=BUCKET)
+        yield store
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return str(tmp_path / 'uploads')
+
+
+def write_file(folder, filename, data):
+    path = ensure_media_path(folder, filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_put_uploads_to_sharded_key(storage, folder):
+    path = write_file(folder, 'photo.jpg', b'jpeg bytes')
+
+    assert storage.put(folder, 'photo.jpg', path) is True
+
+    obj = storage.client.get_object(Bucket=BUCKET, Key=storage.object_key(folder, 'photo.jpg'))
+    assert obj['Body'].read() == b'jpeg bytes'
+    assert obj['ContentType'] == 'image/jpeg'
+    assert storage.object_key(folder, 'photo.jpg').startswith('media/uploads/')
+
+
+def test_fetch_downloads_missing_file_into_local_cache(storage, folder):
+    path = write_file(folder, 'photo.jpg', b'jpeg bytes')
+    storage.put(folder, 'photo.jpg', path)
+    os.remove(path)
+
+    fetched = storage.fetch(folder, 'photo.jpg')
+
+    assert fetched == path
+    with open(fetched, 'rb') as f:
+        assert f.read() == b'jpeg bytes'
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith('.part')]
+
+
+def test_fetch_serves_cached_copy_without_s3(storage, folder):
+    path = write_file(folder, 'photo.jpg', b'jpeg bytes')
+    storage.put(folder, 'photo.jpg', path)
+    os.remove(path)
+    storage.fetch(folder, 'photo.jpg')
+
+    storage.client.delete_object(Bucket=BUCKET, Key=storage.object_key(folder, 'photo.jpg'))
+
+    assert storage.fetch(folder, 'photo.jpg') == path
+
+
+def test_fetch_missing_object_returns_none(storage, folder):
+    assert storage.fetch(folder, 'missing.jpg') is None
+    assert resolve_media_path(folder, 'missing.jpg') is None
+
+
+def test_put_failure_returns_false(storage, folder):
+    path = write_file(folder, 'photo.jpg', b'jpeg bytes')
+    storage.bucket = 'no-such-bucket'
+
+    assert storage.put(folder, 'photo.jpg', path) is False
+
+
+def test_delete_removes_local_copy_and_object(storage, folder):
+    path = write_file(folder, 'photo.jpg', b'jpeg bytes')
+    storage.put(folder, 'photo.jpg', path)
+
+    storage.delete(folder, 'photo.jpg')
+
+    assert not os.path.exists(path)
+    listed = storage.client.list_objects_v2(Bucket=BUCKET)
+    assert listed.get('KeyCount', 0) == 0